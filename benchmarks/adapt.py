@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the cost of resolving formats on every read.
+
+Compares adapting the part through IFormat on every read (what the
+baseline did) with BitStream.read, which uses Format instances as
+they are and only adapts other parts.
+
+    python benchmarks/adapt.py [number]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+SETUP = """
+from fusion.bitstream.bitstream import BitStream, BufferBitStream
+from fusion.bitstream.formats import UB
+from fusion.bitstream.flash_formats import UI8
+from fusion.bitstream.interfaces import IFormat
+ub = UB[5]
+bits = BufferBitStream("\\0" * 0x100000)
+abits = BitStream()
+abits.write_bytes("\\0" * 0x1000)
+
+def adapt_read(bs, part):
+    return IFormat(part)._read(bs, bs.tell())
+"""
+
+CASES = [
+    ("buffer read(UI8)",   "bits.cursor = 0; adapt_read(bits, UI8)",
+                           "bits.cursor = 0; bits.read(UI8)"),
+    ("buffer read(UB[5])", "bits.cursor = 0; adapt_read(bits, ub)",
+                           "bits.cursor = 0; bits.read(ub)"),
+    ("array read(UI8)",    "abits.seek(0); adapt_read(abits, UI8)",
+                           "abits.seek(0); abits.read(UI8)"),
+]
+
+def per_call(stmt, number):
+    best = min(timeit.repeat(stmt, SETUP, number=number, repeat=3))
+    return best / number * 1e6
+
+def main(number=100000):
+    print "%-20s %12s %12s" % ("", "IFormat (us)", "read (us)")
+    for name, before, after in CASES:
+        print "%-20s %12.3f %12.3f" % (name, per_call(before, number),
+                                       per_call(after, number))
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
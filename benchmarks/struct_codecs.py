@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the compiled Struct codecs.
+
+Compares interpreting create_fields (what every Struct read and write
+used to do) with the reader and writer fusion.bitstream.compiler
+generates for the same class, and appending the records of a shape
+through a stream of their own with writing them straight in.
+
+    python benchmarks/struct_codecs.py [number]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+SETUP = """
+from fusion.bitstream.bitstream import BitStream
+from fusion.bitstream.compiler import codec_for
+from fusion.bitstream.structs import Struct
+from fusion.swf.records import Rect, RGB, RGBA, Matrix
+from fusion.swf.records import StraightEdgeRecord, CurvedEdgeRecord
+
+record = %s
+cls = type(record)
+codec = codec_for(cls)
+data = record.as_bitstream()
+
+def interpret_read():
+    data.seek(0)
+    instance = cls.__new__(cls)
+    Struct.__init__(instance)
+    instance._interpret_read(data)
+
+def compiled_read():
+    data.seek(0)
+    instance = cls.__new__(cls)
+    Struct.__init__(instance)
+    codec.read(instance, data)
+
+def interpret_write():
+    record._interpret_write(BitStream())
+
+def compiled_write():
+    codec.write(record, BitStream())
+"""
+
+RECORDS = [
+    ("Rect",               "Rect(-200, -150, 5500, 4000)"),
+    ("RGB",                "RGB(0x336699)"),
+    ("RGBA",               "RGBA(0x336699, 0.5)"),
+    ("Matrix",             "Matrix(2, 0, 0, 2, 100, -40)"),
+    ("Matrix (rotate)",    "Matrix(1.5, 0.25, -0.25, 1.5, 10, 20)"),
+    ("StraightEdge",       "StraightEdgeRecord(120, -45)"),
+    ("StraightEdge (v)",   "StraightEdgeRecord(0, 300)"),
+    ("CurvedEdge",         "CurvedEdgeRecord(10, 20, -30, 40)"),
+]
+
+SHAPE_SETUP = """
+from fusion.bitstream.bitstream import BitStream
+from fusion.swf.records import StraightEdgeRecord, CurvedEdgeRecord
+
+records = [StraightEdgeRecord(i %% 50, -i %% 30) if i %% 3 else
+           CurvedEdgeRecord(i %% 7, 3, -5, i %% 11) for i in xrange(%d)]
+
+def copied():
+    bits = BitStream()
+    for record in records:
+        bits += record.as_bitstream()
+
+def written_through():
+    bits = BitStream()
+    for record in records:
+        bits += record
+"""
+
+def per_call(stmt, setup, number):
+    best = min(timeit.repeat(stmt, setup, number=number, repeat=3))
+    return best / number * 1e6
+
+def main(number=10000):
+    print "%-18s %10s %10s %10s %10s" % ("", "read (us)", "compiled",
+                                        "write (us)", "compiled")
+    for name, record in RECORDS:
+        setup = SETUP % (record,)
+        print "%-18s %10.2f %10.2f %10.2f %10.2f" % (name,
+            per_call("interpret_read()",  setup, number),
+            per_call("compiled_read()",   setup, number),
+            per_call("interpret_write()", setup, number),
+            per_call("compiled_write()",  setup, number))
+
+    records = 1000
+    setup = SHAPE_SETUP % (records,)
+    print
+    print "%d shape records: copied %.2f ms, written through %.2f ms" % (
+        records, per_call("copied()", setup, number // 1000 or 1) / 1000,
+        per_call("written_through()", setup, number // 1000 or 1) / 1000)
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
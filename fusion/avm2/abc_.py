@@ -6,22 +6,22 @@ Structures for ABC, ActionScript Byte Code
 import struct
 import os
 
-from fusion.bitstream import BitStream, BitStreamParseMixin
-from fusion.bitstream.formats import Bit, Zero
+from fusion.bitstream import BitStreamParseMixin
+from fusion.bitstream.formats import Bit
 from fusion.bitstream.flash_formats import UI8, UI16, U32
 
 from fusion.avm2.interfaces import IAbcContainer, IConstantPoolWriter, IMultiname
 from fusion.avm2.constants import ConstantPool, QName, MethodFlag
 from fusion.avm2.traits import parse_trait, eval_traits
 from fusion.avm2.assembler import CodeAssembler
-from fusion.avm2.util import serialize_u32 as s_u32, ValuePool
+from fusion.avm2.util import SerializeMixin, ValuePool
 
 from zope.interface import implements
 
 MAJOR_VERSION = 46
 MINOR_VERSION = 16
 
-class AbcFile(BitStreamParseMixin):
+class AbcFile(BitStreamParseMixin, SerializeMixin):
     def __init__(self, constants=None):
         self.constants = constants or ConstantPool()
 
@@ -50,10 +50,10 @@ class AbcFile(BitStreamParseMixin):
         return CodeGenerator(self, make_script)
 
     @classmethod
-    def from_bitstream(cls, bitstream):
+    def from_bitstream(cls, bitstream, lazy_pool=False):
         assert bitstream.read(UI16) == MINOR_VERSION
         assert bitstream.read(UI16) == MAJOR_VERSION
-        constants = ConstantPool.from_bitstream(bitstream)
+        constants = ConstantPool.from_bitstream(bitstream, lazy_pool)
         abc = cls(constants)
 
         def read_pool(pool, info, length=None):
@@ -87,28 +87,24 @@ class AbcFile(BitStreamParseMixin):
 
         return abc
 
-    def serialize(self):
+    def serialize_into(self, writer):
         def write_pool(pool, prefix_count=True):
-            code = ""
             if prefix_count:
-                code += s_u32(len(pool))
+                writer.write_u30(len(pool))
             for item in pool:
-                code += item.serialize()
-            return code
+                item.serialize_into(writer)
 
-        code = struct.pack("<HH", MINOR_VERSION, MAJOR_VERSION)
-        code += self.constants.serialize()
+        writer.write(struct.pack("<HH", MINOR_VERSION, MAJOR_VERSION))
+        self.constants.serialize_into(writer)
 
-        code += write_pool(self.methods)
-        code += write_pool(self.metadatas)
-        code += write_pool(self.instances)
-        code += write_pool(self.classes, False)
-        code += write_pool(self.scripts)
-        code += write_pool(self.bodies)
+        write_pool(self.methods)
+        write_pool(self.metadatas)
+        write_pool(self.instances)
+        write_pool(self.classes, False)
+        write_pool(self.scripts)
+        write_pool(self.bodies)
 
-        return code
-
-class MethodInfo(object):
+class MethodInfo(SerializeMixin):
     implements(IConstantPoolWriter, IAbcContainer)
     def __init__(self, namestr, param_types, return_type, flags=0, options=None, param_names=None, varargs=None):
         self.namestr = namestr
@@ -133,19 +129,19 @@ class MethodInfo(object):
 
     @classmethod
     def parse(cls, bitstream, abc, constants):
-        PTL = bitstream.read(U32)
+        PTL = bitstream.read_u30()
 
-        return_type = constants.multiname.value_at(bitstream.read(U32))
-        param_types = [constants.multiname.value_at(bitstream.read(U32)) for i in xrange(PTL)]
-        namestr = constants.utf8.value_at(bitstream.read(U32))
+        return_type = constants.multiname.value_at(bitstream.read_u30())
+        param_types = [constants.multiname.value_at(i) for i in bitstream.read_u30_run(PTL)]
+        namestr = constants.utf8.value_at(bitstream.read_u30())
 
         flags = bitstream.read(UI8)
 
         options = None
         if flags & MethodFlag.HasOptional:
-            L = bitstream.read(U32)
+            L = bitstream.read_u30()
             for i in xrange(L):
-                bitstream.read(U32)
+                bitstream.read_u30()
                 bitstream.read(UI8)
 #            options = [abc_to_py((bitstream.read(U32),
 #                                  bitstream.read(UI8)),
@@ -153,20 +149,18 @@ class MethodInfo(object):
 
         param_names = None
         if flags & MethodFlag.HasParamNames:
-            param_names = [constants.utf8.value_at(bitstream.read(U32)) for i in xrange(PTL)]
+            param_names = [constants.utf8.value_at(i) for i in bitstream.read_u30_run(PTL)]
 
         varargs = bool(flags & MethodFlag.NeedRest)
 
         return cls(namestr, param_types, return_type, flags, options, param_names, varargs)
 
-    def serialize(self):
-        code = ""
-
-        code += s_u32(len(self.param_types))
-        code += s_u32(self._return_type_index)
+    def serialize_into(self, writer):
+        writer.write_u30(len(self.param_types))
+        writer.write_u30(self._return_type_index)
 
-        code += ''.join(s_u32(index) for index in self._param_types_indices)
-        code += s_u32(self._namestr_index)
+        writer.write_u30_seq(self._param_types_indices)
+        writer.write_u30(self._namestr_index)
 
         if self.options:
             self.flags |= MethodFlag.HasOptional
@@ -177,18 +171,16 @@ class MethodInfo(object):
         if self.varargs:
             self.flags |= MethodFlag.NeedRest
 
-        code += chr(self.flags & 0xFF)
+        writer.write_ui8(self.flags)
 
         if self.options:
-            code += s_u32(len(self.options))
+            writer.write_u30(len(self.options))
             for ctype, index in self._options_indices:
-                code += s_u32(index)
-                code += chr(ctype)
+                writer.write_u30(index)
+                writer.write_ui8(ctype)
 
         if self.param_names:
-            code += ''.join(s_u32(index) for index in self._param_names_indices)
-
-        return code
+            writer.write_u30_seq(self._param_names_indices)
 
     def add_abc_elements(self, abcfile):
         if self.body is not None:
@@ -209,7 +201,7 @@ class MethodInfo(object):
     def __repr__(self):
         return "MethodInfo(%r)" % (self.namestr,)
 
-class MetadataInfo(object):
+class MetadataInfo(SerializeMixin):
     implements(IConstantPoolWriter)
     def __init__(self, name, items):
         self.name = name
@@ -229,18 +221,11 @@ class MetadataInfo(object):
 
         return cls(name, items)
 
-    def serialize(self):
-        code = ""
-        code += s_u32(self._name_index)
-        code += s_u32(len(self.items))
-
-        for key_i in self._keys_indices:
-            code += s_u32(key_i)
-
-        for val_i in self._values_indices:
-            code += s_u32(val_i)
-
-        return code
+    def serialize_into(self, writer):
+        writer.write_u30(self._name_index)
+        writer.write_u30(len(self.items))
+        writer.write_u30_seq(self._keys_indices)
+        writer.write_u30_seq(self._values_indices)
 
     def write_constants(self, pool):
         self._name_index = pool.utf8.index_for(self.name)
@@ -250,7 +235,7 @@ class MetadataInfo(object):
     def __repr__(self):
         return "Metadata(%r, %s)" % (self.name, ''.join("%s=%r" % t for t in self.items.iteritems()))
 
-class TraitContainer(object):
+class TraitContainer(SerializeMixin):
     implements(IConstantPoolWriter, IAbcContainer)
     def __init__(self, traits):
         self.traits = traits or []
@@ -304,41 +289,34 @@ class InstanceInfo(TraitContainer):
         if FlagProtectedNS:
             protectedNs = constants.namespace.value_at(bitstream.read(U32))
 
-        interfaces = [constants.multiname.value_at(bitstream.read(U32)) for i in xrange(bitstream.read(U32))]
+        interfaces = [constants.multiname.value_at(i) for i in bitstream.read_u30_run(bitstream.read_u30())]
         iinit = abc.methods.value_at(bitstream.read(U32))
 
         traits = [parse_trait(bitstream, abc, constants) for i in xrange(bitstream.read(U32))]
         return cls(name, iinit, interfaces, FlagIsInterface, FlagIsFinal, FlagIsSealed, super_name, traits, protectedNs)
 
-    def serialize(self):
-        code = ""
-        code += s_u32(self._name_index)
-        code += s_u32(self._super_name_index)
+    def serialize_into(self, writer):
+        writer.write_u30(self._name_index)
+        writer.write_u30(self._super_name_index)
 
-        # Flags
-        flags = BitStream()
-        flags.write(Zero[4])                  # first four bits = not defined
-        flags.write(self.protectedNs != None) # 1000 = 0x08 = CLASSFLAG_ClassProtectedNs
-        flags.write(self.is_interface)        # 0100 = 0x04 = CLASSFLAG_ClassInterface
-        flags.write(self.is_final)            # 0010 = 0x02 = CLASSFLAG_ClassFinal
-        flags.write(self.is_sealed)           # 0001 = 0x01 = CLASSFLAG_ClassSealed
-
-        code += flags.serialize()
+        # Flags, the first four bits are not defined.
+        flags  = 0x08 if self.protectedNs != None else 0 # CLASSFLAG_ClassProtectedNs
+        flags |= 0x04 if self.is_interface else 0        # CLASSFLAG_ClassInterface
+        flags |= 0x02 if self.is_final else 0            # CLASSFLAG_ClassFinal
+        flags |= 0x01 if self.is_sealed else 0           # CLASSFLAG_ClassSealed
+        writer.write_ui8(flags)
 
         if self.protectedNs:
-            code += s_u32(self._protectedNs_index)
+            writer.write_u30(self._protectedNs_index)
 
-        code += s_u32(len(self.interfaces))
-        for index in self._interface_indices:
-            code += s_u32(index)
+        writer.write_u30(len(self.interfaces))
+        writer.write_u30_seq(self._interface_indices)
 
-        code += s_u32(self._iinit_index)
+        writer.write_u30(self._iinit_index)
 
-        code += s_u32(len(self.traits))
+        writer.write_u30(len(self.traits))
         for trait in self.traits:
-            code += trait.serialize()
-
-        return code
+            trait.serialize_into(writer)
 
     def write_constants(self, pool):
         super(InstanceInfo, self).write_constants(pool)
@@ -370,14 +348,11 @@ class ClassInfo(TraitContainer):
         traits = [parse_trait(bitstream, abc, constants) for i in xrange(bitstream.read(U32))]
         return cls(cinit, traits)
 
-    def serialize(self):
-        code = ""
-        code += s_u32(self._cinit_index)
-        code += s_u32(len(self.traits))
+    def serialize_into(self, writer):
+        writer.write_u30(self._cinit_index)
+        writer.write_u30(len(self.traits))
         for trait in self.traits:
-            code += trait.serialize()
-
-        return code
+            trait.serialize_into(writer)
 
     def add_abc_elements(self, abcfile):
         super(ClassInfo, self).add_abc_elements(abcfile)
@@ -401,15 +376,11 @@ class ScriptInfo(TraitContainer):
         traits = [parse_trait(bitstream, abc, constants) for i in xrange(bitstream.read(U32))]
         return cls(init, traits)
 
-    def serialize(self):
-        code = ""
-
-        code += s_u32(self._init_index)
-        code += s_u32(len(self.traits))
+    def serialize_into(self, writer):
+        writer.write_u30(self._init_index)
+        writer.write_u30(len(self.traits))
         for trait in self.traits:
-            code += trait.serialize()
-
-        return code
+            trait.serialize_into(writer)
 
     def add_abc_elements(self, abcfile):
         super(ScriptInfo, self).add_abc_elements(abcfile)
@@ -446,7 +417,7 @@ class MethodBodyInfo(TraitContainer):
 
         return cls(minfo, code, traits, exceptions)
 
-    def serialize(self):
+    def serialize_into(self, writer):
         self.code.emit('returnvoid')
 
 #        if self.optimize:
@@ -454,25 +425,22 @@ class MethodBodyInfo(TraitContainer):
 
         self.code.pass1()
 
-        code = ""
-        code += s_u32(self._method_info_index)
-        code += s_u32(self.code.max_stack_depth)
-        code += s_u32(self.code.max_local_count)
-        code += s_u32(0)
-        code += s_u32(self.code.max_scope_depth)
+        writer.write_u30(self._method_info_index)
+        writer.write_u30(self.code.max_stack_depth)
+        writer.write_u30(self.code.max_local_count)
+        writer.write_u30(0)
+        writer.write_u30(self.code.max_scope_depth)
         body = self.code.serialize()
-        code += s_u32(len(body))
-        code += body
+        writer.write_u30(len(body))
+        writer.write(body)
 
-        code += s_u32(len(self.exceptions))
+        writer.write_u30(len(self.exceptions))
         for exc in self.exceptions or []:
-            code += exc.serialize()
+            exc.serialize_into(writer)
 
-        code += s_u32(len(self.traits))
+        writer.write_u30(len(self.traits))
         for trait in self.traits or []:
-            code += trait.serialize()
-
-        return code
+            trait.serialize_into(writer)
 
     def add_abc_elements(self, abcfile):
         super(MethodBodyInfo, self).add_abc_elements(abcfile)
@@ -487,7 +455,7 @@ class MethodBodyInfo(TraitContainer):
     def __repr__(self):
         return "MethodBody(%r)" % (self.method_info.namestr,)
 
-class Exception(object):
+class Exception(SerializeMixin):
     implements(IConstantPoolWriter)
     def __init__(self, from_, to_, target, exc_type, var_name):
         self.from_ = from_
@@ -508,14 +476,12 @@ class Exception(object):
                    constants.multiname.value_at(bitstream.read(U32)),
                    constants.multiname.value_at(bitstream.read(U32)))
 
-    def serialize(self):
-        code = ""
-        code += s_u32(self.from_)
-        code += s_u32(self.to_)
-        code += s_u32(self.target)
-        code += s_u32(self._exc_type_index)
-        code += s_u32(self._var_name_index)
-        return code
+    def serialize_into(self, writer):
+        writer.write_u30(self.from_)
+        writer.write_u30(self.to_)
+        writer.write_u30(self.target)
+        writer.write_u30(self._exc_type_index)
+        writer.write_u30(self._var_name_index)
 
     def write_constants(self, pool):
         self._exc_type_index = pool.multiname.index_for(self.exc_type)
@@ -1,4 +1,5 @@
 
+import os
 import struct
 from math import isnan
 
@@ -6,7 +7,8 @@ from fusion.bitstream.bitstream import BitStreamParseMixin
 from fusion.bitstream.flash_formats import UI8, U32, S32, DOUBLE
 from fusion.bitstream.formats import UTF8
 from fusion.avm2.interfaces import ILoadable, IMultiname, IConstantPoolWriter
-from fusion.avm2.util import serialize_u32 as u32, ValuePool
+from fusion.avm2.util import SerializeMixin, ValuePool, LazyValuePool, \
+     never_default
 
 from zope.interface import implements, implementer
 from zope.component import adapter, provideAdapter
@@ -133,7 +135,7 @@ null = _null()
 # Namespace
 # ======================================
 
-class Namespace(object):
+class Namespace(SerializeMixin):
     implements(IConstantPoolWriter)
     def __init__(self, kind, name):
         self.kind = kind
@@ -152,8 +154,9 @@ class Namespace(object):
     def write_constants(self, pool):
         self._name_index = pool.utf8.index_for(self.name)
 
-    def serialize(self):
-        return chr(self.kind) + u32(self._name_index)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._name_index)
 
     @classmethod
     def parse(cls, bitstream, pool):
@@ -164,7 +167,7 @@ class Namespace(object):
         return "Namespace(name=%r, kind=%r)" % (self.name, kind.get(self.kind, self.kind))
 
 # NamespaceSets
-class NamespaceSet(object):
+class NamespaceSet(SerializeMixin):
     """
     A "NamespaceSet" provides a list of namespaces, usually with
     a Multiname/MultinameL to search the scope stack.
@@ -194,13 +197,12 @@ class NamespaceSet(object):
 
     @classmethod
     def parse(cls, bitstream, pool):
-        ns = []
-        for i in xrange(bitstream.read(U32)):
-            ns.append(pool.namespace.value_at(bitstream.read(U32)))
-        return cls(*ns)
+        indices = bitstream.read_u30_run(bitstream.read_u30())
+        return cls(*[pool.namespace.value_at(i) for i in indices])
 
-    def serialize(self):
-        return u32(len(self.ns)) + ''.join(u32(index) for index in self._ns_indices)
+    def serialize_into(self, writer):
+        writer.write_u30(len(self.ns))
+        writer.write_u30_seq(self._ns_indices)
 
 PACKAGE_NAMESPACE = Namespace(TypeIdentifier.PackageNamespace, "")
 ANY_NAMESPACE     = Namespace(TypeIdentifier.Namespace, "*")
@@ -254,7 +256,15 @@ def parse_multiname(bitstream, pool):
     cls = MultinameKinds[kind]
     return cls.parse(bitstream, pool)
 
-class MultinameL(object):
+def skip_multiname(bitstream):
+    kind = bitstream.read_u30()
+    if kind == TypeIdentifier.TypeName:
+        bitstream.read_u30()
+        bitstream.read_u30_run(bitstream.read_u30())
+    else:
+        bitstream.read_u30_run(MultinameIndexCounts[kind])
+
+class MultinameL(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.MultinameL
@@ -279,13 +289,14 @@ class MultinameL(object):
     def parse(cls, bitstream, constants):
         return cls(constants.nsset.value_at(bitstream.read(U32)))
 
-    def serialize(self):
-        return chr(self.kind) + u32(self._ns_set_index)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._ns_set_index)
 
 class MultinameLA(MultinameL):
     kind = TypeIdentifier.MultinameLA
 
-class Multiname(object):
+class Multiname(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.Multiname
@@ -315,8 +326,10 @@ class Multiname(object):
         nsset = constants.nsset.value_at(bitstream.read(U32))
         return cls(name, nsset)
 
-    def serialize(self):
-        return chr(self.kind) + u32(self._name_index) + u32(self._ns_set_index)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._name_index)
+        writer.write_u30(self._ns_set_index)
 
     def __str__(self):
         return '%s::%s' % (self.ns_set, self.name)
@@ -324,7 +337,7 @@ class Multiname(object):
 class MultinameA(Multiname):
     kind = TypeIdentifier.MultinameA
 
-class QName(object):
+class QName(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.QName
@@ -376,8 +389,10 @@ class QName(object):
             name = constants.utf8.value_at(nameidx)
         return cls(name, ns)
 
-    def serialize(self):
-        return chr(self.kind) + u32(self._ns_index) + u32(self._name_index)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._ns_index)
+        writer.write_u30(self._name_index)
 
 class QNameA(QName):
     kind = TypeIdentifier.QNameA
@@ -386,7 +401,7 @@ class QNameA(QName):
 def packagedQName(ns, name):
     return QName(name, Namespace(TypeIdentifier.PackageNamespace, ns))
 
-class RtqName(object):
+class RtqName(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.RtqName
@@ -418,13 +433,14 @@ class RtqName(object):
         name = constants.utf8.value_at(bitstream.read(U32))
         return cls(name)
 
-    def serialize(self):
-        return chr(self.kind) + u32(self._name_index)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._name_index)
 
 class RtqNameA(RtqName):
     kind = TypeIdentifier.RtqNameA
 
-class RtqNameL(object):
+class RtqNameL(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.RtqNameL
@@ -448,13 +464,13 @@ class RtqNameL(object):
     def parse(cls, bitstream, constants):
         return cls()
 
-    def serialize(self):
-        return chr(self.kind)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
 
 class RtqNameLA(object):
     kind = TypeIdentifier.RtqNameLA
 
-class TypeName(object):
+class TypeName(SerializeMixin):
     implements(IMultiname, ILoadable, IConstantPoolWriter)
 
     kind = TypeIdentifier.TypeName
@@ -495,12 +511,11 @@ class TypeName(object):
         types = [constants.multiname.value_at(bitstream.read(U32)) for i in xrange(types_count)]
         return cls(name, types)
 
-    def serialize(self):
-        code = [chr(self.kind)]
-        code.append(u32(self._name_index))
-        code.append(u32(len(self._types_indices)))
-        code.extend(u32(a) for a in self._types_indices)
-        return ''.join(code)
+    def serialize_into(self, writer):
+        writer.write_ui8(self.kind)
+        writer.write_u30(self._name_index)
+        writer.write_u30(len(self._types_indices))
+        writer.write_u30_seq(self._types_indices)
 
 MultinameKinds = {
     TypeIdentifier.QName: QName,
@@ -516,22 +531,37 @@ MultinameKinds = {
     TypeIdentifier.TypeName: TypeName,
 }
 
+# The number of u30 indices after each multiname kind,
+# except TypeName, which has a list of them.
+MultinameIndexCounts = {
+    TypeIdentifier.QName: 2,
+    TypeIdentifier.QNameA: 2,
+    TypeIdentifier.MultinameL: 1,
+    TypeIdentifier.MultinameLA: 1,
+    TypeIdentifier.Multiname: 2,
+    TypeIdentifier.MultinameA: 2,
+    TypeIdentifier.RtqName: 1,
+    TypeIdentifier.RtqNameA: 1,
+    TypeIdentifier.RtqNameL: 0,
+    TypeIdentifier.RtqNameLA: 0,
+}
+
 # ======================================
 # Constant Pool
 # ======================================
 
-class ConstantPool(BitStreamParseMixin):
+class ConstantPool(BitStreamParseMixin, SerializeMixin):
     def __init__(self):
         self.int       = ValuePool(self, 0)
 
         # don't match -- pushuint is dumb
-        self.uint      = ValuePool(self, 0, lambda v: False)
+        self.uint      = ValuePool(self, 0, never_default)
         self.double    = ValuePool(self, float('nan'), isnan)
 
         # don't match due to https://bugzilla.mozilla.org/show_bug.cgi?id=628031
-        self.utf8      = ValuePool(self, "", lambda v: False)
+        self.utf8      = ValuePool(self, "", never_default)
         self.namespace = ValuePool(self, ANY_NAMESPACE)
-        self.nsset     = ValuePool(self, "non-existant", lambda v: False)
+        self.nsset     = ValuePool(self, "non-existant", never_default)
         self.multiname = ValuePool(self, QName("*"))
 
     def write(self, value):
@@ -540,10 +570,11 @@ class ConstantPool(BitStreamParseMixin):
         except TypeError:
             pass
 
-    def serialize(self):
-
-        def double(double):
-            return struct.pack("<d", double)
+    def serialize_into(self, writer):
+        def write_pool(pool, fn):
+            writer.write_u30(len(pool))
+            for item in pool:
+                fn(item)
 
         def utf8(string):
             try:
@@ -551,27 +582,33 @@ class ConstantPool(BitStreamParseMixin):
             except TypeError:
                 pass
             string = string.encode("utf8")
-            return u32(len(string)) + string
+            writer.write_u30(len(string))
+            writer.write(string)
 
         def serializable(item):
-            return item.serialize()
-
-        def write_pool(pool, fn):
-            return u32(len(pool)) + ''.join(fn(i) for i in pool)
-
-        bytes = ""
-        bytes += write_pool(self.int, u32)
-        bytes += write_pool(self.uint, u32)
-        bytes += write_pool(self.double, double)
-        bytes += write_pool(self.utf8, utf8)
-        bytes += write_pool(self.namespace, serializable)
-        bytes += write_pool(self.nsset, serializable)
-        bytes += write_pool(self.multiname, serializable)
-
-        return bytes
+            item.serialize_into(writer)
+
+        writer.write_u30(len(self.int))
+        writer.write_u30_seq(self.int)
+        writer.write_u30(len(self.uint))
+        writer.write_u30_seq(self.uint)
+        writer.write_u30(len(self.double))
+        writer.write(struct.pack("<%dd" % (len(self.double.pool),), *self.double))
+        write_pool(self.utf8, utf8)
+        write_pool(self.namespace, serializable)
+        write_pool(self.nsset, serializable)
+        write_pool(self.multiname, serializable)
 
     @classmethod
-    def from_bitstream(cls, bitstream):
+    def from_bitstream(cls, bitstream, lazy_pool=False):
+        """
+        Parse a constant pool.
+
+        If lazy_pool is True, the strings, namespaces, namespace sets
+        and multinames are only skipped over, and each is decoded
+        when it is first looked up. The bitstream has to stay
+        seekable for as long as the pool is used.
+        """
         pool = cls()
 
         int_count = bitstream.read(U32)
@@ -583,8 +620,12 @@ class ConstantPool(BitStreamParseMixin):
             pool.uint.add_value(bitstream.read(U32))
 
         double_count = bitstream.read(U32)
-        for i in xrange(1, double_count):
-            pool.double.add_value(bitstream.read(DOUBLE))
+        for double in bitstream.read_array(DOUBLE, max(double_count - 1, 0)):
+            pool.double.add_value(double)
+
+        if lazy_pool:
+            cls.skip_to_lazy(bitstream, pool)
+            return pool
 
         utf8_count = bitstream.read(U32)
         for i in xrange(1, utf8_count):
@@ -604,3 +645,57 @@ class ConstantPool(BitStreamParseMixin):
             pool.multiname.add_value(parse_multiname(bitstream, pool))
 
         return pool
+
+    @classmethod
+    def skip_to_lazy(cls, bitstream, pool):
+        """
+        Record where each entry of the rest of the pool starts, and
+        replace the ValuePools of pool with LazyValuePools that
+        decode those entries on demand.
+        """
+        start = bitstream.tell()
+
+        def skip_utf8(bitstream):
+            bitstream.seek(bitstream.read_u30() * 8, os.SEEK_CUR)
+
+        def skip_namespace(bitstream):
+            bitstream.read(UI8)
+            bitstream.read_u30()
+
+        def skip_nsset(bitstream):
+            bitstream.read_u30_run(bitstream.read_u30())
+
+        def read_utf8(bitstream, pool):
+            return bitstream.read(UTF8[bitstream.read_u30()])
+
+        entries = []
+        for skip, parse in ((skip_utf8, read_utf8),
+                            (skip_namespace, Namespace.parse),
+                            (skip_nsset, NamespaceSet.parse),
+                            (skip_multiname, parse_multiname)):
+            offsets = []
+            for i in xrange(1, bitstream.read_u30()):
+                offsets.append(bitstream.tell() - start)
+                skip(bitstream)
+            entries.append((offsets, parse))
+
+        end = bitstream.tell()
+        bitstream.seek(start)
+        bits = bitstream.substream(end - start)
+
+        def decoder(offsets, parse):
+            def decode(index):
+                cursor = bits.tell()
+                bits.seek(offsets[index])
+                try:
+                    return parse(bits, pool)
+                finally:
+                    bits.seek(cursor)
+            return decode
+
+        for name, (offsets, parse) in zip(("utf8", "namespace", "nsset", "multiname"),
+                                          entries):
+            eager = getattr(pool, name)
+            setattr(pool, name, LazyValuePool(pool, len(offsets),
+                                              decoder(offsets, parse),
+                                              eager.default, eager.is_default))
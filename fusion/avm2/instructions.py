@@ -43,6 +43,13 @@ class BaseInstruction(object):
     def write_constants(self, pool):
         pass
 
+    def __reduce_ex__(self, protocol):
+        if self.opcode is None:
+            return super(BaseInstruction, self).__reduce_ex__(protocol)
+        # get_instruction makes the opcode classes, so they cannot be
+        # found by their module and name.
+        return _rebuild_instruction, (self.name,), self.__dict__
+
     @classmethod
     def parse_inner(cls, bitstream, abc, constants, asm):
         return cls()
@@ -144,7 +151,7 @@ class U30Base(BaseInstruction):
 
     @classmethod
     def parse_inner(cls, bitstream, abc, constants, asm):
-        return cls(*[bitstream.read(U32) for i in xrange(cls.arg_count)])
+        return cls(*bitstream.read_u30_run(cls.arg_count))
 
     def serialize_arguments(self):
         return ''.join(u32(i) for i in self.arguments)
@@ -619,6 +626,10 @@ def get_instruction(name):
 
     return _InstructionCache[name]
 
+def _rebuild_instruction(name):
+    cls = get_instruction(name)
+    return cls.__new__(cls)
+
 def parse_instruction(bitstream, abc, constants, asm):
     label_name = _make_offset_label_name(bitstream.tell()//8)
     cls = get_instruction(OpcodeToName[bitstream.read(UI8)])
@@ -1,5 +1,5 @@
 
-from fusion.avm2 import assembler, constants
+from fusion.avm2 import assembler, constants, util
 
 def test_simple():
     asm = assembler.CodeAssembler([])
@@ -66,3 +66,46 @@ def test_multinames():
     const.write(asm)
 
     assert const.multiname.value_at(1) == constants.QName("String")
+
+def test_lazy_pool():
+    asm = assembler.CodeAssembler([])
+    asm.emit("pushstring", "Hello")
+    asm.emit("getlex", constants.packagedQName("flash.display", "Sprite"))
+    asm.emit("pushdouble", 2.5)
+
+    const = constants.ConstantPool()
+    const.write(asm)
+    bytes = const.serialize()
+
+    lazy = constants.ConstantPool.from_bytestring(bytes, lazy_pool=True)
+    assert lazy.double.value_at(1) == 2.5
+    assert all(v is util.pending for v in lazy.multiname.pool)
+
+    name = lazy.multiname.value_at(1)
+    assert name == constants.packagedQName("flash.display", "Sprite")
+    assert lazy.utf8.pool.count(util.pending) == 1
+    assert not lazy.utf8.materialized
+
+    eager = constants.ConstantPool.from_bytestring(bytes)
+    for name in ("utf8", "namespace", "nsset", "multiname"):
+        assert list(getattr(lazy, name)) == list(getattr(eager, name))
+    assert lazy.utf8.materialized
+    assert lazy.utf8.get_index("Hello") == eager.utf8.get_index("Hello")
+
+def test_multiname_serialization():
+    ns = constants.Namespace(constants.TypeIdentifier.PackageNamespace, "flash.display")
+    names = [constants.QName("Sprite", ns),
+             constants.Multiname("x", constants.NamespaceSet(ns)),
+             constants.MultinameL(constants.NamespaceSet(ns)),
+             constants.TypeName("Vector", ["int"])]
+
+    const = constants.ConstantPool()
+    for name in names:
+        const.multiname.index_for(name)
+        const.write(name)
+    parsed = constants.ConstantPool.from_bytestring(const.serialize())
+    for name in names:
+        assert parsed.multiname.value_at(const.multiname.index_for(name)) == name
+
+    nsset = const.nsset.value_at(1)
+    assert nsset.serialize() == "\x01" + chr(const.namespace.index_for(ns))
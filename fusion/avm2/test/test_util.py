@@ -1,7 +1,9 @@
 
 import py.test
+import pickle
 
-from fusion.avm2.util import serialize_u32, ValuePool
+from fusion.avm2.util import serialize_u32, AbcWriter, ValuePool, LazyValuePool, \
+     never_default
 
 def test_serialize_u32():
     for i in xrange(2**7):
@@ -28,6 +30,17 @@ def test_serialize_u32_signed():
     for i in range(-2**35, -2**35-5):
         py.test.raises(ValueError, serialize_u32, i)
 
+def test_AbcWriter():
+    writer = AbcWriter()
+    writer.write("\x01\x02")
+    writer.write_ui8(0x1FF)
+    writer.write_u30(5)
+    writer.write_u30(2**20)
+    writer.write_u30_seq([0x80, -1, 3])
+    assert writer.getvalue() == "\x01\x02\xFF" + "".join(
+        serialize_u32(i) for i in [5, 2**20, 0x80, -1, 3])
+    assert len(writer) == len(writer.getvalue())
+
 def test_value_pool_default():
     test = object()
     pool = ValuePool(None, default=test)
@@ -50,3 +63,17 @@ def test_value_pool_no_default():
 
     assert pool.index_for(test2) == 1
     assert pool.value_at(1) == test2
+
+def test_value_pool_pickle():
+    pool = ValuePool(None, default=0)
+    pool.index_for(5)
+    copy = pickle.loads(pickle.dumps(pool, 2))
+    assert copy.value_at(1) == 5
+    assert copy.index_for(0) == 0
+    assert copy.is_default.im_self is copy
+
+    lazy = LazyValuePool(None, 3, lambda i: "v%d" % i, "", never_default)
+    assert lazy.value_at(2) == "v1"
+    copy = pickle.loads(pickle.dumps(lazy, 2))
+    assert list(copy) == ["v0", "v1", "v2"]
+    assert copy.index_for("") == 4
@@ -1,12 +1,11 @@
 
 import os
 
-from fusion.bitstream.bitstream import BitStream
 from fusion.bitstream.formats import U32, Bit, UB
 from fusion.bitstream.flash_formats import UI8
 
 from fusion.avm2.interfaces import IMultiname, IConstantPoolWriter, IAbcContainer
-from fusion.avm2.util import serialize_u32 as s_u32
+from fusion.avm2.util import SerializeMixin
 
 from zope.interface import implements
 
@@ -20,7 +19,7 @@ class TraitKinds(object):
     Const    = 6
 
 def parse_trait(bitstream, abc, constants):
-    name = constants.multiname.value_at(bitstream.read(U32))
+    name = constants.multiname.value_at(bitstream.read_u30())
 
     bitstream.seek(1, os.SEEK_CUR)
     has_metadata = bitstream.read(Bit)
@@ -35,8 +34,8 @@ def parse_trait(bitstream, abc, constants):
     trait.override = override
 
     if has_metadata:
-        L = xrange(bitstream.read(U32))
-        trait.metadata = [abc.metadatas.value_at(bitstream.read(U32)) for i in L]
+        L = bitstream.read_u30_run(bitstream.read_u30())
+        trait.metadata = [abc.metadatas.value_at(i) for i in L]
 
     return trait
 
@@ -90,7 +89,7 @@ def eval_traits(owner):
     owner.methods    = methods
     owner.properties = properties
 
-class TraitBase(object):
+class TraitBase(SerializeMixin):
     """
     Traits are things that specify ownership of a specific
     part elsewhere in the ABC file. Scripts, classes,
@@ -125,28 +124,22 @@ class TraitBase(object):
     def write_constants(self, pool):
         self._name_index = pool.multiname.index_for(self.name)
 
-    def serialize_inner(self):
-        return ""
+    def serialize_inner(self, writer):
+        pass
 
-    def serialize(self):
-        code = ""
-        code += s_u32(self._name_index)
+    def serialize_into(self, writer):
+        writer.write_u30(self._name_index)
 
-        flags = BitStream()
-        flags.write(False)
-        flags.write(bool(self.metadata)) # Has Metadata
-        flags.write(self.is_override)    # Is Override
-        flags.write(self.is_final)       # Is Final
-        flags.write(self.kind, UB[4])    # kind
+        flags  = 0x40 if self.metadata else 0 # Has Metadata
+        flags |= 0x20 if self.is_override else 0 # Is Override
+        flags |= 0x10 if self.is_final else 0    # Is Final
+        writer.write_ui8(flags | self.kind & 0x0F) # kind
 
-        code += flags.serialize()
-        code += self.serialize_inner()
+        self.serialize_inner(writer)
 
         if self.metadata:
-            code += s_u32(len(self.metadata))
-            for m in self._metadata_indices:
-                code += s_u32(m)
-        return code
+            writer.write_u30(len(self.metadata))
+            writer.write_u30_seq(self._metadata_indices)
 
 class SlotTrait(TraitBase):
     """
@@ -190,16 +183,12 @@ class SlotTrait(TraitBase):
 
         return cls(None, type_name, value, slot_id)
 
-    def serialize_inner(self):
-        code = ""
-
-        code += s_u32(self.slot_id)
-        code += s_u32(self._type_name_index)
-        code += s_u32(self._default_index)
+    def serialize_inner(self, writer):
+        writer.write_u30(self.slot_id)
+        writer.write_u30(self._type_name_index)
+        writer.write_u30(self._default_index)
         if self._default_index:
-            code += s_u32(self._default_kind)
-
-        return code
+            writer.write_u30(self._default_kind)
 
 class ConstTrait(SlotTrait):
     """
@@ -228,8 +217,9 @@ class ClassTrait(TraitBase):
         clazz   = abc.classes.value_at(bitstream.read(U32))
         return cls(None, clazz, slot_id)
 
-    def serialize_inner(self):
-        return s_u32(self.slot_id) + s_u32(self._cls_index)
+    def serialize_inner(self, writer):
+        writer.write_u30(self.slot_id)
+        writer.write_u30(self._cls_index)
 
 class MethodTrait(TraitBase):
     kind = TraitKinds.Method
@@ -250,8 +240,9 @@ class MethodTrait(TraitBase):
         method = abc.methods.value_at(bitstream.read(U32))
         return cls(None, method, disp_id)
 
-    def serialize_inner(self):
-        return s_u32(self.disp_id) + s_u32(self._method_index)
+    def serialize_inner(self, writer):
+        writer.write_u30(self.disp_id)
+        writer.write_u30(self._method_index)
 
 class GetterTrait(MethodTrait):
     kind = TraitKinds.Getter
@@ -278,8 +269,9 @@ class FunctionTrait(TraitBase):
         function = abc.methods.value_at(bitstream.read(U32))
         return cls(None, function, slot_id)
 
-    def serialize_inner(self):
-        return s_u32(self.slot_id) + s_u32(self._function_index)
+    def serialize_inner(self, writer):
+        writer.write_u30(self.slot_id)
+        writer.write_u30(self._function_index)
 
 Traits = [SlotTrait, MethodTrait, GetterTrait,
           SetterTrait, ClassTrait, FunctionTrait,
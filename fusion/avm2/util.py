@@ -4,7 +4,14 @@ import struct
 U32_MAX = 2**32 - 1
 S32_MAX = 2**31 - 1
 
+# EncodedU32s of the values below 2**14, which covers nearly every
+# index and count in an ABC file.
+U30_TABLE = [chr(i) for i in xrange(0x80)] + \
+            [chr(0x80 | i & 0x7F) + chr(i >> 7) for i in xrange(0x80, 0x4000)]
+
 def serialize_u32(value):
+    if 0 <= value < 0x4000:
+        return U30_TABLE[value]
     if value >= 2**35 or value <= -2**34:
         raise ValueError("value %d does not fit in a u32" % (value,))
     encoded, value = "", value & 0xFFFFFFFF
@@ -26,12 +33,62 @@ def serialize_s24(value):
         raise ValueError, "value does not fit in a s24"
     return m[:3]
 
+class AbcWriter(object):
+    """
+    A growable buffer that the serialize_into methods of the
+    ABC structures append to.
+    """
+    def __init__(self):
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def write(self, bytes):
+        self.data += bytes
+
+    def write_ui8(self, value):
+        self.data.append(value & 0xFF)
+
+    def write_u30(self, value):
+        if 0 <= value < 0x4000:
+            self.data += U30_TABLE[value]
+        else:
+            self.data += serialize_u32(value)
+
+    def write_u30_seq(self, values):
+        data, table = self.data, U30_TABLE
+        for value in values:
+            if 0 <= value < 0x4000:
+                data += table[value]
+            else:
+                data += serialize_u32(value)
+
+    def getvalue(self):
+        return str(self.data)
+
+class SerializeMixin(object):
+    """
+    Provides serialize() on top of the serialize_into(writer) of the
+    class it is mixed into.
+    """
+    def serialize(self):
+        writer = AbcWriter()
+        self.serialize_into(writer)
+        return writer.getvalue()
+
 class empty(object):
     def __repr__(self):
         return "(empty)"
 
 empty = empty()
 
+def never_default(value):
+    """
+    For pools that should store the default value like any other.
+    """
+    return False
+
 class ValuePool(object):
     def __init__(self, parent, default=None, is_default=None):
         self.parent = parent
@@ -44,6 +101,19 @@ class ValuePool(object):
     def default_compare(self, value):
         return value == self.default
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Bound methods do not pickle, and default_compare is rebound
+        # to the unpickled pool.
+        if getattr(self.is_default, "im_func", None) is ValuePool.default_compare.im_func:
+            del state["is_default"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "is_default" not in state:
+            self.is_default = self.default_compare
+
     def __contains__(self, value):
         return value in self.index_map
 
@@ -124,3 +194,79 @@ class ValuePool(object):
         self.pool[index] = empty
         self.free.append(index)
         return index
+
+class pending(object):
+    def __repr__(self):
+        return "(pending)"
+
+pending = pending()
+
+class LazyValuePool(ValuePool):
+    """
+    A ValuePool of count values that are only decoded when used.
+
+    decode(i) returns the i-th stored value (not counting the
+    default). value_at decodes just the value asked for, while
+    everything that needs the index map or all of the values
+    materializes the whole pool first.
+    """
+    def __init__(self, parent, count, decode, default=None, is_default=None):
+        super(LazyValuePool, self).__init__(parent, default, is_default)
+        self.pool = [pending] * count
+        self.decode = decode
+        self.materialized = False
+
+    def value_at(self, index):
+        value = super(LazyValuePool, self).value_at(index)
+        if value is pending:
+            if self.default is not None:
+                index -= 1
+            value = self.pool[index] = self.decode(index)
+        return value
+
+    def materialize(self):
+        """
+        Decode every value and build the index map.
+        """
+        if self.materialized:
+            return
+        offset = int(self.default is not None)
+        for index, value in enumerate(self.pool):
+            if value is pending:
+                value = self.pool[index] = self.decode(index)
+            self.index_map.setdefault(value, index + offset)
+        self.materialized = True
+        self.decode = None
+
+    def __getstate__(self):
+        # The decoder reads from the stream the pool was parsed from.
+        self.materialize()
+        return super(LazyValuePool, self).__getstate__()
+
+    def __contains__(self, value):
+        self.materialize()
+        return super(LazyValuePool, self).__contains__(value)
+
+    def __iter__(self):
+        self.materialize()
+        return super(LazyValuePool, self).__iter__()
+
+    def __str__(self):
+        self.materialize()
+        return super(LazyValuePool, self).__str__()
+
+    def get_index(self, value):
+        self.materialize()
+        return super(LazyValuePool, self).get_index(value)
+
+    def add_value(self, value):
+        self.materialize()
+        return super(LazyValuePool, self).add_value(value)
+
+    def index_for(self, value):
+        self.materialize()
+        return super(LazyValuePool, self).index_for(value)
+
+    def kill(self, value):
+        self.materialize()
+        return super(LazyValuePool, self).kill(value)
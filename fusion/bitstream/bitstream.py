@@ -1,11 +1,29 @@
 
 from array import array
+import binascii
+import mmap
 import os
+import struct
+import sys
 import zlib
 
 ALIGN_LEFT = "left"
 ALIGN_RIGHT = "right"
 
+# The window read_ub extracts bit fields from.
+WORD = struct.Struct(">Q")
+
+NATIVE_ORDER = "<" if sys.byteorder == "little" else ">"
+
+# struct format characters -> the array typecode of the same size.
+ARRAY_TYPECODES = {"f": "f", "d": "d"}
+for _code in "bBhHiIlLqQ":
+    for _typecode in ("bhil" if _code.islower() else "BHIL"):
+        if array(_typecode).itemsize == struct.calcsize("=" + _code):
+            ARRAY_TYPECODES[_code] = _typecode
+            break
+del _code, _typecode
+
 from fusion.bitstream import formats as F, flash_formats as FF
 from fusion.bitstream.interfaces import IBitStream, IFormat, IFormatData
 
@@ -109,6 +127,132 @@ class BitStreamMixin(object):
     def read_all(self):
         pass
 
+    def substream(self, length=None):
+        """
+        Read the next length bits, or the rest of the stream,
+        into a new BitStream.
+        """
+        if length is None:
+            length = self.bits_available
+        inst = ByteArrayBitStream()
+        inst.write_bits(self.read_bits(length))
+        inst.seek(0)
+        return inst
+
+    def drop_before(self, position):
+        """
+        Tell the stream that the data before the bit position
+        will not be read again. Streams that keep all of their
+        data ignore this.
+        """
+        pass
+
+    def read_ub(self, length):
+        """
+        Read an unsigned integer of length bits.
+        """
+        n = 0
+        for bit in self.read_bits(length):
+            n = n << 1 | bit
+        return n
+
+    def read_sb(self, length):
+        """
+        Read a two's complement signed integer of length bits.
+        """
+        if length == 0:
+            return 0
+        n = self.read_ub(length)
+        if n >> (length - 1):
+            n -= 1 << length
+        return n
+
+    def write_ub(self, value, length):
+        """
+        Write value as an unsigned integer of length bits.
+        """
+        self.write_bits(value & (1 << b) for b in reversed(xrange(length)))
+
+    def write_sb(self, value, length):
+        """
+        Write value as a two's complement signed integer of length bits.
+        """
+        self.write_ub(value & ((1 << length) - 1), length)
+
+    def unpack(self, struct):
+        """
+        Read struct.size bytes and unpack them with the
+        struct.Struct struct.
+        """
+        size = struct.size
+        return struct.unpack(unhexlify_ub(self.read_ub(size*8), size))
+
+    def read_string(self, length):
+        """
+        Read length bytes as a string.
+        """
+        if not length:
+            return ""
+        return unhexlify_ub(self.read_ub(length*8), length)
+
+    def read_cstring(self):
+        """
+        Read bytes up to the next NUL and return them as a
+        string, consuming the NUL.
+        """
+        chars = []
+        byte = self.read_byte()
+        while byte:
+            chars.append(chr(byte))
+            byte = self.read_byte()
+        return "".join(chars)
+
+    def read_u30(self):
+        """
+        Read an EncodedU32 (also used for ABC's u30),
+        seven bits per byte, least significant group first.
+        """
+        n = 0
+        for i in xrange(5):
+            byte = self.read_byte()
+            n |= (byte & 0x7F) << 7*i
+            if not (byte & 0x80):
+                return n
+        raise ValueError("Invalid U32")
+
+    def read_u30_run(self, count):
+        """
+        Read count EncodedU32s into a list.
+        """
+        return [self.read_u30() for i in xrange(count)]
+
+    def read_array(self, format, count):
+        """
+        Read count elements of format into an array.array, decoding
+        them all at once if format is a fixed-width machine type, or
+        into a list one element at a time otherwise.
+        """
+        format = IFormat(format)
+        st = getattr(format, "_array_struct", None)
+        st = st and st()
+        typecode = st and ARRAY_TYPECODES.get(st.format[-1])
+        if typecode is None:
+            return [self.read(format) for i in xrange(count)]
+        result = array(typecode)
+        if count:
+            bytes = self.unpack(struct.Struct("%ds" % (st.size*count,)))[0]
+            result.fromstring(bytes)
+            if st.format[0] != NATIVE_ORDER:
+                result.byteswap()
+        return result
+
+    def pack(self, struct, *values):
+        """
+        Pack values with the struct.Struct struct and write them.
+        """
+        data = struct.pack(*values)
+        self.write_ub(int(binascii.hexlify(data), 16), len(data)*8)
+
     def decompress(self):
         """
         Decompress and replace the contents of
@@ -139,6 +283,18 @@ class BitStreamMixin(object):
         copy.seek(0)
         return copy.read(F.ByteString[numbytes])
 
+    def getvalue(self):
+        """
+        Return the serialized stream as a memoryview.
+        """
+        return memoryview(self.serialize())
+
+    def tobytes(self):
+        """
+        Return the serialized stream as a string.
+        """
+        return self.serialize()
+
     def real_len(self):
         return len(self)
 
@@ -241,6 +397,8 @@ class BoolArrayBitStream(BitStreamMixin):
         self.write_bits(self.BYTE_TO_BITS[byte], raw=True)
 
     def write_bytes(self, bytes):
+        if isinstance(bytes, (str, buffer, memoryview)):
+            bytes = bytearray(bytes)
         bits = array('c')
         for i, B in enumerate(bytes):
             self.bytes[self.cursor+i*8] = B
@@ -283,23 +441,28 @@ class ByteArrayBitStream(BitStreamMixin):
           File "<stdin>", line 1, in <module>
         TypeError: 'int' object is not iterable
         """
-        self.bytes = array('B', [0])
+        self.bytes = bytearray(1)
         self.byte, self.bit = 0, 7
         self.len = 0
-        for bit in bits:
-            if bit == " ": continue
-            self.write_bit(bit or bit == "1")
+        if isinstance(bits, str):
+            bits = (bit == "1" for bit in bits if bit != " ")
+        self.write_bits(bits)
 
     def read(self, part):
-        return IFormat(part)._read(self, self.tell())
+        if not isinstance(part, F.Format):
+            part = IFormat(part)
+        return part._read(self, self.tell())
 
     def write(self, argument, part=None):
         if part is None:
             part = argument
-        IFormat(part)._write(self, self.tell(), argument)
+        if not isinstance(part, F.Format):
+            part = IFormat(part)
+        part._write(self, self.tell(), argument)
 
     def modify(self, modifier, *args, **kwargs):
-        data, cursor = modifier(self, self.tell(), *args, **kwargs)
+        cursor = self.byte*8 + 7-self.bit
+        data, cursor = modifier(self, cursor, *args, **kwargs)
         self.byte, bit = divmod(cursor, 8)
         self.bit = 7-bit
         return data
@@ -326,21 +489,116 @@ class ByteArrayBitStream(BitStreamMixin):
                 self.bytes.append(0)
         else:
             self.bit -= 1
-        L = self.tell()
+        L = self.byte*8 + 7-self.bit
         if L > self.len: self.len = L
 
     def read_bits(self, length):
         return tuple(self.read_bit() for _ in xrange(length))
 
     def write_bits(self, bits):
+        # Pack the bits into an integer and write them all at once.
+        n = length = 0
         for b in bits:
-            self.write_bit(b)
+            n = n << 1 | bool(b)
+            length += 1
+        self.write_ub(n, length)
 
     def read_byte(self):
         if self.bit == 7:
             self.byte += 1
             return self.bytes[self.byte-1]
-        return self.BITS_TO_BYTE[self.read_bits(8)]
+        return self.read_ub(8)
+
+    def read_ub(self, length):
+        cursor = self.byte*8 + 7-self.bit
+        if cursor + length > self.len:
+            raise IndexError("BitStream read beyond boundaries")
+        value = extract_ub(self.bytes, len(self.bytes), cursor, length)
+        self.byte, bit = divmod(cursor + length, 8)
+        self.bit = 7-bit
+        return value
+
+    def unpack(self, struct):
+        if self.bit != 7:
+            return BitStreamMixin.unpack(self, struct)
+        size = struct.size
+        if (self.byte + size)*8 > self.len:
+            raise IndexError("BitStream read beyond boundaries")
+        value = struct.unpack_from(self.bytes, self.byte)
+        self.byte += size
+        return value
+
+    def read_string(self, length):
+        if self.bit != 7:
+            return BitStreamMixin.read_string(self, length)
+        if (self.byte + length)*8 > self.len:
+            raise IndexError("BitStream read beyond boundaries")
+        value = buffer(self.bytes, self.byte, length)[:]
+        self.byte += length
+        return value
+
+    def read_cstring(self):
+        if self.bit != 7:
+            return BitStreamMixin.read_cstring(self)
+        end = self.bytes.find("\0", self.byte, self.len >> 3)
+        if end < 0:
+            raise IndexError("BitStream read beyond boundaries")
+        value = buffer(self.bytes, self.byte, end - self.byte)[:]
+        self.byte = end + 1
+        return value
+
+    def read_u30(self):
+        if self.bit != 7:
+            return BitStreamMixin.read_u30(self)
+        n, self.byte = decode_u30(self.bytes, self.byte, self.len >> 3)
+        return n
+
+    def read_u30_run(self, count):
+        if self.bit != 7:
+            return BitStreamMixin.read_u30_run(self, count)
+        values, self.byte = decode_u30_run(self.bytes, self.byte,
+                                           self.len >> 3, count)
+        return values
+
+    def pack(self, struct, *values):
+        if self.bit != 7:
+            return BitStreamMixin.pack(self, struct, *values)
+        end = self.byte + struct.size
+        bytes = self.bytes
+        if len(bytes) <= end:
+            bytes.extend(bytearray(end + 1 - len(bytes)))
+        struct.pack_into(bytes, self.byte, *values)
+        self.byte = end
+        if end*8 > self.len:
+            self.len = end*8
+
+    def write_ub(self, value, length):
+        if length == 0:
+            return
+        end = self.byte*8 + 7-self.bit + length
+        index, shift = self.byte, 7-self.bit
+        last = (end + 7) >> 3
+        bytes = self.bytes
+        # Keep a spare byte past the end for the next write to land in.
+        if len(bytes) <= end >> 3:
+            bytes.extend(bytearray((end >> 3) + 1 - len(bytes)))
+
+        # Merge the bits already in the first and last
+        # bytes with the new ones, then store whole bytes.
+        tail = -end & 7
+        word = bytes[index] >> (8-shift)
+        word = word << length | (value & ((1 << length) - 1))
+        word = word << tail | (bytes[last-1] & ((1 << tail) - 1))
+        nbytes = last - index
+        if nbytes == 1:
+            bytes[index] = word
+        else:
+            bytes[index:last] = unhexlify_ub(word, nbytes)
+
+        self.byte, bit = divmod(end, 8)
+        self.bit = 7-bit
+        if end > self.len:
+            self.len = end
 
     def write_byte(self, byte):
         if byte < 0: byte += 256
@@ -351,20 +609,77 @@ class ByteArrayBitStream(BitStreamMixin):
                 self.len += 8
                 self.bytes.append(0)
         else:
-            self.write_bits(self.BYTE_TO_BITS[byte])
+            self.write_ub(byte, 8)
 
     def write_bytes(self, bytes):
-        bytes = list(bytes)
+        if not isinstance(bytes, (str, bytearray, buffer, memoryview)):
+            bytes = bytearray(B & 0xFF for B in bytes)
         Len = len(bytes)
         if self.bit == 7:
-            self.bytes[self.byte:self.byte+Len] = array('B', bytes)
+            self.bytes[self.byte:self.byte+Len] = bytes
             self.byte += Len
             if self.byte*8 > self.len:
                 self.len = self.byte*8
                 self.bytes.append(0)
+        elif Len:
+            self.write_ub(int(binascii.hexlify(bytes), 16), Len*8)
+
+    def substream(self, length=None):
+        cursor = self.byte*8 + 7-self.bit
+        if length is None:
+            length = self.len - cursor
+        end = cursor + length
+        if end > self.len:
+            raise IndexError("BitStream read beyond boundaries")
+        inst = ByteArrayBitStream()
+        if cursor & 7:
+            for i in xrange(0, length, 56):
+                n = min(56, length - i)
+                inst.write_ub(self.read_ub(n), n)
+            inst.seek(0)
+            return inst
+
+        # Copy the whole bytes in one go.
+        bytes = self.bytes[cursor >> 3:(end + 7) >> 3]
+        if length & 7:
+            bytes[-1] &= 0xFF00 >> (length & 7)
         else:
-            for byte in bytes:
-                self.write_byte(byte)
+            bytes.append(0)
+        inst.bytes, inst.len = bytes, length
+        self.byte, bit = divmod(end, 8)
+        self.bit = 7-bit
+        return inst
+
+    def serialize(self, align=ALIGN_LEFT):
+        numbytes, leftover = divmod(self.len, 8)
+        data = buffer(self.bytes, 0, numbytes)[:]
+        if not leftover:
+            return data
+        last = self.bytes[numbytes] & (0xFF00 >> leftover)
+        if align == ALIGN_RIGHT:
+            # Shift everything right in one go to fill the last byte.
+            n = int(binascii.hexlify(data + chr(last)), 16) >> (8-leftover)
+            return unhexlify_ub(n, numbytes + 1)
+        return data + chr(last & 0xFF)
+
+    def getvalue(self):
+        """
+        Return a memoryview of the bytes backing this stream, padded
+        with zeros to a byte boundary, without copying them.
+
+        The stream cannot grow while the view is alive.
+        """
+        numbytes = (self.len + 7) // 8
+        if self.len & 7:
+            self.bytes[numbytes-1] &= 0xFF00 >> (self.len & 7)
+        return memoryview(self.bytes)[:numbytes]
+
+    def tobytes(self):
+        """
+        Return the bytes backing this stream as a string,
+        padded with zeros to a byte boundary.
+        """
+        return self.serialize()
 
     def tell(self):
         return self.byte*8 + 7-self.bit
@@ -374,14 +689,288 @@ class ByteArrayBitStream(BitStreamMixin):
 
     def __iter__(self):
         bytes = self.bytes
-        if self.len & 7 == 0:
-            bytes = bytes[:-1] # chop off the last 0
-        for B in bytes:
-            for i in reversed(xrange(8)):
-                yield bool(B & 1 << i)
+        for i in xrange(self.len):
+            yield bool(bytes[i >> 3] & 0x80 >> (i & 7))
 
 BitStream = ByteArrayBitStream
 
+def extract_ub(data, size, cursor, length):
+    """
+    Extract the unsigned, most significant bit first integer that is
+    length bits long and starts at bit cursor of the buffer data,
+    which is size bytes long. The caller checks the bounds.
+
+    The field is shifted out of a single 64-bit big-endian word when it
+    fits into one, and assembled byte by byte otherwise.
+    """
+    if length == 0:
+        return 0
+    index, shift = cursor >> 3, cursor & 7
+    end = shift + length
+    if end <= 64 and index + 8 <= size:
+        word = WORD.unpack_from(data, index)[0]
+        return int((word >> (64 - end)) & ((1 << length) - 1))
+    word = 0
+    for i in xrange(index, index + ((end + 7) >> 3)):
+        B = data[i]
+        if not isinstance(B, int):
+            B = ord(B)
+        word = word << 8 | B
+    return (word >> (-end & 7)) & ((1 << length) - 1)
+
+def decode_u30(data, index, end):
+    """
+    Decode the EncodedU32 at byte index of data, reading no further
+    than byte end. data may index to ints, like bytearray, or to
+    characters, like str and mmap. Returns the value and the index
+    after it.
+    """
+    n = 0
+    for shift in (0, 7, 14, 21, 28):
+        if index >= end:
+            raise IndexError("BitStream read beyond boundaries")
+        byte = data[index]
+        if not isinstance(byte, int):
+            byte = ord(byte)
+        index += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, index
+    raise ValueError("Invalid U32")
+
+def decode_u30_run(data, index, end, count):
+    """
+    Decode count EncodedU32s with decode_u30. Returns the
+    values and the index after the last one.
+    """
+    values = []
+    append = values.append
+    for i in xrange(count):
+        n, index = decode_u30(data, index, end)
+        append(n)
+    return values, index
+
+def unhexlify_ub(value, size):
+    """
+    Return the unsigned integer value as a big-endian string of size bytes.
+    """
+    return binascii.unhexlify("%0*x" % (size*2, value))
+
+class BufferBitStream(BitStreamMixin):
+    """
+    A read-only BitStream that wraps anything supporting the buffer
+    protocol (str, bytearray, mmap, memoryview) with a bit cursor.
+
+    The underlying buffer is never copied, which makes this the
+    stream of choice for parsing. A stream can also be limited to
+    the bits between start and end of the buffer, which is how
+    substream hands out views of a payload without copying it.
+    """
+    implements(IBitStream)
+
+    byte_aligned = False
+
+    def __init__(self, data="", start=0, end=None):
+        self.data = data
+        # bytearrays index to ints, everything else indexes to chars.
+        self.int_items = isinstance(data, bytearray)
+        self.size = len(data)
+        if end is None:
+            end = self.size * 8
+        if not 0 <= start <= end <= self.size * 8:
+            raise ValueError("BufferBitStream bounds out of range")
+        self.start, self.end = start, end
+        self.cursor = start
+
+    def read(self, part):
+        # Formats provide IFormat themselves, skip the lookup.
+        if not isinstance(part, F.Format):
+            part = IFormat(part)
+        return part._read(self, self.cursor - self.start)
+
+    def write(self, argument, part=None):
+        raise IOError("BufferBitStream is read-only")
+
+    def modify(self, modifier, *args, **kwargs):
+        start = self.start
+        data, cursor = modifier(self, self.cursor - start, *args, **kwargs)
+        self.cursor = cursor + start
+        return data
+
+    def _byte_at(self, index):
+        if self.int_items:
+            return self.data[index]
+        return ord(self.data[index])
+
+    def _slice(self, start, end):
+        """
+        Return the bytes between start and end as a string.
+        """
+        if isinstance(self.data, memoryview):
+            return self.data[start:end].tobytes()
+        return buffer(self.data, start, end - start)[:]
+
+    def read_bit(self):
+        cursor = self.cursor
+        if cursor >= self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = cursor + 1
+        return bool(self._byte_at(cursor >> 3) & (0x80 >> (cursor & 7)))
+
+    def read_bits(self, length):
+        if self.cursor + length > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        return tuple(self.read_bit() for _ in xrange(length))
+
+    def read_byte(self):
+        cursor = self.cursor
+        if cursor + 8 > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = cursor + 8
+        index, shift = cursor >> 3, cursor & 7
+        if shift == 0:
+            if self.int_items:
+                return self.data[index]
+            return ord(self.data[index])
+        word = self._byte_at(index) << 8 | self._byte_at(index + 1)
+        return (word >> (8 - shift)) & 0xFF
+
+    def read_ub(self, length):
+        cursor = self.cursor
+        if cursor + length > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = cursor + length
+        return extract_ub(self.data, self.size, cursor, length)
+
+    def unpack(self, struct):
+        cursor = self.cursor
+        if cursor & 7:
+            return BitStreamMixin.unpack(self, struct)
+        end = cursor + struct.size*8
+        if end > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = end
+        return struct.unpack_from(self.data, cursor >> 3)
+
+    def _find(self, char, start, end):
+        """
+        Return the index of the first char between start and
+        end of the buffer, or -1.
+        """
+        find = getattr(self.data, "find", None)
+        if find is not None:
+            return find(char, start, end)
+        while start < end:
+            chunk = self._slice(start, min(start + 0x400, end))
+            index = chunk.find(char)
+            if index >= 0:
+                return start + index
+            start += len(chunk)
+        return -1
+
+    def read_string(self, length):
+        cursor = self.cursor
+        if cursor & 7:
+            return BitStreamMixin.read_string(self, length)
+        end = cursor + length*8
+        if end > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = end
+        return self._slice(cursor >> 3, end >> 3)
+
+    def read_cstring(self):
+        cursor = self.cursor
+        if cursor & 7:
+            return BitStreamMixin.read_cstring(self)
+        start = cursor >> 3
+        end = self._find("\0", start, self.end >> 3)
+        if end < 0:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = (end + 1) * 8
+        return self._slice(start, end)
+
+    def read_u30(self):
+        cursor = self.cursor
+        if cursor & 7:
+            return BitStreamMixin.read_u30(self)
+        n, after = decode_u30(self.data, cursor >> 3, self.end >> 3)
+        self.cursor = after * 8
+        return n
+
+    def read_u30_run(self, count):
+        cursor = self.cursor
+        if cursor & 7:
+            return BitStreamMixin.read_u30_run(self, count)
+        values, after = decode_u30_run(self.data, cursor >> 3,
+                                       self.end >> 3, count)
+        self.cursor = after * 8
+        return values
+
+    def pack(self, struct, *values):
+        raise IOError("BufferBitStream is read-only")
+
+    def substream(self, length=None):
+        cursor = self.cursor
+        end = self.end if length is None else cursor + length
+        if end > self.end:
+            raise IndexError("BitStream read beyond boundaries")
+        self.cursor = end
+        return BufferBitStream(self.data, cursor, end)
+
+    def write_bit(self, bit):
+        raise IOError("BufferBitStream is read-only")
+
+    def write_bits(self, bits):
+        raise IOError("BufferBitStream is read-only")
+
+    def write_byte(self, byte):
+        raise IOError("BufferBitStream is read-only")
+
+    def write_bytes(self, bytes):
+        raise IOError("BufferBitStream is read-only")
+
+    def serialize(self, align=ALIGN_LEFT):
+        start, end = self.start, self.end
+        if not (start | end) & 7:
+            return self._slice(start >> 3, end >> 3)
+        length = end - start
+        if not length:
+            return ""
+        n = extract_ub(self.data, self.size, start, length)
+        numbytes, leftover = divmod(length, 8)
+        if leftover:
+            numbytes += 1
+            if align != ALIGN_RIGHT:
+                n <<= 8 - leftover
+        return unhexlify_ub(n, numbytes)
+
+    def getvalue(self):
+        """
+        Return a view of the underlying buffer without copying it.
+        """
+        start, end = self.start, self.end
+        if (start | end) & 7:
+            return memoryview(self.serialize())
+        start, end = start >> 3, end >> 3
+        try:
+            return memoryview(self.data)[start:end]
+        except TypeError:
+            # mmaps do not support the new buffer protocol.
+            return buffer(self.data, start, end - start)
+
+    def tobytes(self):
+        return self.serialize()
+
+    def tell(self):
+        return self.cursor - self.start
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        for i in xrange(self.start, self.end):
+            yield bool(self._byte_at(i >> 3) & 0x80 >> (i & 7))
+
 def list_to_bitstream(bits):
     bits = list(bits)
     if all(bit in (0, 1, True, False) for bit in bits):
@@ -404,10 +993,7 @@ class BitStreamFormatAdaptor(object):
 
     # bs.read(BitStream)
     def _read(self, bs, cursor):
-        inst = self.bitstream()
-        inst.write(BitStreamDataFormat(type(self), bs.bits_available))
-        inst.seek(0)
-        return inst
+        return BitStreamDataFormat(self.bitstream, bs.bits_available)._read(bs, cursor)
 
     # bs.write(bs2, BitStream)
     # bs.write(bs2)
@@ -436,8 +1022,16 @@ class BitStreamDataFormat(object):
 
     # bs.read(BitStream[8])
     def _read(self, bs, cursor):
-        inst = self.cls()
         length = self.length
+        if self.endianness != "<" and isinstance(bs, self.cls):
+            # Share the buffer of read-only streams, and make a
+            # single copy out of other streams of the requested type.
+            # Anything else gets a fresh, writable stream below.
+            inst = bs.substream(length)
+            if isinstance(inst, self.cls):
+                return inst
+            bs = inst
+        inst = self.cls()
         if self.endianness and length & 7: # we don't support endianness
             raise ValueError("You must have a length of a multiple of 8"
                              " in order to read with endianness")
@@ -460,11 +1054,30 @@ class BitStreamDataFormat(object):
         if argument.byte_aligned:
             bs.flush()
 
+class BitStreamWindowError(IndexError): pass
+
 def LazyBitStream(cls):
     class LazyBitStream(cls):
-        def __init__(self, source):
+        """
+        A BitStream that pulls its data from source as it is read.
+
+        With forward_only, the stream only keeps what lies past the
+        position last given to drop_before, so memory use stays bounded
+        no matter how much of the source has been read. Positions stay
+        relative to the start of the source, and seeking back before
+        the window raises BitStreamWindowError. Only streams that keep
+        their data in bytes, like ByteArrayBitStream, can drop it.
+        """
+        origin = 0
+        byte_buffered = issubclass(cls, ByteArrayBitStream)
+
+        def __init__(self, source, forward_only=False):
+            if forward_only and not self.byte_buffered:
+                raise TypeError("%s cannot drop data, so it cannot be "
+                                "forward_only" % cls.__name__)
             super(LazyBitStream, self).__init__()
             self.source = source
+            self.forward_only = forward_only
             self.source.fill_stream(self, 0)
             self.install_lazy()
 
@@ -472,12 +1085,14 @@ def LazyBitStream(cls):
             self.read_bit  = self.__read_bit
             self.read_bits = self.__read_bits
             self.read_byte = self.__read_byte
+            self.read_ub   = self.__read_ub
             self.real_len  = self.__real_len
 
         def uninstall_lazy(self):
             self.read_bit  = super(LazyBitStream, self).read_bit
             self.read_bits = super(LazyBitStream, self).read_bits
             self.read_byte = super(LazyBitStream, self).read_byte
+            self.read_ub   = super(LazyBitStream, self).read_ub
             self.real_len  = super(LazyBitStream, self).real_len
 
         def read_all(self):
@@ -499,23 +1114,180 @@ def LazyBitStream(cls):
                 self.source.fill_stream(self, 8)
             return super(LazyBitStream, self).read_byte()
 
+        def __read_ub(self, length):
+            if self.bits_ready < length:
+                self.source.fill_stream(self, length)
+            return super(LazyBitStream, self).read_ub(length)
+
         def __real_len(self):
             return len(self.source)
+
+        def unpack(self, struct):
+            if self.bits_ready < struct.size*8:
+                self.source.fill_stream(self, struct.size*8)
+            return super(LazyBitStream, self).unpack(struct)
+
+        def read_string(self, length):
+            if self.bits_ready < length*8:
+                self.source.fill_stream(self, length*8)
+            return super(LazyBitStream, self).read_string(length)
+
+        def read_cstring(self):
+            # Fill until the buffered bytes hold a NUL. Other streams
+            # read a byte at a time, which fills them as it goes.
+            while self.byte_buffered and self.bits_ready < self.bits_available and \
+                  self.bytes.find("\0", self.byte, self.len >> 3) < 0:
+                self.source.fill_stream(self, self.bits_ready + 8)
+            return super(LazyBitStream, self).read_cstring()
+
+        def read_u30(self):
+            if self.bits_ready < 40:
+                self.source.fill_stream(self, min(40, self.bits_available))
+            return super(LazyBitStream, self).read_u30()
+
+        def read_u30_run(self, count):
+            length = min(40*count, self.bits_available)
+            if self.bits_ready < length:
+                self.source.fill_stream(self, length)
+            return super(LazyBitStream, self).read_u30_run(count)
+
+        def substream(self, length=None):
+            if length is None:
+                length = self.bits_available
+            if self.bits_ready < length:
+                self.source.fill_stream(self, length)
+            return super(LazyBitStream, self).substream(length)
+
+        def drop_before(self, position):
+            """
+            Discard the data before the bit position, which can no
+            longer be read afterwards. Only whole bytes before the
+            cursor are dropped, and only on forward_only streams.
+            """
+            if not self.forward_only:
+                return
+            cursor = super(LazyBitStream, self).tell()
+            drop = min(position - self.origin*8, cursor) // 8
+            if drop <= 0:
+                return
+            del self.bytes[:drop]
+            self.byte -= drop
+            self.len -= drop*8
+            self.origin += drop
+
+        def modify(self, modifier, *args, **kwargs):
+            origin = self.origin*8
+            if not origin:
+                return super(LazyBitStream, self).modify(modifier, *args, **kwargs)
+            def inner(stream, cursor, *args, **kwargs):
+                data, cursor = modifier(stream, cursor + origin, *args, **kwargs)
+                if cursor < origin:
+                    raise BitStreamWindowError("cannot seek to bit %d, data before "
+                                               "bit %d has been dropped" % (cursor, origin))
+                return data, cursor - origin
+            return super(LazyBitStream, self).modify(inner, *args, **kwargs)
+
+        def tell(self):
+            return super(LazyBitStream, self).tell() + self.origin*8
+
+        def __len__(self):
+            return super(LazyBitStream, self).__len__() + self.origin*8
     return LazyBitStream
 
+def missing_bits(stream, cursor, length):
+    """
+    The number of bits a lazy source has to append to stream for
+    length bits past cursor to be ready. The cursor may lie past the
+    data filled in so far, after seeking over a large tag.
+    """
+    return max(cursor + length - len(stream), 0)
+
+def is_seekable(file):
+    """
+    Whether file can tell and seek. Files without a seekable method
+    are asked for their position instead.
+    """
+    seekable = getattr(file, "seekable", None)
+    if seekable is not None:
+        return seekable()
+    try:
+        file.tell()
+    except (IOError, OSError):
+        return False
+    return True
+
 class LazyBitStreamFileSource(object):
-    def __init__(self, file, len, sizehint=10):
+    """
+    Reads ahead from file as a LazyBitStream asks for more data.
+
+    The read-ahead starts at readahead bytes and doubles on every fill
+    while the file is read sequentially, up to max_readahead. It starts
+    over at readahead when the stream was seeked past the data filled
+    in so far, and when the file has been moved under us, in which case
+    we seek back first. Data is read into a reusable buffer and
+    appended to the stream in one go.
+
+    stats counts the fills ("hits" for sequential ones, "misses" after
+    a seek), the reads issued to the file and the bytes they returned.
+
+    len is the number of bytes to read from the current position of
+    file. Files that cannot seek, like pipes or zip members, are read
+    sequentially from there; they cannot be read_at.
+    """
+    def __init__(self, file, len, readahead=0x10000, max_readahead=0x400000):
         self.file, self.len = file, len
-        self.sizehint = sizehint
+        self.min_readahead = self.readahead = readahead
+        self.max_readahead = max_readahead
+        self.seekable = is_seekable(file)
+        self.start = self.position = file.tell() if self.seekable else 0
+        self.end = self.start + len
+        self.buffer = bytearray()
+        self.stats = dict(hits=0, misses=0, reads=0, bytes=0)
+
+    def read_at(self, offset, length):
+        """
+        Read length bytes at the byte offset of the stream straight
+        from the file, without filling the stream up to them.
+        """
+        if not self.seekable:
+            raise IOError("cannot read_at in a file that cannot seek")
+        self.file.seek(self.start + offset)
+        return self.file.read(length)
 
     def fill_stream(self, stream, length):
         cursor = stream.tell()
-        length = length // 8 + self.sizehint
+        skipped = cursor > len(stream)
+        length = missing_bits(stream, cursor, length)
+        moved = self.seekable and self.file.tell() != self.position
+        if moved:
+            self.file.seek(self.position)
+        if moved or skipped:
+            self.readahead = self.min_readahead
+            self.stats["misses"] += 1
+        else:
+            self.stats["hits"] += 1
+
+        size = min(max(length // 8 + 1, self.readahead), self.end - self.position)
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view, got = memoryview(self.buffer), 0
+        while got < size:
+            if hasattr(self.file, "readinto"):
+                n = self.file.readinto(view[got:size])
+            else:
+                data = self.file.read(size - got)
+                n = len(data)
+                self.buffer[got:got+n] = data
+            self.stats["reads"] += 1
+            if not n:
+                break
+            got += n
+        self.stats["bytes"] += got
+        self.position += got
+        self.readahead = min(self.readahead * 2, self.max_readahead)
+
         stream.seek(0, os.SEEK_END)
-        while True:
-            data = self.file.read(length)
-            stream.write_bytes(ord(B) for B in data)
-            if len(data) in (0, length): break
+        stream.write_bytes(view[:got])
         stream.seek(cursor)
 
     def __len__(self):
@@ -529,42 +1301,156 @@ class LazyBitStreamByteStringSource(object):
 
     def fill_stream(self, stream, length):
         cursor = stream.tell()
-        length = length // 8 + self.sizehint
+        length = missing_bits(stream, cursor, length) // 8 + self.sizehint
         stream.seek(0, os.SEEK_END)
-        for byte in self.string[self.cursor:self.cursor+length]:
-            stream.write_byte(ord(byte))
+        stream.write_bytes(self.string[self.cursor:self.cursor+length])
+        self.cursor += length
         stream.seek(cursor)
 
     def __len__(self):
         return len(self.string)*8
 
+class LazyBitStreamZlibSource(object):
+    """
+    Inflates zlib compressed data read from another BitStream as the
+    LazyBitStream it fills asks for it, instead of decompressing
+    everything up front.
+
+    prefix is handed out before any inflated data (for example the
+    uncompressed header of a CWS file), and len is the total number of
+    bytes the prefix and inflated data are expected to make up.
+    """
+    def __init__(self, bitstream, len, prefix="", sizehint=0x4000,
+                 chunksize=0x4000):
+        self.bitstream = bitstream
+        self.len = len
+        self.prefix = prefix
+        self.sizehint = sizehint
+        self.chunksize = chunksize
+        self.decompressor = zlib.decompressobj()
+        self.produced = 0
+        self.done = False
+
+    def read_compressed(self, length):
+        bs = self.bitstream
+        length = min(length, bs.bits_available // 8)
+        if isinstance(bs, BufferBitStream) and not bs.cursor & 7:
+            index = bs.cursor >> 3
+            bs.cursor += length * 8
+            return bs._slice(index, index + length)
+        data = bs.read(F.ByteString[length])
+        bs.drop_before(bs.tell())
+        return data
+
+    def inflate(self, length):
+        """
+        Return at most length more bytes of data.
+        """
+        chunks, got = [], 0
+        if self.prefix:
+            chunks.append(self.prefix)
+            got, self.prefix = len(self.prefix), ""
+        D = self.decompressor
+        while got < length and not self.done:
+            data = D.unconsumed_tail or self.read_compressed(self.chunksize)
+            if data:
+                data = D.decompress(data, length - got)
+                if D.unused_data:
+                    self.done = True
+            else:
+                data = D.flush()
+                self.done = True
+            chunks.append(data)
+            got += len(data)
+        self.produced += got
+        if self.done:
+            # Trust the data over the declared length.
+            self.len = self.produced
+        return "".join(chunks)
+
+    def fill_stream(self, stream, length):
+        cursor = stream.tell()
+        length = missing_bits(stream, cursor, length) // 8 + self.sizehint
+        length = min(length, self.len - self.produced)
+        stream.seek(0, os.SEEK_END)
+        stream.write_bytes(self.inflate(length))
+        stream.seek(cursor)
+
+    def __len__(self):
+        return self.len*8
+
 class BitStreamParseMixin(object):
+    """
+    Provides the from_bytestring/from_file/from_filename constructors on
+    top of from_bitstream.
+
+    Unless a BitStream class or the lazy keyword is passed, the data is
+    parsed in place through a read-only BufferBitStream. from_filename
+    can also map the file into memory and parse straight off the mapping.
+
+    Passing forward_only reads lazily through a LazyBitStream that drops
+    the data before whatever position from_bitstream hands to its
+    drop_before method.
+    """
     @classmethod
     def from_bitstream(cls, bitstream):
         raise NotImplementedError
 
     @classmethod
     def from_bytestring(cls, bytes, *a, **kw):
-        BS = kw.pop('BitStream', BitStream)
-        if kw.pop('lazy', True):
-            bits = LazyBitStream(BS)(LazyBitStreamByteStringSource(bytes))
+        BS, lazy = kw.pop('BitStream', None), kw.pop('lazy', None)
+        forward_only = kw.pop('forward_only', False)
+        if forward_only:
+            lazy = True
+        if BS is None and lazy is None:
+            bits = BufferBitStream(bytes)
+        elif lazy or lazy is None:
+            bits = LazyBitStream(BS or BitStream)(LazyBitStreamByteStringSource(bytes),
+                                                  forward_only)
         else:
-            bits = BS()
+            bits = (BS or BitStream)()
             bits.write(bytes, F.ByteString)
             bits.seek(0)
         return cls.from_bitstream(bits, *a, **kw)
 
     @classmethod
     def from_file(cls, file, len, *a, **kw):
-        BS = kw.pop('BitStream', BitStream)
-        if kw.pop('lazy', True):
-            bits = LazyBitStream(BS)(LazyBitStreamFileSource(file, len))
+        BS, lazy = kw.pop('BitStream', None), kw.pop('lazy', None)
+        forward_only = kw.pop('forward_only', False)
+        if forward_only:
+            lazy = True
+        if BS is None and lazy is None:
+            return cls.from_bytestring(file.read(len), *a, **kw)
+        elif lazy or lazy is None:
+            bits = LazyBitStream(BS or BitStream)(LazyBitStreamFileSource(file, len),
+                                                  forward_only)
             return cls.from_bitstream(bits, *a, **kw)
         else:
-            return cls.from_bytestring(file.read(), lazy=False, *a, **kw)
+            return cls.from_bytestring(file.read(len), BitStream=BS or BitStream,
+                                       lazy=False, *a, **kw)
 
     @classmethod
     def from_filename(cls, filename, *a, **kw):
+        if kw.pop('mmap', False):
+            if 'BitStream' in kw or 'lazy' in kw or 'forward_only' in kw:
+                raise ValueError("mmap cannot be combined with the"
+                                 " BitStream, lazy or forward_only arguments")
+            return cls.from_bitstream(BufferBitStream(map_file(filename)),
+                                      *a, **kw)
         return cls.from_file(open(filename, 'rb'),
                              os.path.getsize(filename),
                              *a, **kw)
+
+def map_file(filename):
+    """
+    Map the file at filename read-only into memory.
+
+    The mapping outlives the file object, and its pages are
+    shared with any other process mapping the same file.
+    """
+    with open(filename, 'rb') as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped.
+            return ""
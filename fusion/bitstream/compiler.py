@@ -0,0 +1,790 @@
+"""
+Compile the field programs of Struct classes into plain functions.
+
+`Struct.from_bitstream` and `Struct.as_bitstream` interpret the
+`create_fields` generator twice for every instance, adapting every
+statement it yields and evaluating its formats and filters through
+`IStructEvaluateable`. Most structs yield the same statements every
+time though; only the branches around them depend on the data.
+
+`compile_struct` reads the source of `create_fields` once per class,
+builds every statement it yields up front, and generates a reader and
+a writer in which both passes are straight-line code: the NBits
+bookkeeping lives in local variables, formats that depend on NBits
+turn into direct calls on the bitstream and simple filters like ``* 20``
+are inlined. The `if` statements of `create_fields` are kept as they
+are, so data-dependent layouts like `Matrix` still work.
+
+Classes that can't be compiled (statements built from ``self``, yields
+inside loops, overridden `get_local`/`set_local`, ...) keep using the
+interpreter; `codec_for` returns None for them and records why in
+`interpreted`. Not finding the source of `create_fields` (installs
+without .py files) is logged as a warning, every other reason at the
+debug level.
+"""
+
+import ast
+import copy
+import inspect
+import keyword
+import logging
+import re
+import textwrap
+
+from types import NoneType
+
+from fusion.bitstream.formats import UB, SB, FB, Format, FormatMetaAdaptor
+from fusion.bitstream.formats import PLAIN_TYPES
+from fusion.bitstream.interfaces import IStructStatement, IStructEvaluateable, IFormat
+from fusion.util import nbits
+
+try:
+    from numbers import Integral
+except ImportError:
+    Integral = (int, long)
+
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# Values Struct.set_local stores as they are.
+LOCAL_TYPES = frozenset([int, long, bool, str, NoneType])
+
+# Comparisons FieldTemp turns into atoms.
+ATOM_COMPARISONS = {ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<",
+                    ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+
+log = logging.getLogger(__name__)
+
+class CompileError(Exception):
+    """
+    The create_fields of a Struct can't be compiled.
+    """
+
+class SourceUnavailable(CompileError):
+    """
+    The source of create_fields can't be found.
+    """
+
+def read_ub(bs, length):
+    """
+    Read big-endian UB[length], like UB._read.
+    """
+    if length == 0:
+        return 0
+    elif length == 1:
+        return bs.read_bit()
+    return bs.read_ub(length)
+
+def write_ub(bs, value, length):
+    """
+    Write value as big-endian UB[length], like UB._write.
+    """
+    value = int(value)
+    nb = nbits(value)
+    if length == 0:
+        return
+    elif length < nb:
+        raise ValueError(("length of %d is not large "
+                          "enough to store %d") % (length, value))
+    bs.write_ub(value, length)
+
+def evaluate_local(struct, value):
+    """
+    Evaluate value the way Struct.set_local does.
+    """
+    if type(value) in LOCAL_TYPES:
+        return value
+    return IStructEvaluateable(value)._evaluate(struct)
+
+class StructCodec(object):
+    """
+    The generated reader and writer of a Struct class.
+
+    ``read(instance, bitstream)`` fills in a new instance and
+    ``write(instance, bitstream)`` serializes one, both with the
+    same results as interpreting create_fields. may_flush tells
+    whether writing can flush the stream, through nested structs
+    or statements the compiler doesn't know.
+    """
+    def __init__(self, read, write, may_flush=True):
+        self.read = read
+        self.write = write
+        self.may_flush = may_flush
+
+_codecs = {}
+
+# The reason each class codec_for returned None for has to be
+# interpreted.
+interpreted = {}
+
+def codec_for(cls):
+    """
+    Return the StructCodec of cls, compiling it the first
+    time, or None if cls has to be interpreted.
+    """
+    try:
+        return _codecs[cls]
+    except KeyError:
+        pass
+    try:
+        codec = compile_struct(cls)
+    except CompileError, e:
+        codec = None
+        interpreted[cls] = str(e)
+        level = logging.WARNING if isinstance(e, SourceUnavailable) else logging.DEBUG
+        log.log(level, "interpreting %s.%s: %s", cls.__module__, cls.__name__, e)
+    _codecs[cls] = codec
+    return codec
+
+class Site(object):
+    """
+    One yield statement of create_fields, and the code each pass
+    runs in its place.
+
+    Every method returns the source of the statements for one pass;
+    `const` hands objects to the generated code.
+    """
+    may_flush = True
+
+    def __init__(self, compiler, statement):
+        self.compiler = compiler
+        self.statement = statement
+        self.self_name = compiler.self_name
+
+    def const(self, value):
+        return self.compiler.const(value)
+
+    def pre_read(self):
+        return "%s._pre_read(%s)" % (self.const(self.statement), self.self_name)
+
+    def read(self):
+        return "%s._struct_read(%s, __bs)" % (self.const(self.statement), self.self_name)
+
+    def pre_write(self):
+        return "%s._pre_write(%s)" % (self.const(self.statement), self.self_name)
+
+    def write(self):
+        return "%s._struct_write(%s, __bs)" % (self.const(self.statement), self.self_name)
+
+class FormatSite(Site):
+    """
+    A bare format, like ``yield One``.
+    """
+    def __init__(self, compiler, statement):
+        super(FormatSite, self).__init__(compiler, statement)
+        self.format = self.const(statement.format)
+        self.may_flush = not isinstance(statement.format, Format)
+
+    def pre_read(self):
+        return ""
+
+    def read(self):
+        return "__bs.read(%s)" % (self.format,)
+
+    def pre_write(self):
+        return ""
+
+    def write(self):
+        return "__bs.write(%s)" % (self.format,)
+
+class NBitsSite(Site):
+    """
+    ``yield NBits[length]``, keeping the locals the interpreter keeps
+    and the current length in __nb.
+    """
+    may_flush = False
+
+    def __init__(self, compiler, statement):
+        super(NBitsSite, self).__init__(compiler, statement)
+        self.index = compiler.nbits_sites
+        compiler.nbits_sites += 1
+        self.format = self.const(UB[statement.length])
+
+    def prequel(self):
+        i = self.index
+        return ("__c%d = __L.get('NBitsCount', 0) + 1\n"
+                "__L['NBitsCount'] = __c%d\n"
+                "__n%d, __o%d = __NAMES[__c%d]\n"
+                "__L[__o%d] = %r\n") % (i, i, i, i, i, i, self.statement.offset)
+
+    def pre_read(self):
+        return self.prequel()
+
+    def pre_write(self):
+        i = self.index
+        return self.prequel() + "__nbn, __nbo = __n%d, %r\n" % (i, self.statement.offset)
+
+    def read(self):
+        i, length = self.index, self.statement.length
+        if length == 0:
+            value = "0"
+        elif length == 1:
+            value = "__bs.read_bit()"
+        else:
+            value = "__bs.read_ub(%d)" % (length,)
+        return ("__L['NBitsCount'] = __c%d\n"
+                "__v = %s\n"
+                "__L[__NAMES[__c%d][0]] = __v\n"
+                "__nb = __v - (%r)\n") % (i, value, i, self.statement.offset)
+
+    def write(self):
+        i = self.index
+        return ("__L['NBitsCount'] = __c%d\n"
+                "__v = __L[__NAMES[__c%d][0]]\n"
+                "__bs.write(__v, %s)\n"
+                "__nb = __v - (%r)\n") % (i, i, self.format, self.statement.offset)
+
+class FieldSite(Site):
+    """
+    Field, Local, Fields and Locals whose format is either fixed
+    or one of UB, SB and FB with an NBits length.
+    """
+    def __init__(self, compiler, statement, names, array, format, kind):
+        super(FieldSite, self).__init__(compiler, statement)
+        self.names = names
+        self.array = array
+        self.kind = kind
+        self.element = format
+        self.format = self.const(format)
+        self.may_flush = isinstance(format, type) \
+                     and issubclass(format, compiler.structs.Struct)
+        self.array_format = self.const(IFormat(statement.format))
+
+    def filters(self, filters, value):
+        code = []
+        for filter in filters:
+            operator = getattr(filter, "operator", None)
+            if operator and type(filter.operand) in (int, long):
+                call = "%s.%s(%r)" % (value, operator, filter.operand)
+            else:
+                call = "%s(%s, %s)" % (self.const(filter), self.self_name, value)
+            code.append(call)
+        return code
+
+    def target(self, name):
+        """
+        The expression the value of name is stored in.
+        """
+        if isinstance(self.statement, self.compiler.structs.Local) \
+                or self.array and self.statement.var_name == "TEMP_FIELDS":
+            return "__L[%r]" % (name,)
+        if self.array:
+            return "__D[%r]" % (name,)
+        if IDENTIFIER.match(name) and not keyword.iskeyword(name):
+            return "%s.%s" % (self.self_name, name)
+        return None
+
+    def get(self):
+        """
+        Code leaving the (unfiltered) value to write in __w.
+        """
+        if self.array:
+            targets = ", ".join(self.target(name) for name in self.names)
+            return "__w = [%s]\n" % (targets,)
+        target = self.target(self.names[0])
+        if target is None:
+            return "__w = getattr(%s, %r)\n" % (self.self_name, self.names[0])
+        return "__w = %s\n" % (target,)
+
+    def set(self, name, value):
+        target = self.target(name)
+        if target is None:
+            return "setattr(%s, %r, %s)\n" % (self.self_name, name, value)
+        if target.startswith("__L") and not self.array and value != "True":
+            value = "__evaluate_local(%s, %s)" % (self.self_name, value)
+        return "%s = %s\n" % (target, value)
+
+    def dict_prologue(self):
+        if self.array and self.statement.var_name == "__dict__":
+            return "__D = %s.__dict__\n" % (self.self_name,)
+        return ""
+
+    def element_read(self):
+        if self.kind == "static":
+            return "__bs.read(%s)" % (self.format,)
+        elif type(self.element) is UB:
+            return "__read_ub(__bs, __nb)"
+        elif type(self.element) is SB:
+            return "__bs.read_sb(__nb)"
+        return "__bs.read_sb(__nb) / 65536.0"
+
+    def element_write(self, value):
+        if self.kind == "static":
+            return "__bs.write(%s, %s)\n" % (value, self.format)
+        elif type(self.element) is UB:
+            return "__write_ub(__bs, %s, __nb)\n" % (value,)
+        elif type(self.element) is SB:
+            return "if __nb != 0: __bs.write_sb(int(%s), __nb)\n" % (value,)
+        return "if __nb != 0: __bs.write_sb(int(%s * 65536.0), __nb)\n" % (value,)
+
+    def pre_read(self):
+        if self.array or self.statement.default is not True:
+            # Arrays default to [], which sets nothing.
+            return "" if self.array else Site.pre_read(self)
+        return self.set(self.names[0], "True")
+
+    def read(self):
+        if not self.array:
+            code = ["__v = %s\n" % (self.element_read(),)]
+            code.extend("__v = %s\n" % (c,) for c in
+                        self.filters(self.statement.filter_read, "__v"))
+            code.append(self.set(self.names[0], "__v"))
+            return "".join(code)
+
+        values = ["__v%d" % (i,) for i in xrange(len(self.names))]
+        code = [self.dict_prologue()]
+        if self.kind == "static":
+            code.append("__a = __bs.read_array(%s, %d)\n"
+                        % (self.format, len(values)))
+            code.extend("%s = __a[%d]\n" % (v, i) for i, v in enumerate(values))
+        else:
+            read = self.element_read()
+            code.extend("%s = %s\n" % (v, read) for v in values)
+        for filter in self.statement.filter_read:
+            for v in values:
+                code.append("%s = %s\n" % (v, self.filters([filter], v)[0]))
+        for name, v in zip(self.names, values):
+            code.append(self.set(name, v))
+        return "".join(code)
+
+    def write_filters(self):
+        code = []
+        for filter in self.statement.filter_write:
+            if self.array:
+                code.append("__w = [%s for __x in __w]\n"
+                            % (self.filters([filter], "__x")[0],))
+            else:
+                code.append("__w = %s\n" % (self.filters([filter], "__w")[0],))
+        return "".join(code)
+
+    def pre_write(self):
+        if self.kind == "static":
+            return ""
+        code = [self.dict_prologue(), self.get(), self.write_filters()]
+        if not self.array:
+            code.append("if isinstance(__w, __Integral): __w = [__w]\n")
+        code.append("__x = max(%s._nbits(*__w) + __nbo, 0)\n"
+                    "if __x > __L.get(__nbn, -1): __L[__nbn] = __x\n"
+                    % (self.format,))
+        return "".join(code)
+
+    def write(self):
+        code = [self.dict_prologue(), self.get(), self.write_filters()]
+        if self.kind == "static":
+            format = self.array_format if self.array else self.format
+            code.append("__bs.write(__w, %s)\n" % (format,))
+        elif self.array:
+            code.extend(self.element_write("__w[%d]" % (i,))
+                        for i in xrange(len(self.names)))
+        else:
+            code.append(self.element_write("__w"))
+        return "".join(code)
+
+class StructCompiler(object):
+    """
+    Compiles the create_fields of one Struct class.
+    """
+    def __init__(self, cls):
+        from fusion.bitstream import structs
+        self.structs = structs
+        self.cls = cls
+        self.consts = []
+        self.const_names = {}
+        self.nbits_sites = 0
+
+    def const(self, value):
+        key = id(value)
+        if key not in self.const_names:
+            self.const_names[key] = "__k%d" % (len(self.consts),)
+            self.consts.append(value)
+        return self.const_names[key]
+
+    def parse_function(self):
+        structs = self.structs
+        if self.cls.get_local.im_func is not structs.Struct.get_local.im_func \
+                or self.cls.set_local.im_func is not structs.Struct.set_local.im_func:
+            raise CompileError("%s overrides the locals" % (self.cls.__name__,))
+
+        function = getattr(self.cls.create_fields, "im_func", None)
+        if function is None or function.func_closure:
+            raise CompileError("create_fields isn't a plain method")
+        if not function.func_code.co_flags & inspect.CO_GENERATOR:
+            raise CompileError("create_fields isn't a generator")
+        try:
+            source = textwrap.dedent(inspect.getsource(function))
+            self.filename = inspect.getsourcefile(function) or "<struct>"
+        except (IOError, TypeError):
+            raise SourceUnavailable("can't find the source of create_fields")
+
+        tree = ast.parse(source)
+        ast.increment_lineno(tree, function.func_code.co_firstlineno - 1)
+        definition = tree.body[0]
+        if not isinstance(definition, ast.FunctionDef):
+            raise CompileError("create_fields isn't a def")
+        args = definition.args
+        if len(args.args) != 1 or not isinstance(args.args[0], ast.Name) \
+                or args.vararg or args.kwarg or args.defaults:
+            raise CompileError("create_fields has an unexpected signature")
+
+        self.function = function
+        self.globals = function.func_globals
+        self.self_name = args.args[0].id
+        self.body = definition.body
+
+        assigned = set()
+        for node in ast.walk(ast.Module(body=self.body)):
+            if isinstance(node, ast.Name):
+                if node.id.startswith("__"):
+                    raise CompileError("create_fields uses %s" % (node.id,))
+                if not isinstance(node.ctx, ast.Load):
+                    assigned.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                assigned.add(node.name)
+            elif isinstance(node, ast.alias):
+                assigned.add((node.asname or node.name).split(".")[0])
+            elif isinstance(node, ast.Return):
+                raise CompileError("create_fields returns early")
+        if self.self_name in assigned:
+            raise CompileError("create_fields rebinds %s" % (self.self_name,))
+        self.local_names = assigned | set([self.self_name])
+
+    def depends_on_instance(self, node):
+        return any(isinstance(n, ast.Name) and n.id in self.local_names
+                   for n in ast.walk(node))
+
+    def evaluate(self, node):
+        code = compile(ast.Expression(body=node), self.filename, "eval")
+        try:
+            return eval(code, self.globals)
+        except Exception, e:
+            raise CompileError("can't build the statement on line %d: %s"
+                               % (node.lineno, e))
+
+    def make_site(self, node):
+        """
+        Build the statement yielded by node once, and pick the code
+        that replaces it.
+        """
+        if node.value is None or self.depends_on_instance(node.value):
+            raise CompileError("the statement on line %d depends on the "
+                               "instance" % (node.lineno,))
+        structs = self.structs
+        try:
+            statement = IStructStatement(self.evaluate(node.value))
+        except TypeError, e:
+            raise CompileError("can't adapt the statement on line %d: %s"
+                               % (node.lineno, e))
+        kind = type(statement)
+
+        if kind is structs.NBits:
+            if type(statement.length) not in (int, long):
+                raise CompileError("NBits on line %d has no fixed length"
+                                   % (node.lineno,))
+            return NBitsSite(self, statement)
+        elif isinstance(statement, structs.NBits):
+            raise CompileError("NBits subclasses can't be compiled")
+        elif kind is structs.FormatStructStatementAdapter:
+            if self.format_kind(statement.format) == "static":
+                return FormatSite(self, statement)
+            return Site(self, statement)
+
+        try:
+            format = IFormat(statement.format)
+        except (AttributeError, TypeError):
+            return Site(self, statement)
+        if kind in (structs.Field, structs.Local):
+            format_kind = self.format_kind(format)
+            if format_kind:
+                return FieldSite(self, statement, [statement.name], False,
+                                 format, format_kind)
+        elif kind in (structs.Fields, structs.Locals):
+            format = format.format
+            format_kind = self.format_kind(format)
+            if format_kind:
+                return FieldSite(self, statement, statement.fields, True,
+                                 format, format_kind)
+        return Site(self, statement)
+
+    def format_kind(self, format):
+        """
+        "static" for formats that evaluate to themselves, "nbits" for
+        UB, SB and FB whose length is NBits, None for anything else.
+        """
+        if isinstance(format, Format):
+            if type(format.length) in PLAIN_TYPES \
+                    and type(format.endianness) in PLAIN_TYPES:
+                return "static"
+            if type(format) in (UB, SB, FB) and format.endianness is None \
+                    and format.length is self.structs.NBits:
+                return "nbits"
+        elif isinstance(format, FormatMetaAdaptor):
+            return "static"
+        elif isinstance(format, type) and issubclass(format, self.structs.Struct):
+            return "static"
+        return None
+
+    def find_sites(self, body):
+        """
+        Map every yield statement in body to its Site. Yields may only
+        be statements of their own, nested in nothing but ifs.
+        """
+        for statement in body:
+            if isinstance(statement, ast.Expr) \
+                    and isinstance(statement.value, ast.Yield):
+                self.sites[statement] = self.make_site(statement.value)
+                continue
+            if isinstance(statement, ast.If):
+                self.check_no_yield(statement.test)
+                self.find_sites(statement.body)
+                self.find_sites(statement.orelse)
+                continue
+            self.check_no_yield(statement)
+
+    def check_no_yield(self, node):
+        for n in ast.walk(node):
+            if isinstance(n, ast.Yield):
+                raise CompileError("yield on line %d can't be compiled"
+                                   % (n.lineno,))
+
+    def parse(self, code, node):
+        statements = ast.parse(code).body
+        for statement in statements:
+            for n in ast.walk(statement):
+                if "lineno" in n._attributes:
+                    n.lineno = node.lineno
+                    n.col_offset = node.col_offset
+        return statements
+
+    def emit(self, body, mode):
+        """
+        Return a copy of body in which every yield is replaced by
+        what mode (a Site method name) runs for it.
+        """
+        emitted = []
+        for statement in body:
+            if statement in self.sites:
+                code = getattr(self.sites[statement], mode)()
+                emitted.extend(self.parse(code, statement))
+            elif isinstance(statement, ast.If):
+                new = copy.copy(statement)
+                new.test = self.rewrite(statement.test)
+                new.body = self.emit(statement.body, mode) \
+                        or [ast.copy_location(ast.Pass(), statement)]
+                new.orelse = self.emit(statement.orelse, mode)
+                emitted.append(ast.copy_location(new, statement))
+            else:
+                emitted.append(self.rewrite(statement))
+        return emitted
+
+    def rewrite(self, node):
+        return LocalsRewriter(self).visit(copy.deepcopy(node))
+
+    def atom(self, node):
+        """
+        The source of a plain expression computing the Atom built by
+        node, or None if node isn't a comparison of Fields and Locals
+        combined with & and |.
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in (ast.BitAnd, ast.BitOr):
+            left, right = self.atom(node.left), self.atom(node.right)
+            if left is None or right is None:
+                return None
+            joiner = "and" if isinstance(node.op, ast.BitAnd) else "or"
+            return "(%s %s %s)" % (left, joiner, right)
+
+        if not isinstance(node, ast.Compare) or len(node.ops) != 1 \
+                or type(node.ops[0]) not in ATOM_COMPARISONS:
+            return None
+        field, other = node.left, node.comparators[0]
+        if not (isinstance(field, ast.Call) and isinstance(field.func, ast.Name)
+                and field.func.id not in self.local_names
+                and not field.keywords and not field.starargs
+                and not field.kwargs and 1 <= len(field.args) <= 2
+                and isinstance(field.args[0], ast.Str)):
+            return None
+        kind = self.globals.get(field.func.id)
+        if kind is self.structs.Field and IDENTIFIER.match(field.args[0].s) \
+                and not keyword.iskeyword(field.args[0].s):
+            value = "%s.%s" % (self.self_name, field.args[0].s)
+        elif kind is self.structs.Local:
+            value = "__L[%r]" % (field.args[0].s,)
+        else:
+            return None
+
+        if isinstance(other, ast.Num) and type(other.n) in (int, long):
+            other = repr(other.n)
+        elif isinstance(other, ast.Str) and type(other.s) is str:
+            other = repr(other.s)
+        elif isinstance(other, ast.Name) and other.id == "None" \
+                and "None" not in self.local_names:
+            other = "None"
+        else:
+            return None
+        return "(%s %s %s)" % (value, ATOM_COMPARISONS[type(node.ops[0])], other)
+
+    def compile(self):
+        self.parse_function()
+        self.sites = {}
+        self.find_sites(self.body)
+        if not self.sites:
+            raise CompileError("create_fields yields nothing")
+
+        names = [(None, None)]
+        for count in xrange(1, self.nbits_sites + 1):
+            names.append(("NBits%d" % (count,), "NBits%dOffset" % (count,)))
+        helpers = [("__NAMES", tuple(names)), ("__Integral", Integral),
+                   ("__read_ub", read_ub), ("__write_ub", write_ub),
+                   ("__evaluate_local", evaluate_local)]
+
+        passes = {}
+        for mode in ("pre_read", "read", "pre_write", "write"):
+            passes[mode] = self.emit(self.body, mode)
+
+        # Emitting the passes registers the constants they use.
+        params = [self.const_names[id(v)] for v in self.consts]
+        params.extend(name for name, value in helpers)
+        args = self.consts + [value for name, value in helpers]
+
+        counts = "".join("__c%d, " % (i,) for i in xrange(self.nbits_sites))
+        template = ast.parse(FACTORY_TEMPLATE % dict(
+            self=self.self_name, consts=", ".join(params),
+            counts=counts or "__unused",
+            init=" = ".join(["__c%d" % (i,) for i in xrange(self.nbits_sites)]
+                            + ["None"]) if counts else "__unused = None"))
+
+        # Python 2 can't map code to lines that go backwards, so each
+        # pass gets a function of its own and the statements around it
+        # take the first or the last line of create_fields.
+        first = self.function.func_code.co_firstlineno
+        last = max(n.lineno for n in ast.walk(ast.Module(body=self.body))
+                   if "lineno" in n._attributes)
+        factory = template.body[0]
+        for function in factory.body[:-1]:
+            lineno, body = first, []
+            for statement in function.body:
+                if isinstance(statement, ast.Expr) \
+                        and isinstance(statement.value, ast.Name) \
+                        and statement.value.id in PASS_MARKERS:
+                    mode = PASS_MARKERS[statement.value.id]
+                    body.extend(passes[mode])
+                    lineno = last
+                    continue
+                for n in ast.walk(statement):
+                    if "lineno" in n._attributes:
+                        n.lineno, n.col_offset = lineno, 0
+                body.append(statement)
+            function.body = body
+        for n in ast.walk(template):
+            if "lineno" in n._attributes:
+                n.lineno = max(getattr(n, "lineno", first), first)
+        ast.fix_missing_locations(template)
+
+        namespace = {}
+        exec compile(template, self.filename, "exec") in self.globals, namespace
+        read, write = namespace["__factory"](*args)
+        may_flush = any(site.may_flush for site in self.sites.itervalues())
+        return StructCodec(read, write, may_flush)
+
+PASS_MARKERS = {
+    "__PRE_READ__":  "pre_read",
+    "__READ__":      "read",
+    "__PRE_WRITE__": "pre_write",
+    "__WRITE__":     "write",
+}
+
+FACTORY_TEMPLATE = """
+def __factory(%(consts)s):
+    def __pre_read(%(self)s, __L):
+        %(init)s
+        __PRE_READ__
+        return %(counts)s
+    def __read(%(self)s, __bs):
+        __L = %(self)s.TEMP_FIELDS = {}
+        %(counts)s = __pre_read(%(self)s, __L)
+        %(self)s.reading = True
+        __READ__
+        del %(self)s.TEMP_FIELDS
+        %(self)s.reading = False
+    def __pre_write(%(self)s, __L):
+        %(init)s
+        __PRE_WRITE__
+        return %(counts)s
+    def __write(%(self)s, __bs):
+        __L = %(self)s.TEMP_FIELDS = {}
+        %(counts)s = __pre_write(%(self)s, __L)
+        %(self)s.writing = True
+        __WRITE__
+        del %(self)s.TEMP_FIELDS
+        %(self)s.writing = False
+    return __read, __write
+"""
+
+class LocalsRewriter(ast.NodeTransformer):
+    """
+    Turn get_local and set_local calls on the struct into operations
+    on __L, and set_local of comparisons of Fields into plain Python.
+    """
+    def __init__(self, compiler):
+        self.compiler = compiler
+
+    def method(self, node, name):
+        return isinstance(node, ast.Call) \
+           and isinstance(node.func, ast.Attribute) \
+           and node.func.attr == name \
+           and isinstance(node.func.value, ast.Name) \
+           and node.func.value.id == self.compiler.self_name \
+           and not node.keywords and not node.starargs and not node.kwargs
+
+    def visit_Expr(self, node):
+        call = node.value
+        if not self.method(call, "set_local") or len(call.args) != 2:
+            return self.generic_visit(node)
+        name, value = call.args
+        atom = self.compiler.atom(value)
+        name = self.visit(name)
+        if atom is not None:
+            value = ast.parse(atom, mode="eval").body
+        else:
+            value = ast.Call(func=ast.Name(id="__evaluate_local", ctx=ast.Load()),
+                             args=[ast.Name(id=self.compiler.self_name,
+                                            ctx=ast.Load()),
+                                   self.visit(value)],
+                             keywords=[], starargs=None, kwargs=None)
+        target = ast.Subscript(value=ast.Name(id="__L", ctx=ast.Load()),
+                               slice=ast.Index(value=name), ctx=ast.Store())
+        assign = ast.Assign(targets=[target], value=value)
+        for n in ast.walk(assign):
+            if "lineno" in n._attributes:
+                ast.copy_location(n, node)
+        return assign
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if not self.method(node, "get_local") or not 1 <= len(node.args) <= 2:
+            return node
+        default = node.args[1] if len(node.args) == 2 else None
+        locals_ = ast.Name(id="__L", ctx=ast.Load())
+        if default is None or isinstance(default, ast.Name) \
+                and default.id == "None" \
+                and "None" not in self.compiler.local_names:
+            new = ast.Subscript(value=locals_, slice=ast.Index(value=node.args[0]),
+                                ctx=ast.Load())
+        elif isinstance(default, (ast.Num, ast.Str)) or \
+                isinstance(default, ast.Name) and default.id in ("True", "False") \
+                and default.id not in self.compiler.local_names:
+            new = ast.Call(func=ast.Attribute(value=locals_, attr="get",
+                                              ctx=ast.Load()),
+                           args=node.args, keywords=[], starargs=None,
+                           kwargs=None)
+        else:
+            return node
+        for n in ast.walk(new):
+            if "lineno" in n._attributes and not hasattr(n, "lineno"):
+                ast.copy_location(n, node)
+        return new
+
+def compile_struct(cls):
+    """
+    Compile the create_fields of cls into a StructCodec, raising
+    CompileError if it has to be interpreted.
+    """
+    return StructCompiler(cls).compile()
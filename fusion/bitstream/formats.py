@@ -1,6 +1,7 @@
 
 from itertools import izip, izip_longest
-from math import ceil, isnan
+from math import ceil, copysign, frexp, isinf, isnan, ldexp
+import struct
 
 from fusion.bitstream.interfaces import IFormat, IBitStream
 from fusion.bitstream.interfaces import IFormatData, IFormatLength
@@ -54,14 +55,26 @@ class FormatData(object):
 classImplements(int,  IFormatLength)
 classImplements(long, IFormatLength)
 
+# Lengths, endiannesses and reprs of these types
+# evaluate to themselves and can be hashed.
+PLAIN_TYPES = frozenset([int, long, str, NoneType])
+
 class FormatMeta(type):
     """
     The metaclass used to implement formats.
     """
     def __init__(self, name, bases, dct):
-        self._cache = {}
+        # The two generations of interned specializations,
+        # see Format.specialize.
+        self._cache, self._old_cache = {}, {}
 
     def __getitem__(self, item):
+        if type(item) in (int, long):
+            # Skip building the FormatData for interned lengths.
+            try:
+                return self._cache[item, None, None]
+            except KeyError:
+                pass
         return self.specialize(IFormatData(item))
 
     def __str__(self):
@@ -130,13 +143,34 @@ class Format(object):
 
     cached = False
 
+    # How many specializations of each format are interned at most.
+    CACHE_SIZE = 256
+
     @classmethod
     def specialize(cls, data):
-        ## D = cls._cache
-        ## if data in D:
-        ##     return D[data]
-        obj = cls(data)
-        ## D[data] = obj
+        """
+        Return the format specialized with data, sharing one instance
+        between all specializations with the same plain length,
+        endianness and repr.
+
+        Once CACHE_SIZE specializations are interned, the ones that
+        have not been asked for since the last time the cache filled
+        up are dropped, so formats like UTF8[n] cannot grow it forever.
+        """
+        key = (data.length, data.endianness, data.repr)
+        if not (type(key[0]) in PLAIN_TYPES and type(key[1]) in PLAIN_TYPES
+                and type(key[2]) in PLAIN_TYPES):
+            return cls(data)
+        try:
+            return cls._cache[key]
+        except KeyError:
+            pass
+        obj = cls._old_cache.pop(key, None)
+        if obj is None:
+            obj = cls(data)
+        if len(cls._cache) >= cls.CACHE_SIZE:
+            cls._old_cache, cls._cache = cls._cache, {}
+        cls._cache[key] = obj
         return obj
 
     def __init__(self, data=None):
@@ -160,12 +194,22 @@ class Format(object):
     def _write(self, bitstream, cursor, argument):
         raise NotImplementedError
 
+    def _array_struct(self):
+        """
+        The struct.Struct for one element of this format, if it
+        is a fixed-width machine type that can be read in bulk.
+        """
+        return None
+
     def _pre_write(self, struct, field):
         m = getattr(self.length, "_pre_write_inner", None)
         if m:
             m(struct, self, field)
 
     def _evaluate(self, struct):
+        if type(self.length) in PLAIN_TYPES and type(self.endianness) in PLAIN_TYPES:
+            # Nothing to evaluate.
+            return self
         return type(self).specialize(FormatData(
             IStructEvaluateable(self.length)._evaluate(struct),
             IStructEvaluateable(self.endianness)._evaluate(struct),
@@ -178,10 +222,9 @@ class FormatArray(object):
         self.repeat = repeat
 
     def _read(self, bs, cursor):
-        results = []
-        for i in xrange(self.repeat):
-            results.append(bs.read(self.format))
-        return results
+        values = bs.read_array(self.format, self.repeat)
+        # Machine types come back from read_array as an array.array.
+        return values if type(values) is list else values.tolist()
 
     def _write(self, bs, cursor, argument):
         if len(argument) != self.repeat:
@@ -225,7 +268,7 @@ class BoolFormat(Format):
     @no_endianness
     def _write(self, bs, cursor, argument):
         length = 1 if self.length is None else self.length
-        bs.write_bits([self.VALUE] * length)
+        bs.write_ub((1 << length) - 1 if self.VALUE else 0, length)
 
 class Zero(BoolFormat):
     VALUE = False
@@ -233,6 +276,28 @@ class Zero(BoolFormat):
 class One(BoolFormat):
     VALUE = True
 
+# (length, endianness, signed) -> (struct, min, max) for the
+# integer widths the struct module can read and write directly.
+INT_STRUCTS = {}
+for _length, _code in ((1, "b"), (2, "h"), (4, "i"), (8, "q")):
+    for _endianness in (None, "<", ">"):
+        _bits = _length*8
+        INT_STRUCTS[_length, _endianness, True] = (
+            struct.Struct((_endianness or ">") + _code),
+            -1 << (_bits-1), (1 << (_bits-1)) - 1)
+        INT_STRUCTS[_length, _endianness, False] = (
+            struct.Struct((_endianness or ">") + _code.upper()),
+            0, (1 << _bits) - 1)
+del _length, _code, _endianness, _bits
+
+# (length in bits, endianness) -> struct for the IEEE float widths;
+# FLOAT16s are read and written as their 16 bit pattern.
+FLOAT_STRUCTS = {}
+for _length, _code in ((16, "H"), (32, "f"), (64, "d")):
+    for _endianness in (None, "<", ">"):
+        FLOAT_STRUCTS[_length, _endianness] = struct.Struct((_endianness or ">") + _code)
+del _length, _code, _endianness
+
 class Byte(Format):
     """
     A byte/bytestring.
@@ -240,8 +305,19 @@ class Byte(Format):
     string = False
     list   = False
     signed = False
+    def _array_struct(self):
+        if self.string or self.list:
+            return None
+        st = INT_STRUCTS.get((self.length, self.endianness, self.signed))
+        return st and st[0]
+
     def _read(self, bs, cursor):
         length = self.length
+        if not (self.string or self.list):
+            st = INT_STRUCTS.get((length, self.endianness, self.signed))
+            if st is not None:
+                return bs.unpack(st[0])[0]
+
         if (length == None and not self.string) or length == 1:
             byte = bs.read_byte()
             if self.string:
@@ -260,10 +336,9 @@ class Byte(Format):
             length = bs.bits_available // 8
             bs.read_all()
 
-        if self.string:
-            bytes = ''.join(chr(bs.read_byte()) for _ in xrange(length))
-        else:
-            bytes = [bs.read_byte() for _ in xrange(length)]
+        bytes = bs.read_string(length)
+        if not self.string:
+            bytes = list(bytearray(bytes))
 
         if self.endianness == "<":
             bytes = bytes[::-1]
@@ -275,7 +350,7 @@ class Byte(Format):
             for i, b in izip(reversed(xrange(0, len(bytes)*8, 8)), bytes):
                 n |= b << i
             if self.signed:
-                if n > 2**(length*8-1):
+                if n >= 2**(length*8-1):
                     n -= 2**(length*8)
             return n
 
@@ -284,6 +359,9 @@ class Byte(Format):
             bytes = int(bytes)
 
         if isinstance(bytes, (int, long)):
+            st = INT_STRUCTS.get((self.length, self.endianness, self.signed))
+            if st is not None and st[1] <= bytes <= st[2]:
+                return bs.pack(st[0], bytes)
             if bytes in xrange(-128, 256) and self.length in (1, None):
                 return bs.write_byte(bytes)
             Len = int(ceil(nbits(bytes)/8.))
@@ -292,27 +370,25 @@ class Byte(Format):
                 leftover = (self.length - Len) * 8
                 if leftover > 0 and self.endianness != "<":
                     if self.signed and bytes < 0:
-                        bs.write(One[leftover])
+                        bs.write_ub((1 << leftover) - 1, leftover)
                     else:
-                        bs.write(Zero[leftover])
+                        bs.write_ub(0, leftover)
                 elif leftover < 0:
                     raise ValueError("%r does not fit in %d bytes"
                                      ""% (bytes, self.length))
             else:
                 leftover = 0
 
-            R = xrange(0, Len*8, 8)
             if self.endianness != "<":
-                R = reversed(R)
+                return bs.write_ub(bytes, Len*8)
 
-            for i in R:
+            for i in xrange(0, Len*8, 8):
                 bs.write_byte((bytes & (0xFF << i)) >> i)
 
-            if self.endianness == "<":
-                if self.signed and bytes < 0:
-                    bs.write(One[leftover])
-                else:
-                    bs.write(Zero[leftover])
+            if self.signed and bytes < 0:
+                bs.write_ub((1 << leftover) - 1, leftover)
+            else:
+                bs.write_ub(0, leftover)
 
         elif isinstance(bytes, str):
             length = self.length
@@ -327,9 +403,9 @@ class Byte(Format):
                 leftover, length = 0, len(bytes)*8
 
             if self.endianness == "<":
-                bytes = reversed(bytes)
+                bytes = bytes[::-1]
 
-            bs.write_bytes(ord(B) for B in bytes)
+            bs.write_bytes(bytes)
         else:
             raise TypeError("Invalid type for Byte/ByteString")
 
@@ -349,10 +425,7 @@ class CString(Format):
     @no_endianness
     @requires_length(can_be=(None,))
     def _read(self, bs, cursor):
-        bytes = [0xDEADBEEF]
-        while bytes[-1] != 0:
-            bytes.append(bs.read(Byte))
-        return ''.join(chr(i) for i in bytes[1:-1])
+        return bs.read_cstring()
 
     @requires_length(can_be=(None,))
     def _write(self, bs, cursor, argument):
@@ -365,7 +438,7 @@ class UTF8(Format):
     """
     @requires_length(cant_be=(None,))
     def _read(self, bs, cursor):
-        return bs.read(ByteString[self.length]).decode("utf8")
+        return bs.read_string(self.length).decode("utf8")
 
     @requires_length(cant_be=(None,))
     def _write(self, bs, cursor, argument):
@@ -381,7 +454,7 @@ class CUTF8(Format):
     """
     @requires_length(can_be=(None,))
     def _read(self, bs, cursor):
-        return bs.read(CString).decode("utf8")
+        return bs.read_cstring().decode("utf8")
 
     @requires_length(can_be=(None,))
     def _write(self, bs, cursor, argument):
@@ -421,12 +494,11 @@ class UB(Format):
             return 0
         elif length == 1:
             return bs.read_bit()
+        elif self.endianness != "<":
+            return bs.read_ub(length)
         elif length & 7 == 0:
             bytes, n = [bs.read_byte() for _ in xrange(length // 8)], 0
-            R = xrange(len(bytes))
-            if self.endianness != "<":
-                R = reversed(R)
-            for i, b in zip(R, bytes):
+            for i, b in enumerate(bytes):
                 n |= b << 8*i
             return n
 
@@ -445,12 +517,15 @@ class UB(Format):
         argument = int(argument)
         nb = nbits(argument)
         if length is None:
-            length = nbits(argument)
+            length = nb
         elif length == 0:
             return
         elif length < nb:
             raise ValueError(("length of %d is not large "
                               "enough to store %d") % (length, argument))
+
+        if self.endianness != "<":
+            return bs.write_ub(argument, length)
         elif length == 1:
             return bs.write_bit(argument)
         elif length & 7 == 0:
@@ -481,12 +556,14 @@ class SB(Format):
     """
     @requires_length(cant_be=(None,))
     def _read(self, bs, cursor):
+        if self.endianness != "<":
+            return bs.read_sb(self.length)
         if self.length == 0:
             return 0
         signed = bs.read_bit()
         n = bs.read(UB[self.length-1:self.endianness])
         if signed:
-            return n - 1 << self.length
+            return n - (1 << (self.length-1))
         return n
 
     def _write(self, bs, cursor, argument):
@@ -494,6 +571,12 @@ class SB(Format):
         if length == 0:
             return
 
+        if self.endianness != "<":
+            argument = int(argument)
+            if length is None:
+                length = nbits_signed(argument)
+            return bs.write_sb(argument, length)
+
         if argument > 0:
             if length is not None:
                 length -= 1
@@ -519,12 +602,16 @@ class FB(Format):
     """
     @requires_length(cant_be=(None,))
     def _read(self, bs, cursor):
-        return bs.read(SB[self.length]) / float(0x10000)
+        return bs.read_sb(self.length) / float(0x10000)
 
     def _write(self, bs, cursor, value):
         if self.length == 0:
             return 0
-        bs.write(int(value * float(0x10000)), SB[self.length])
+        value = int(value * float(0x10000))
+        length = self.length
+        if length is None:
+            length = nbits_signed(value)
+        bs.write_sb(value, length)
 
     def _nbits(self, *args):
         return nbits_fixed(*args)
@@ -543,14 +630,7 @@ class U32(Format):
     @requires_length(can_be=(None,))
     @no_endianness
     def _read(self, bs, cursor):
-        n = 0
-        for i in xrange(5):
-            byte = bs.read_byte()
-            n |= (byte & 0x7F) << 7*i
-            if not (byte & 0x80):
-                break
-        else:
-            raise ValueError("Invalid U32")
+        n = bs.read_u30()
         if self.signed and n > 0x7FFFFFFF:
             n -= 0x100000000
         return int(n) # no pesky 'L's
@@ -611,80 +691,79 @@ class FloatFormat(Format):
     _N_EXPN_BITS = {16: 5, 32: 8, 64: 11}
     _N_FRAC_BITS = {16: 10, 32: 23, 64: 52}
 
-    @requires_length(can_be=(16, 32, 64))
-    def _read(self, bs, cursor):
-        from fusion.bitstream.bitstream import BitStream
-        bits = bs.read(BitStream[self.length:self.endianness])
-        sign = bits.read(Bit)
-
-        expn_len = self._N_EXPN_BITS[self.length]
-        frac_len = self._N_FRAC_BITS[self.length]
-
-        expn = bits.read(UB[expn_len])
+    # FLOAT16 bit patterns -> floats, built on first use.
+    _FLOAT16_TABLE = None
 
-        frac = bits.read(UB[frac_len])
+    def _struct(self):
+        return FLOAT_STRUCTS[self.length, self.endianness]
 
-        bias = expn - self._EXPN_BIAS[self.length]
+    def _array_struct(self):
+        if self.length in (32, 64):
+            return self._struct()
+        return None
 
-        frac_total = float(1 << frac_len)
-        expn_total = float(1 << expn_len)
+    @classmethod
+    def _float16_table(cls):
+        table = cls._FLOAT16_TABLE
+        if table is None:
+            table = [0.0] * 0x10000
+            for bits in xrange(0x10000):
+                expn, frac = (bits >> 10) & 0x1F, bits & 0x3FF
+                if expn == 0x1F:
+                    value = float("nan") if frac else float("inf")
+                elif expn == 0:
+                    # Subnormal, no implicit leading 1.
+                    value = ldexp(frac, 1 - 16 - 10)
+                else:
+                    value = ldexp(frac | 0x400, expn - 16 - 10)
+                table[bits] = -value if bits & 0x8000 else value
+            cls._FLOAT16_TABLE = table
+        return table
 
-        if expn == 0:
-            if frac == 0:
-                return 0
-            else:
-                return ~frac + 1 if sign else frac
-        elif expn == expn_total - 1:
-            if frac == 0:
-                return float("-inf") if sign else float("inf")
-            else:
-                return float("nan")
+    @classmethod
+    def _float16_bits(cls, value):
+        """
+        Encode value as a FLOAT16, rounding to the nearest
+        representable value and to even on ties.
+        """
+        sign = 0x8000 if copysign(1.0, value) < 0 else 0
+        value = abs(value)
+        if isnan(value):
+            return 0x7E00
+        elif isinf(value):
+            return sign | 0x7C00
+        elif value == 0:
+            return sign
+        # Subnormals share the smallest normal exponent, without the
+        # implicit leading 1.
+        expn = max(frexp(value)[1] - 1, 1 - 16)
+        scaled = ldexp(value, 10 - expn)
+        n = int(scaled)
+        rest = scaled - n
+        if rest > 0.5 or (rest == 0.5 and n & 1):
+            n += 1
+        # n carries the implicit 1 at 0x400, so adding it to one below
+        # the biased exponent also carries a rounded-up fraction into it.
+        n += (expn + 16 - 1) << 10
+        if n >= 0x7C00:
+            raise ValueError("Exponent out of range in %s." % (cls.__name__,))
+        return sign | n
 
-        return (-1 if sign else 1) * 2**bias * (1 + frac / frac_total)
+    @requires_length(can_be=(16, 32, 64))
+    def _read(self, bs, cursor):
+        value = bs.unpack(FLOAT_STRUCTS[self.length, self.endianness])[0]
+        if self.length == 16:
+            return self._float16_table()[value]
+        return value
 
     @requires_length(can_be=(16, 32, 64))
     def _write(self, bs, cursor, value):
-        from fusion.bitstream.bitstream import BitStream
-        bits = BitStream()
-        if value in (0, 0.0): # value is zero
-            bits.write(Zero[self.length])
-        elif value == -0.0:
-            bits.write(One)
-            bits.write(Zero[self.length-1])
-        elif isnan(value):
-            bits.write(One [self.length])
-        elif value == float("-inf"): # negative infinity
-            bits.write(One [self._N_EXPN_BITS[self.length] + 1]) # sign merged
-            bits.write(Zero[self._N_FRAC_BITS[self.length]])
-        elif value == float("inf"): # positive infinity
-            bits.write(Zero)
-            bits.write(One [self._N_EXPN_BITS[self.length]])
-            bits.write(Zero[self._N_FRAC_BITS[self.length]])
-        else:
-            if value < 0:
-                bits.write(One)
-                value = ~value + 1
-            else:
-                bits.write(Zero)
-
-            exp = self._EXPN_BIAS[self.length]
-            if value < 1:
-                while int(value) != 1:
-                    value *= 2
-                    exp -= 1
-            else:
-                while int(value) != 1:
-                    value /= 2
-                    exp += 1
-
-            if exp < 0 or exp > (1 << self._N_EXPN_BITS[self.length]):
-                raise ValueError("Exponent out of range in %s." % (self,))
-
-            frac_total = 1 << self._N_FRAC_BITS[self.length]
-            bits.write(exp, UB[self._N_EXPN_BITS[self.length]])
-            bits.write(int((value-1)*frac_total) & (frac_total - 1),
-                     UB[self._N_FRAC_BITS[self.length]])
-        bs.write(bits, BitStream[self.endianness])
+        if self.length == 16:
+            value = self._float16_bits(value)
+        try:
+            bs.pack(FLOAT_STRUCTS[self.length, self.endianness], value)
+        except OverflowError:
+            raise ValueError("Exponent out of range in %s." % (self,))
 
 def bool_to_iformat(bit):
     if bit:
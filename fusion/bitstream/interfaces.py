@@ -55,11 +55,78 @@ class IBitStream(Interface):
         Read a byte.
         """
 
+    def read_ub(length):
+        """
+        Read an unsigned integer of length bits,
+        most significant bit first.
+        """
+
+    def read_sb(length):
+        """
+        Read a two's complement signed integer of length bits,
+        most significant bit first.
+        """
+
     def write_byte(byte):
         """
         Write a byte.
         """
 
+    def unpack(struct):
+        """
+        Read struct.size bytes and return them unpacked
+        with the struct.Struct struct.
+        """
+
+    def read_string(length):
+        """
+        Read length bytes as a string.
+        """
+
+    def read_cstring():
+        """
+        Read a NUL-terminated string, without the NUL.
+        """
+
+    def read_u30():
+        """
+        Read an EncodedU32.
+        """
+
+    def read_u30_run(count):
+        """
+        Read count EncodedU32s into a list.
+        """
+
+    def read_array(format, count):
+        """
+        Read count elements of format, as an array.array
+        where format allows it.
+        """
+
+    def pack(struct, *values):
+        """
+        Write values packed with the struct.Struct struct.
+        """
+
+    def substream(length=None):
+        """
+        Read the next length bits, or the rest of the stream if
+        length is None, as a BitStream of their own.
+        """
+
+    def write_ub(value, length):
+        """
+        Write value as an unsigned integer of length bits,
+        most significant bit first.
+        """
+
+    def write_sb(value, length):
+        """
+        Write value as a two's complement signed integer of
+        length bits, most significant bit first.
+        """
+
     def __len__():
         """
         Return how many bits are in this stream.
@@ -134,6 +201,14 @@ class IAutoStruct(IStruct):
         """
         This should be a generator that yields IStructStatements that make
         up this struct.
+
+        Statements that don't depend on the instance let
+        fusion.bitstream.compiler generate the reader and writer.
+        """
+
+    def write_into(bitstream):
+        """
+        Write this struct into bitstream at its cursor.
         """
 
     def set_local(name, value):
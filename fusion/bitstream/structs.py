@@ -5,6 +5,7 @@ import operator
 from types import NoneType
 
 from fusion.bitstream.bitstream import BitStream, BitStreamParseMixin
+from fusion.bitstream.compiler import codec_for
 from fusion.bitstream.formats import UB, FormatArray, FormatMeta
 
 from fusion.bitstream.interfaces import IBitStream, IFormat, IFormatLength
@@ -127,6 +128,9 @@ def simple_op_filter(name, read=None):
         def op_filter_write(struct, value):
             return getattr(value, name_write) \
                    (IStructEvaluateable(other)._evaluate(struct))
+        # Let the compiler inline the operation.
+        op_filter_read.operator,  op_filter_read.operand  = name_read,  other
+        op_filter_write.operator, op_filter_write.operand = name_write, other
         self.filter_read .append(op_filter_read)
         self.filter_write.append(op_filter_write)
         return self
@@ -440,11 +444,48 @@ class Struct(StructMixin):
         assert isinstance(argument, cls)
         if getattr(cls.create_fields, "byte_aligned", None):
             bs.flush()
-        bs += argument.as_bitstream()
+        argument.write_into(bs)
 
     def as_bitstream(self):
         bitstream = BitStream()
         bitstream.byte_aligned = getattr(self.create_fields, "byte_aligned", False)
+        codec = codec_for(type(self))
+        if codec is None:
+            self._interpret_write(bitstream)
+        else:
+            codec.write(self, bitstream)
+        bitstream.seek(0)
+        return bitstream
+
+    def write_into(self, bitstream):
+        """
+        Write this struct straight into bitstream at its cursor, like
+        ``bitstream += self.as_bitstream()`` but without building and
+        copying a stream of its own.
+
+        Nested structs flush relative to the stream they are written
+        to, so structs that contain them are only written through when
+        bitstream is byte aligned and at its end.
+        """
+        cls = type(self)
+        codec = codec_for(cls)
+        if cls.as_bitstream.im_func is not Struct.as_bitstream.im_func or \
+               (codec is None or codec.may_flush) and \
+               (bitstream.tell() & 7 or bitstream.bits_available):
+            bitstream += self.as_bitstream()
+            return
+        if codec is None:
+            self._interpret_write(bitstream)
+        else:
+            codec.write(self, bitstream)
+        if getattr(self.create_fields, "byte_aligned", False):
+            bitstream.flush()
+
+    def _interpret_write(self, bitstream):
+        """
+        Write the fields by running create_fields, for
+        classes the compiler can't handle.
+        """
         self.TEMP_FIELDS = {}
         statements = {}
         for statement in self.create_fields():
@@ -457,26 +498,35 @@ class Struct(StructMixin):
             statement._struct_write(self, bitstream)
         del self.TEMP_FIELDS
         self.writing = False
-        bitstream.seek(0)
-        return bitstream
 
     @classmethod
     def from_bitstream(cls, bitstream):
         instance = cls.__new__(cls)
         Struct.__init__(instance)
-        instance.TEMP_FIELDS = {}
+        codec = codec_for(cls)
+        if codec is None:
+            instance._interpret_read(bitstream)
+        else:
+            codec.read(instance, bitstream)
+        return instance
+
+    def _interpret_read(self, bitstream):
+        """
+        Read the fields by running create_fields, for
+        classes the compiler can't handle.
+        """
+        self.TEMP_FIELDS = {}
         statements = {}
-        for statement in instance.create_fields():
+        for statement in self.create_fields():
             statement = IStructStatement(statement)
-            statement._pre_read(instance)
+            statement._pre_read(self)
             statements[statement] = statement
-        instance.reading = True
-        for statement in instance.create_fields():
+        self.reading = True
+        for statement in self.create_fields():
             statement = IStructStatement(statements.get(statement, statement))
-            statement._struct_read(instance, bitstream)
-        del instance.TEMP_FIELDS
-        instance.reading = False
-        return instance
+            statement._struct_read(self, bitstream)
+        del self.TEMP_FIELDS
+        self.reading = False
 
     @classmethod
     def _evaluate(cls, struct):
@@ -492,6 +542,10 @@ class IStructFormatAdapter(object):
         return self.struct.from_bitstream(bs)
 
     def _write(self, bs, cursor, argument):
-        bs += self.struct.as_bitstream()
+        write_into = getattr(self.struct, "write_into", None)
+        if write_into is None:
+            bs += self.struct.as_bitstream()
+        else:
+            write_into(bs)
 
 provideAdapter(IStructFormatAdapter)
@@ -1,9 +1,12 @@
 
 import py.test
 import os
+import zlib
 
-from fusion.bitstream.bitstream import BitStream
-from fusion.bitstream.formats import One, ByteString
+from fusion.bitstream.bitstream import BitStream, BufferBitStream, BitStreamParseMixin, \
+     BoolArrayBitStream, LazyBitStream, LazyBitStreamFileSource, LazyBitStreamZlibSource, \
+     LazyBitStreamByteStringSource, BitStreamWindowError, ALIGN_RIGHT
+from fusion.bitstream.formats import One, ByteString, Bit, Byte
 
 def test_constructor():
     bits = BitStream("10")
@@ -169,3 +172,317 @@ def test_skip_flush():
     bits.skip_flush()
     assert bits.tell() == 16
     assert bits.bits_available == 3
+
+def test_write_ub():
+    bits = BitStream()
+    bits.write_ub(0b101, 3)
+    bits.write_ub(0x1FFFF, 17)
+    bits.write_sb(-2, 5)
+    assert len(bits) == 25
+    assert str(bits) == "101" + "1" * 17 + "11110"
+
+    bits.seek(0)
+    assert bits.read_ub(3) == 0b101
+    assert bits.read_ub(17) == 0x1FFFF
+    assert bits.read_sb(5) == -2
+
+    # Overwriting in the middle keeps the bits around it.
+    bits.seek(5)
+    bits.write_ub(0, 10)
+    assert len(bits) == 25
+    assert str(bits) == "10111" + "0" * 10 + "11111" + "11110"
+
+def test_write_bytes_unaligned():
+    bits = BitStream()
+    bits.write_bit(1)
+    bits.write_bytes("\xAB\xCD")
+    bits.write_bytes([0x12, -1])
+    assert len(bits) == 33
+    bits.seek(1)
+    assert bits.read(ByteString[4]) == "\xAB\xCD\x12\xFF"
+
+def test_serialize():
+    bits = BitStream()
+    bits.write("FW", ByteString)
+    assert bits.serialize() == "FW"
+    bits.write_ub(0b101, 3)
+    assert bits.serialize() == "FW\xA0"
+    assert bits.serialize(ALIGN_RIGHT) == "\x02\x32\xBD"
+
+    # Bits past the end of the stream are not serialized.
+    bits.seek(16)
+    bits.write_ub(0xFF, 8)
+    bits.seek(16)
+    bits.write_ub(0, 3)
+    bits.len = 19
+    assert bits.serialize() == "FW\x00"
+
+def test_getvalue():
+    bits = BitStream()
+    bits.write("SWF", ByteString)
+    value = bits.getvalue()
+    assert isinstance(value, memoryview)
+    assert value.tobytes() == bits.tobytes() == "SWF"
+    del value
+
+    bits.write_bit(1)
+    assert bits.getvalue().tobytes() == "SWF\x80"
+    assert BufferBitStream(bytearray("SWF")).getvalue().tobytes() == "SWF"
+
+def test_BufferBitStream_read():
+    for data in ("\xAA\x0F\xF0", bytearray("\xAA\x0F\xF0"), memoryview("\xAA\x0F\xF0")):
+        bits = BufferBitStream(data)
+        assert len(bits) == 24
+        assert bits.read_bit() == True
+        assert bits.read_bits(3) == (False, True, False)
+        assert bits.read_byte() == 0xA0
+        assert bits.bits_available == 12
+        assert bits.read(ByteString[1]) == "\xFF"
+        assert str(bits) == "101010100000111111110000"
+        py.test.raises(IndexError, bits.read_byte)
+
+    bits = BufferBitStream("FWS")
+    assert bits.read(ByteString[3]) == "FWS"
+    assert bits.serialize() == "FWS"
+
+def test_BufferBitStream_read_only():
+    bits = BufferBitStream("FWS")
+    py.test.raises(IOError, bits.write_bit, True)
+    py.test.raises(IOError, bits.write, "SWF", ByteString)
+
+class RawBits(BitStreamParseMixin):
+    @classmethod
+    def from_bitstream(cls, bitstream):
+        return bitstream
+
+def test_substream():
+    data = bytearray("\x00ABCDEFGH\xFF")
+    bits = BufferBitStream(data)
+    bits.seek(8)
+    view = bits.substream(64)
+    assert bits.tell() == 72
+    assert len(view) == 64 and view.tell() == 0
+    assert view.read(ByteString[2]) == "AB"
+
+    inner = view.read(BufferBitStream[16])
+    assert isinstance(inner, BufferBitStream) and inner.data is data
+    assert inner.read(ByteString) == "CD"
+    py.test.raises(IndexError, inner.read_bit)
+    inner.seek(0)
+    assert inner.serialize() == "CD"
+
+    # Asking for another type of stream gets a writable copy.
+    copy = view.read(BitStream[16])
+    assert isinstance(copy, BitStream) and copy.serialize() == "EF"
+    copy.seek(0, os.SEEK_END)
+    copy.write("G", ByteString)
+    assert copy.serialize() == "EFG"
+
+    view.seek(4)
+    unaligned = view.substream(12)
+    assert unaligned.serialize() == "\x14\x20"
+    assert unaligned.serialize(ALIGN_RIGHT) == "\x01\x42"
+    py.test.raises(IndexError, view.substream, 64)
+
+    bits = BitStream()
+    bits.write(str(data), ByteString)
+    bits.seek(8)
+    copy = bits.read(BitStream[20])
+    assert isinstance(copy, BitStream) and len(copy) == 20
+    assert copy.serialize() == "AB\x40"
+    assert bits.tell() == 28
+    assert bits.substream(12).serialize() == "\x34\x40"
+
+def test_from_filename_mmap(tmpdir):
+    filename = tmpdir.join("test.abc")
+    filename.write("\x10\x00\x2E\x00", mode='wb')
+    bits = RawBits.from_filename(str(filename), mmap=True)
+    assert isinstance(bits, BufferBitStream)
+    assert bits.read(ByteString[4]) == "\x10\x00\x2E\x00"
+
+    empty = tmpdir.join("empty.abc")
+    empty.write("", mode='wb')
+    assert len(RawBits.from_filename(str(empty), mmap=True)) == 0
+
+def test_LazyBitStreamZlibSource():
+    data = "".join(chr(i % 251) for i in xrange(100000))
+    compressed = BufferBitStream("HDR" + zlib.compress(data))
+    compressed.seek(24)
+    source = LazyBitStreamZlibSource(compressed, 3 + len(data), "HDR",
+                                     sizehint=16, chunksize=64)
+    bits = LazyBitStream(BitStream)(source)
+    assert bits.read(ByteString[3]) == "HDR"
+    assert bits.read(ByteString[5]) == data[:5]
+    assert source.produced < 1000
+    assert bits.bits_available == len(data) * 8 - 40
+
+    bits.read_all()
+    bits.seek(24)
+    assert bits.read(ByteString) == data
+    assert source.produced == 3 + len(data)
+
+def test_LazyBitStream_forward_only():
+    data = "".join(chr(i % 251) for i in xrange(1000))
+    bits = RawBits.from_bytestring(data, forward_only=True)
+    assert bits.read(ByteString[100]) == data[:100]
+    bits.drop_before(96 * 8 + 4)
+    assert bits.tell() == 800
+    assert len(bits.bytes) < 100
+
+    bits.seek(96 * 8)
+    assert bits.read(ByteString[8]) == data[96:104]
+    py.test.raises(BitStreamWindowError, bits.seek, 95 * 8)
+
+    bits.seek(900 * 8)
+    assert bits.read(ByteString) == data[900:]
+    assert bits.bits_available == 0
+
+def test_LazyBitStreamFileSource_readahead(tmpdir):
+    data = "".join(chr(i % 251) for i in xrange(1000))
+    path = tmpdir.join("data.bin")
+    path.write(data, mode="wb")
+
+    file = path.open("rb")
+    source = LazyBitStreamFileSource(file, len(data), readahead=16, max_readahead=64)
+    bits = LazyBitStream(BitStream)(source)
+    assert len(bits) == 16 * 8
+    assert bits.read(ByteString[20]) == data[:20]
+    assert source.readahead == 64
+    assert bits.read(ByteString[100]) == data[20:120]
+    assert source.stats["misses"] == 0
+
+    file.seek(0)
+    assert bits.read(ByteString[300]) == data[120:420]
+    assert source.stats["misses"] == 1
+
+    # Seeking the stream past its data starts the read-ahead over too.
+    assert bits.read(ByteString[100]) == data[420:520]
+    assert source.readahead == 64
+    bits.seek(700 * 8)
+    assert bits.read(ByteString[4]) == data[700:704]
+    assert source.stats["misses"] == 2
+    assert source.readahead == 32
+
+    bits.read_all()
+    bits.seek(0)
+    assert bits.read(ByteString) == data
+    assert source.stats["bytes"] == len(data)
+
+def test_LazyBitStream_seek_past_fill(tmpdir):
+    data = "".join(chr(i % 251) for i in xrange(100000))
+    path = tmpdir.join("data.bin")
+    path.write("HDR" + data, mode="wb")
+    file = path.open("rb")
+    file.seek(3)
+
+    sources = [LazyBitStreamByteStringSource(data),
+               LazyBitStreamFileSource(file, len(data), readahead=16),
+               LazyBitStreamZlibSource(BufferBitStream(zlib.compress(data)),
+                                       len(data), sizehint=16)]
+    for source in sources:
+        bits = LazyBitStream(BitStream)(source)
+        assert bits.bits_available == len(data) * 8
+        bits.seek(50000 * 8)
+        assert bits.read(ByteString[4]) == data[50000:50004]
+
+    source = sources[1]
+    assert source.read_at(70000, 5) == data[70000:70005]
+    bits.seek(0)
+    assert bits.read(ByteString[3]) == data[:3]
+
+def test_read_array():
+    from fusion.bitstream.flash_formats import UI16, SI32, DOUBLE
+    bits = BitStream()
+    bits.write(1, UI16)
+    bits.write(0xFFFE, UI16)
+    bits.write(-5, SI32)
+    bits.write(2**31 - 1, SI32)
+    bits.write(-0.5, DOUBLE)
+    bits.write(1e300, DOUBLE)
+    data = bits.serialize()
+
+    for stream in (bits, BufferBitStream(data)):
+        stream.seek(0)
+        result = stream.read_array(UI16, 2)
+        assert result.typecode == "H" and list(result) == [1, 0xFFFE]
+        assert list(stream.read_array(SI32, 2)) == [-5, 2**31 - 1]
+        assert list(stream.read_array(DOUBLE, 2)) == [-0.5, 1e300]
+        assert stream.bits_available == 0
+        assert len(stream.read_array(UI16, 0)) == 0
+        py.test.raises(IndexError, stream.read_array, UI16, 1)
+
+    # Unaligned and big-endian elements.
+    bits = BitStream()
+    bits.write_bit(1)
+    bits.write_bytes("\x12\x34\x56\x78")
+    bits.seek(1)
+    assert list(bits.read_array(Byte[2:">"], 2)) == [0x1234, 0x5678]
+
+    # Formats without a machine type come back as a list.
+    bits.seek(0)
+    assert bits.read_array(Bit, 3) == [True, False, False]
+
+def test_read_u30():
+    data = "\x05\x80\x01\xFF\xFF\xFF\xFF\x0F\x7F"
+    for stream in (BitStream(), BufferBitStream(data),
+                   BufferBitStream(bytearray(data)),
+                   BufferBitStream(memoryview(data))):
+        if isinstance(stream, BitStream):
+            stream.write_bytes(data)
+        stream.seek(0)
+        assert stream.read_u30() == 5
+        assert stream.read_u30_run(2) == [0x80, 0xFFFFFFFF]
+        assert stream.read_u30() == 0x7F
+        assert stream.bits_available == 0
+        py.test.raises(IndexError, stream.read_u30)
+
+    # A continuation bit on the last byte runs off the end.
+    py.test.raises(IndexError, BufferBitStream("\x80\x80").read_u30)
+    py.test.raises(IndexError, BufferBitStream("\x80\x80\x01", 0, 16).read_u30)
+    stream = BufferBitStream("\x00\x85\x01\x03", 8)
+    assert stream.read_u30_run(2) == [0x85, 3]
+    assert stream.tell() == 24
+    py.test.raises(ValueError, BufferBitStream("\x80" * 6).read_u30)
+
+    # Unaligned reads take the generic path.
+    bits = BitStream()
+    bits.write_bit(0)
+    bits.write_bytes("\x85\x01\x03")
+    bits.seek(1)
+    assert bits.read_u30_run(2) == [0x85, 3]
+
+def test_read_string():
+    data = "abc\0\0xyz"
+    for stream in (BitStream(), BufferBitStream(data),
+                   BufferBitStream(buffer(data))):
+        if isinstance(stream, BitStream):
+            stream.write_bytes(data)
+        stream.seek(0)
+        assert stream.read_cstring() == "abc"
+        assert stream.read_cstring() == ""
+        assert stream.read_string(2) == "xy"
+        py.test.raises(IndexError, stream.read_cstring)
+        py.test.raises(IndexError, stream.read_string, 2)
+        assert stream.read_string(1) == "z"
+
+    # Unaligned reads take the generic path.
+    bits = BitStream()
+    bits.write_bit(1)
+    bits.write_bytes("hi\0yo")
+    bits.seek(1)
+    assert bits.read_cstring() == "hi"
+    assert bits.read_string(2) == "yo"
+
+def test_LazyBitStream_read_cstring():
+    data = "x" * 50 + "\0" + "y" * 3
+    bits = LazyBitStream(BitStream)(LazyBitStreamByteStringSource(data, 4))
+    assert bits.read_cstring() == "x" * 50
+    assert bits.read_string(3) == "yyy"
+
+    bits = LazyBitStream(BoolArrayBitStream)(LazyBitStreamByteStringSource(data, 4))
+    assert bits.read_cstring() == "x" * 50
+    assert bits.read_string(3) == "yyy"
+
+    with py.test.raises(TypeError):
+        LazyBitStream(BoolArrayBitStream)(LazyBitStreamByteStringSource(data),
+                                          forward_only=True)
@@ -2,7 +2,7 @@
 import py.test
 import os
 
-from fusion.bitstream.bitstream import BitStream
+from fusion.bitstream.bitstream import BitStream, BufferBitStream
 
 from fusion.bitstream.formats import Bit, Byte, ByteList,  \
      ByteString, SignedByte, CString, UTF8, CUTF8, Zero, One, UB, SB, FB, \
@@ -44,6 +44,13 @@ def test_FormatArray_read():
     result = bits.read(Bit[:][6])
     assert result == [False, True]*3
 
+def test_FormatArray_read_bulk():
+    # Fixed-width elements are read in bulk, but still come back as a list.
+    bits = BitStream()
+    bits.write_bytes("\x01\x00\x02\x00\x03\x00")
+    bits.seek(0)
+    assert bits.read(Byte[2:"<"][3]) == [1, 2, 3]
+
 def test_FormatArray_write():
     bits = BitStream()
 
@@ -313,6 +320,39 @@ def test_UB_read():
     assert result == 0xFFEEDD
     assert bits.bits_available == 0
 
+def test_read_ub_unaligned():
+    data = "\xDD\xEE\xFF\x01\x23\x45\x67\x89\xAB\xCD"
+    value = int(data.encode("hex"), 16)
+    size = len(data) * 8
+    for make in (lambda: BufferBitStream(data), lambda: BufferBitStream(bytearray(data))):
+        for start in (0, 1, 3, 7, 12):
+            for length in (1, 5, 17, 31, 57, 64, size - start):
+                if start + length > size:
+                    continue
+                bits = make()
+                bits.seek(start)
+                expected = (value >> (size - start - length)) & ((1 << length) - 1)
+                assert bits.read_ub(length) == expected
+                assert bits.tell() == start + length
+
+    bits = BitStream()
+    bits.write(data, ByteString)
+    bits.seek(3)
+    assert bits.read_ub(61) == (value >> (size - 64)) & ((1 << 61) - 1)
+    assert bits.tell() == 64
+    assert bits.read_ub(16) == 0xABCD
+    py.test.raises(IndexError, bits.read_ub, 1)
+
+def test_SB_read():
+    bits = BufferBitStream("\xF8\x80")
+    assert bits.read(SB[5]) == -1
+    assert bits.read(SB[3]) == 0
+    assert bits.read(SB[8]) == -128
+
+    bits = BufferBitStream("\x7F\xFF\x80\x00")
+    assert bits.read(FB[16]) == 0x7FFF / float(0x10000)
+    assert bits.read(FB[16]) == -0.5
+
 def test_UB_write():
     bits = BitStream()
     bits.write(0b1111, UB[4])
@@ -399,3 +439,103 @@ def test_FloatValue_read():
     result = bits.read(FloatFormat[64])
     assert result == float("-inf")
     assert bits.bits_available == 0
+
+def test_read_honours_new_adapters():
+    from zope.component import provideAdapter
+    from fusion.bitstream.interfaces import IFormat
+
+    class ThreeBits(object):
+        pass
+
+    bits = BufferBitStream("\xA0")
+    py.test.raises(TypeError, bits.read, ThreeBits())
+
+    provideAdapter(lambda obj: UB[3], [ThreeBits], IFormat)
+    assert bits.read(ThreeBits()) == 0b101
+
+def test_specialize_interned():
+    assert UB[5] is UB[5]
+    assert UB[5:"<"] is UB[5:"<"]
+    assert UB[5] is not SB[5] and UB[5] is not UB[6]
+    assert UB[5]._evaluate(None) is UB[5]
+
+    first = UTF8[0]
+    for i in xrange(UTF8.CACHE_SIZE * 2):
+        UTF8[i]
+        UTF8[0]
+    assert UTF8[0] is first
+    assert len(UTF8._cache) <= UTF8.CACHE_SIZE
+
+    UTF8[10000]
+    for i in xrange(UTF8.CACHE_SIZE * 2):
+        UTF8[20000 + i]
+    assert (10000, None, None) not in UTF8._cache
+    assert (10000, None, None) not in UTF8._old_cache
+
+def test_Byte_struct_fast_path():
+    from fusion.bitstream.flash_formats import UI16, UI32, SI16, SI24, SI32, UI64
+
+    bits = BitStream()
+    bits.write(0x1234, UI16)
+    bits.write(-2, SI32)
+    bits.write(0xFFFFFFFFFFFFFFFF, UI64)
+    bits.write_bit(1)
+    bits.write(0xABCD, UI16)
+    bits.write(-0x800000, SI24)
+    assert bits.serialize() == "\x34\x12\xFE\xFF\xFF\xFF" + "\xFF" * 8 + \
+                               "\xE6\xD5\x80\x00\x40\x00"
+
+    for stream in (bits, BufferBitStream(bits.serialize())):
+        stream.seek(0)
+        assert stream.read(UI16) == 0x1234
+        assert stream.read(SI32) == -2
+        assert stream.read(UI64) == 0xFFFFFFFFFFFFFFFF
+        assert stream.read_bit()
+        assert stream.read(UI16) == 0xABCD
+        assert stream.read(SI24) == -0x800000
+        py.test.raises(IndexError, stream.read, SI16)
+
+    # Values outside the range of the struct format keep
+    # going through the generic path.
+    bits = BitStream()
+    bits.write(40000, SI16)
+    bits.seek(0)
+    assert bits.read(UI16) == 40000
+
+def test_FLOAT16_subnormal():
+    # No implicit leading 1 below the smallest exponent.
+    bits = BitStream("0000000000000001")
+    bits.seek(0)
+    assert bits.read(FloatFormat[16]) == 2.0 ** -25
+    bits = BitStream("1000001000000000")
+    bits.seek(0)
+    assert bits.read(FloatFormat[16]) == -(2.0 ** -16)
+
+def test_FLOAT16_round_trip():
+    from math import isnan
+    table = FloatFormat._float16_table()
+    for pattern, value in enumerate(table):
+        if not isnan(value):
+            assert FloatFormat._float16_bits(value) == pattern
+
+    # Ties round to even.
+    assert FloatFormat._float16_bits(1 + 2.0 ** -11) == 0x4000
+    assert FloatFormat._float16_bits(1 + 3 * 2.0 ** -11) == 0x4002
+    assert FloatFormat._float16_bits(2.0 ** -26) == 0x0000
+    py.test.raises(ValueError, FloatFormat._float16_bits, 70000.0)
+
+def test_FloatFormat_write():
+    from fusion.bitstream.flash_formats import FLOAT16, FLOAT, DOUBLE
+    bits = BitStream()
+    bits.write(1.5, FLOAT16)
+    bits.write(-0.0, FLOAT16)
+    bits.write(0.15625, FLOAT)
+    bits.write(-2.5, DOUBLE)
+    assert bits.serialize() == "\x00\x42\x00\x80\x00\x00\x20\x3E" + \
+                               "\x00\x00\x00\x00\x00\x00\x04\xC0"
+    bits.seek(0)
+    assert bits.read(FLOAT16) == 1.5
+    assert str(bits.read(FLOAT16)) == "-0.0"
+    assert bits.read(FLOAT) == 0.15625
+    assert bits.read(DOUBLE) == -2.5
+    py.test.raises(ValueError, bits.write, 1e40, FLOAT)
@@ -1,9 +1,17 @@
 
+import py
+import inspect
+import logging
+
 from fusion.bitstream.bitstream import BitStream
 
+from fusion.swf import records, shapes
 from fusion.swf.records import Rect
 
-from fusion.bitstream.formats import SB, FB, Bit
+from fusion.bitstream import compiler
+from fusion.bitstream.compiler import CompileError, codec_for, compile_struct, \
+     interpreted
+from fusion.bitstream.formats import UB, SB, FB, Bit
 from fusion.bitstream.structs import Struct, Fields, NBits
 from fusion.bitstream.structs import Field, Local
 
@@ -80,3 +88,80 @@ def test_matrix_read():
 ## test_rect_read()
 ## test_matrix_read()
 ## test_matrix_write()
+
+class InstanceStruct(Struct):
+    def __init__(self, value=0, width=4):
+        super(InstanceStruct, self).__init__(locals())
+
+    def create_fields(self):
+        yield Field("width", UB[4])
+        yield Field("value", UB[self.width])
+
+def interpret_write(struct):
+    bits = BitStream()
+    struct._interpret_write(bits)
+    bits.seek(0)
+    return bits
+
+def test_compiled_write():
+    assert codec_for(TestMatrix) is not None
+    for tup, bits in matrix_testcases:
+        matrix = TestMatrix(*tup)
+        assert str(matrix.as_bitstream()) == str(interpret_write(matrix))
+        assert not hasattr(matrix, "TEMP_FIELDS")
+        assert not matrix.writing
+
+def test_compiled_read():
+    assert codec_for(TestRect) is not None
+    rect_data.seek(0)
+    rect = TestRect.from_bitstream(rect_data)
+    rect_data.seek(0)
+    interpreted = TestRect.__new__(TestRect)
+    Struct.__init__(interpreted)
+    interpreted._interpret_read(rect_data)
+    assert vars(rect) == vars(interpreted)
+    assert (rect.XMin, rect.YMin, rect.XMax, rect.YMax) == (20, 80, 600, 800)
+
+def test_compile_fallback():
+    py.test.raises(CompileError, compile_struct, InstanceStruct)
+    assert codec_for(InstanceStruct) is None
+    assert "depends on the instance" in interpreted[InstanceStruct]
+    bits = InstanceStruct(5, 3).as_bitstream()
+    assert InstanceStruct.from_bitstream(bits).value == 5
+
+def test_write_into():
+    for rect in (Rect(20, 80, 600, 800), TestRect(20, 80, 600, 800)):
+        for prefix in ("", "101"):
+            copied, written = BitStream(prefix), BitStream(prefix)
+            copied += rect.as_bitstream()
+            written += rect
+            assert str(written) == str(copied)
+            assert written.tell() == copied.tell()
+
+def test_compile_without_source(monkeypatch, caplog):
+    class NoSource(Struct):
+        def create_fields(self):
+            yield Field("value", UB[4])
+
+    def getsource(function):
+        raise IOError("could not get source code")
+    monkeypatch.setattr(compiler.inspect, "getsource", getsource)
+    with caplog.at_level(logging.WARNING, logger=compiler.__name__):
+        assert codec_for(NoSource) is None
+    assert "NoSource" in caplog.text
+    assert "source" in interpreted[NoSource]
+
+# The structs the compiler leaves to the interpreter on purpose.
+INTERPRETED_RECORDS = set(["FillStyle", "FocalGradient", "Gradient",
+                           "LineStyle2", "StyleChangeRecord"])
+
+def test_records_compile():
+    for module in (records, shapes):
+        for name, cls in vars(module).items():
+            if not (inspect.isclass(cls) and issubclass(cls, Struct)
+                    and cls.__module__ == module.__name__):
+                continue
+            if name in INTERPRETED_RECORDS:
+                py.test.raises(CompileError, compile_struct, cls)
+            else:
+                compile_struct(cls)
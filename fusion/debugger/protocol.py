@@ -2,7 +2,7 @@
 import collections
 import struct
 
-from fusion.bitstream.bitstream import BitStream
+from fusion.bitstream.bitstream import BufferBitStream
 from fusion.debugger import commands
 
 from twisted.internet import protocol
@@ -31,7 +31,7 @@ class DebugProtocol(protocol.Protocol):
 
             command = commands.get_in_command(commandid)()
             command.raw_data = data
-            command.data = BitStream(data)
+            command.data = BufferBitStream(data)
             self.commandReceived(command)
 
     def sendCommand(self, command):
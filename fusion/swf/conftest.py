@@ -0,0 +1,20 @@
+import py.test
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.tags import End
+
+def build_swf(tags, compress=False, end=True, serialize=True):
+    """
+    Build a SwfData out of tags, followed by an End tag unless end is
+    False. Returns it serialized unless serialize is False.
+    """
+    swf = SwfData(compress=compress)
+    for tag in tags:
+        swf.add_tag(tag)
+    if end:
+        swf.add_tag(End())
+    return swf.serialize() if serialize else swf
+
+@py.test.fixture
+def make_swf():
+    return build_swf
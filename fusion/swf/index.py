@@ -0,0 +1,272 @@
+"""
+A persistent index of the tags of a SWF file.
+
+Finding a tag used to mean walking read_tags from the start of the
+file. SwfTagIndex records where every top level tag lives in one pass
+over the raw tag headers, skipping the bodies, so that SwfData can seek
+straight to the bytes of the tags it is asked for.
+
+Offsets are relative to the start of the uncompressed file, like the
+offset of the tags read_tags returns. The index of a file can be kept
+in a sidecar file next to it, which is only trusted while the size,
+modification time and a digest of the file still match.
+"""
+
+import os
+import struct
+import hashlib
+from collections import namedtuple
+from bisect import bisect_left
+
+from fusion.bitstream.bitstream import BitStream, LazyBitStream, \
+     LazyBitStreamFileSource, LazyBitStreamZlibSource
+from fusion.bitstream.formats import ByteString
+from fusion.swf.tags import UnknownSwfTag
+
+# The tags that close a frame and the movie.
+SHOW_FRAME = 1
+END = 0
+
+SIDECAR_MAGIC = "FSIX\x01"
+SIDECAR_SUFFIX = ".idx"
+SIDECAR_HEADER = struct.Struct("<QdI16s")
+SIDECAR_ENTRY = struct.Struct("<HIIII")
+
+# How much of both ends of the file goes into its digest.
+DIGEST_SAMPLE = 0x10000
+
+# Tag name -> id, for every tag known, parsed by fusion or not.
+TAG_IDS = dict((name, id) for id, name in UnknownSwfTag.reference.iteritems())
+
+TagEntry = namedtuple("TagEntry", "id header_offset offset length frame")
+
+class SwfTagIndex(object):
+    """
+    The (tag id, header offset, body offset, length, frame number)
+    entries of the top level tags of a SWF, in file order.
+
+    Frames are numbered from 0; a ShowFrame tag belongs to the frame
+    it shows. Tags nested in a DefineSprite are not indexed.
+    """
+    def __init__(self, entries, key=None):
+        self.entries = entries
+        self.key = key
+        self.frames = [entry.frame for entry in entries]
+        self.offsets = [entry.header_offset for entry in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        return self.entries[i]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    @property
+    def frame_count(self):
+        """
+        The number of frames closed by a ShowFrame tag.
+        """
+        return sum(1 for entry in self.entries if entry.id == SHOW_FRAME)
+
+    def of_type(self, ids):
+        """
+        Return the entries of the tags whose id is in ids.
+        """
+        return [entry for entry in self.entries if entry.id in ids]
+
+    def from_offset(self, offset):
+        """
+        Return the entries of the tags whose header starts at or after
+        the byte offset.
+        """
+        return self.entries[bisect_left(self.offsets, offset):]
+
+    def frame_range(self, start, stop=None):
+        """
+        Return the entries of the tags in frames start up to stop,
+        or only in frame start if stop is not given.
+        """
+        if stop is None:
+            stop = start + 1
+        return self.entries[bisect_left(self.frames, start):
+                            bisect_left(self.frames, stop)]
+
+    @classmethod
+    def scan(cls, read, skip, offset, key=None):
+        """
+        Build the index by parsing the tag headers handed out by
+        read(n), starting at offset. skip(n) has to move past n bytes
+        of tag body; the bodies are never looked at.
+
+        The scan stops after the End tag, or at the end of the data.
+        """
+        entries, frame = [], 0
+        while True:
+            header = read(2)
+            if len(header) < 2:
+                break
+            code, = struct.unpack("<H", header)
+            id, length = code >> 6, code & 0x3F
+            body = offset + 2
+            if length == 0x3F:
+                long_length = read(4)
+                if len(long_length) < 4:
+                    break
+                length, = struct.unpack("<I", long_length)
+                body += 4
+            entries.append(TagEntry(id, offset, body, length, frame))
+            if id == END:
+                break
+            if id == SHOW_FRAME:
+                frame += 1
+            skip(length)
+            offset = body + length
+        return cls(entries, key)
+
+    @classmethod
+    def from_bitstream(cls, bitstream, offset):
+        """
+        Index the tags of a SWF held by bitstream, starting at the
+        byte offset of its first tag. The cursor is left untouched.
+        """
+        def read(n):
+            n = min(n, bitstream.bits_available // 8)
+            return bitstream.read(ByteString[n]) if n > 0 else ""
+        def skip(n):
+            bitstream.seek(n * 8, os.SEEK_CUR)
+
+        cursor = bitstream.tell()
+        bitstream.seek(offset * 8)
+        try:
+            return cls.scan(read, skip, offset)
+        finally:
+            bitstream.seek(cursor)
+
+    @classmethod
+    def from_file(cls, file, size=None, key=None):
+        """
+        Index the SWF read from file, which has to be positioned at
+        the start of the SWF. The tag bodies of an uncompressed file
+        are seeked over; those of a compressed one are inflated and
+        thrown away as they go.
+        """
+        start = file.tell()
+        header = file.read(8)
+        if header[:3] not in ("CWS", "FWS"):
+            raise ValueError("Unrecognizable header. Are you sure this is a SWF file?")
+        if header[0] == "C":
+            if size is None:
+                file.seek(0, os.SEEK_END)
+                size = file.tell() - start
+                file.seek(start + 8)
+            length, = struct.unpack("<I", header[4:])
+            compressed = LazyBitStream(BitStream)(
+                LazyBitStreamFileSource(file, size - 8), True)
+            source = LazyBitStreamZlibSource(compressed, length)
+            read = source.inflate
+            def skip(n):
+                while n > 0 and not source.done:
+                    n -= len(source.inflate(min(n, 0x100000)))
+        else:
+            read = file.read
+            def skip(n):
+                file.seek(n, os.SEEK_CUR)
+
+        # Skip the frame size Rect, frame rate and frame count.
+        nbits = read(1)
+        rect = (5 + (ord(nbits) >> 3 if nbits else 0) * 4 + 7) // 8
+        skip(rect - 1 + 4)
+        return cls.scan(read, skip, 8 + rect + 4, key)
+
+    @classmethod
+    def for_filename(cls, filename, sidecar=None):
+        """
+        Return the index of the SWF at filename, from its sidecar file
+        if that is still valid, or by scanning the file and writing a
+        new sidecar otherwise. The sidecar defaults to filename + ".idx".
+        Failing to write it is not an error.
+        """
+        if sidecar is None:
+            sidecar = filename + SIDECAR_SUFFIX
+        key = file_key(filename)
+        index = cls.load(sidecar, key)
+        if index is None:
+            with open(filename, "rb") as file:
+                index = cls.from_file(file, key[0], key)
+            try:
+                index.save(sidecar)
+            except (IOError, OSError):
+                pass
+        return index
+
+    def save(self, filename):
+        """
+        Write the index to filename. The file is replaced in one go,
+        so readers never see half an index.
+        """
+        size, mtime, digest = self.key or (0, 0.0, "\0" * 16)
+        data = [SIDECAR_MAGIC,
+                SIDECAR_HEADER.pack(size, mtime, len(self.entries), digest)]
+        data.extend(SIDECAR_ENTRY.pack(*entry) for entry in self.entries)
+        temp = "%s.%d.tmp" % (filename, os.getpid())
+        with open(temp, "wb") as file:
+            file.write("".join(data))
+        try:
+            os.rename(temp, filename)
+        except OSError:
+            os.remove(temp)
+            raise
+
+    @classmethod
+    def load(cls, filename, key=None):
+        """
+        Read an index written by save. Returns None if the file is
+        missing, damaged, or was written for a key other than key.
+        """
+        try:
+            with open(filename, "rb") as file:
+                data = file.read()
+        except IOError:
+            return None
+        magic, start = len(SIDECAR_MAGIC), len(SIDECAR_MAGIC) + SIDECAR_HEADER.size
+        if data[:magic] != SIDECAR_MAGIC or len(data) < start:
+            return None
+        size, mtime, count, digest = SIDECAR_HEADER.unpack_from(data, magic)
+        if key is not None and (size, mtime, digest) != tuple(key):
+            return None
+        if len(data) != start + count * SIDECAR_ENTRY.size:
+            return None
+        entries = [TagEntry(*SIDECAR_ENTRY.unpack_from(data, offset)) for offset
+                   in xrange(start, len(data), SIDECAR_ENTRY.size)]
+        return cls(entries, (size, mtime, digest))
+
+def type_ids(types):
+    """
+    The set of ids of types, which may be SwfTag classes, tag names
+    or tag ids.
+    """
+    ids = set()
+    for kind in types:
+        if isinstance(kind, basestring):
+            kind = TAG_IDS[kind]
+        ids.add(getattr(kind, "id", kind))
+    return ids
+
+def file_key(filename):
+    """
+    The (size, mtime, digest) key a sidecar index is checked against.
+
+    Only the first and last DIGEST_SAMPLE bytes are digested, which
+    catches copies that keep the modification time without reading
+    a huge file in full.
+    """
+    stat = os.stat(filename)
+    digest = hashlib.md5()
+    with open(filename, "rb") as file:
+        digest.update(file.read(DIGEST_SAMPLE))
+        if stat.st_size > DIGEST_SAMPLE:
+            file.seek(max(stat.st_size - DIGEST_SAMPLE, DIGEST_SAMPLE))
+            digest.update(file.read())
+    return stat.st_size, stat.st_mtime, digest.digest()
@@ -0,0 +1,129 @@
+"""
+Parse the tags of a SWF in a pool of worker processes.
+
+Once the tag index says where every tag lives, the tags can be parsed
+independently of each other. ParallelSwfReader hands them out to a
+multiprocessing pool in batches and yields the parsed tags in file
+order. The batches are put together on the calling thread as the
+parsed tags are used, with at most two batches per worker in flight.
+
+Workers map an uncompressed SWF file themselves, so only the index
+entries travel to them. The bodies of compressed or in-memory SWFs are
+sent along with their entries.
+"""
+
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from fusion.bitstream.bitstream import BufferBitStream, map_file
+from fusion.swf.tags import tag_map
+from fusion.swf.index import type_ids
+
+# Small tags go out in batches of about this many bytes of body. A tag
+# larger than that is a batch of its own, which goes to whichever
+# worker is free first.
+BATCH_SIZE = 0x10000
+
+# The mapped SWF file of a worker process.
+_data = None
+
+def _init_worker(filename):
+    global _data
+    if filename is not None:
+        _data = map_file(filename)
+
+def _parse_batch(batch):
+    tags = []
+    for id, header_offset, offset, length, body in batch:
+        if body is None:
+            bits = BufferBitStream(_data, offset * 8, (offset + length) * 8)
+        else:
+            bits = BufferBitStream(body)
+        tag = tag_map[id].parse_inner(bits)
+        tag.offset = header_offset
+        tags.append(tag)
+    return tags
+
+class ParallelSwfReader(object):
+    """
+    Parses the tags of swf, a SwfData, in processes worker processes
+    (one per CPU by default).
+    """
+    def __init__(self, swf, processes=None, batch_size=BATCH_SIZE):
+        self.swf = swf
+        self.processes = processes or cpu_count()
+        self.batch_size = batch_size
+
+    @property
+    def filename(self):
+        """
+        The file workers can map to read the tag bodies from, if any.
+        """
+        if self.swf.compress:
+            return None
+        return getattr(self.swf, "filename", None)
+
+    def batches(self, entries):
+        shared = self.filename is not None
+        batch, size = [], 0
+        for entry in entries:
+            if entry.length >= self.batch_size:
+                if batch:
+                    yield batch
+                    batch, size = [], 0
+            body = None if shared else self.swf.tag_body(entry).serialize()
+            batch.append((entry.id, entry.header_offset, entry.offset,
+                          entry.length, body))
+            size += entry.length
+            if size >= self.batch_size:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def parse_batches(self, pool, entries):
+        """
+        Yield the batches of entries along with the tags parsed from
+        them, in order, with at most two batches per worker in flight.
+        """
+        pending = deque()
+        for batch in self.batches(entries):
+            pending.append((batch, pool.apply_async(_parse_batch, (batch,))))
+            while pending and (len(pending) > 2 * self.processes or
+                               pending[0][1].ready()):
+                batch, result = pending.popleft()
+                yield batch, result.get()
+        while pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+
+    def read_tags(self, only_parse_type=None):
+        """
+        Yield the parsed tags from the current tag of swf on in file
+        order, or only those of the types in only_parse_type, like
+        SwfData.read_tags does. swf is moved past the last tag, or
+        past the last tag yielded if the generator is not exhausted.
+        """
+        swf = self.swf
+        entries = swf.tag_index.from_offset(swf.tag_offset)
+        if not entries:
+            return
+        end = entries[-1].offset + entries[-1].length
+        if only_parse_type:
+            ids = type_ids(only_parse_type)
+            entries = [entry for entry in entries if entry.id in ids]
+
+        pool = Pool(self.processes, _init_worker, (self.filename,))
+        resume = None
+        try:
+            for batch, tags in self.parse_batches(pool, entries):
+                for (id, header_offset, offset, length, body), tag in zip(batch, tags):
+                    resume = offset + length
+                    yield tag
+            pool.close()
+            resume = end
+        finally:
+            pool.terminate()
+            pool.join()
+            if resume is not None:
+                swf.skip_to(resume)
@@ -36,12 +36,16 @@ class RecordHeader(object):
     RECORDHEADER struct, the header that signifies SWF tags.
     """
     implements(IStruct)
-    def __init__(self, id, length):
+    def __init__(self, id, length, long_form=None):
         from fusion.swf.tags import tag_map
         self.id = id
         self.type = tag_map[id]
         self.length = length
         self.bit_length = length*8
+        # Short tags may be written with a long header too.
+        if long_form is None:
+            long_form = length >= 0x3F
+        self.long_form = long_form
 
     def as_bitstream(self):
         """
@@ -55,18 +59,21 @@ class RecordHeader(object):
         ====== =========
         """
         bits = BitStream()
-        bits.write((self.id << 6) | min(self.length, 0x3F), UI16)
-        if self.length >= 0x3F:
+        if self.long_form:
+            bits.write((self.id << 6) | 0x3F, UI16)
             bits.write(self.length, SI32)
+        else:
+            bits.write((self.id << 6) | self.length, UI16)
         return bits
 
     @classmethod
     def from_bitstream(cls, bitstream):
         bits = bitstream.read(UI16)
         id, length = (bits >> 6), (bits & 0x3F)
-        if length == 0x3F:
+        long_form = length == 0x3F
+        if long_form:
             length = bitstream.read(UI32)
-        return cls(id, length)
+        return cls(id, length, long_form)
 
 class _EndShapeRecord(Struct):
     classProvides(IFormat, IStructEvaluateable)
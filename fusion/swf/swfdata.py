@@ -3,13 +3,18 @@ import os
 import zlib
 import struct
 
-from fusion.bitstream.bitstream import BitStream, BitStreamParseMixin
+from fusion.bitstream.bitstream import BitStream, BitStreamParseMixin, \
+     BufferBitStream, LazyBitStream, LazyBitStreamFileSource, \
+     LazyBitStreamZlibSource
 from fusion.bitstream.formats import ByteString
 from fusion.bitstream.flash_formats import UI8, UI16, UI32, FIXED8
 from fusion.swf.records import Rect, RecordHeader
 from fusion.swf.interfaces import ISwfPart
-from fusion.swf.tags import SwfTag
+from fusion.swf.tags import SwfTag, UnknownSwfTag, tag_map, lazy_tag, parse_tag
+from fusion.swf.index import SwfTagIndex, type_ids
+from fusion.swf.parallel import ParallelSwfReader
 from fusion.swf.core import SwfMovieClip
+from fusion.util import parallel_compress, DEFLATE_BLOCK_SIZE
 
 class SwfData(BitStreamParseMixin, SwfMovieClip):
     def __init__(self, width=600, height=400, fps=24, compress=False, version=10):
@@ -22,6 +27,8 @@ class SwfData(BitStreamParseMixin, SwfMovieClip):
         self.version = version
         self._next_tag_header = None
         self._next_character_id = 1
+        self.index = None
+        self.filename = None
 
     def __getitem__(self, i):
         return self.tags[i]
@@ -36,20 +43,42 @@ class SwfData(BitStreamParseMixin, SwfMovieClip):
         """
         ISwfPart(part).add_to(self)
 
-    def serialize(self):
+    def serialize(self, level=6, threads=None, block_size=DEFLATE_BLOCK_SIZE):
         """
         Serialize to bytes.
+
+        A compressed SWF is compressed at level, on threads threads (or
+        one per CPU if True) in blocks of block_size bytes if threads
+        is given.
         """
         data = self.get_data_stub()
         data += super(SwfData, self).serialize()
         filesize = len(data) + 8
 
         if self.compress:
-            data = zlib.compress(data)
+            if threads:
+                data = parallel_compress(data, level, block_size,
+                                         None if threads is True else threads)
+            else:
+                data = zlib.compress(data, level)
 
         return "".join([self.get_magic(), chr(self.version),
                         struct.pack("<L", filesize), data])
 
+    def write_to(self, file, level=6, threads=None, block_size=DEFLATE_BLOCK_SIZE):
+        """
+        Write the SWF to file through a SwfWriter, without building the
+        whole file in memory. Compressed output differs from serialize,
+        but inflates to the same data.
+        """
+        from fusion.swf.writer import SwfWriter
+        with SwfWriter(file, self.width, self.height, self.fps, self.compress,
+                       self.version, level, threads=threads,
+                       block_size=block_size) as writer:
+            for tag in self.tags:
+                writer.add_raw_tag(tag)
+            writer.num_frames = self.num_frames
+
     def get_magic(self):
         return "CWS" if self.compress else "FWS"
 
@@ -71,7 +100,12 @@ class SwfData(BitStreamParseMixin, SwfMovieClip):
         version = bitstream.read(UI8)
         length  = bitstream.read(UI32)
         if compressed:
-            bitstream.decompress()
+            # Inflate the body as the tags are read.
+            prefix = header + struct.pack("<BI", version, length)
+            source = LazyBitStreamZlibSource(bitstream, length, prefix)
+            forward_only = getattr(bitstream, "forward_only", False)
+            bitstream = LazyBitStream(BitStream)(source, forward_only)
+            bitstream.seek(len(prefix) * 8)
 
         rect = Rect.from_bitstream(bitstream)
         bitstream.skip_flush()
@@ -80,6 +114,20 @@ class SwfData(BitStreamParseMixin, SwfMovieClip):
         inst = cls(rect.XMax, rect.YMax, fps, compressed, version)
         inst.frame_count = frame_count
         inst.bitstream = bitstream
+        inst.tags_offset = bitstream.tell() // 8
+        return inst
+
+    @classmethod
+    def from_filename(cls, filename, *a, **kw):
+        """
+        Pass index=True to load the tag index from the sidecar file
+        next to filename, or build and save it if there is none.
+        """
+        index = kw.pop('index', False)
+        inst = super(SwfData, cls).from_filename(filename, *a, **kw)
+        inst.filename = filename
+        if index:
+            inst.index = SwfTagIndex.for_filename(filename)
         return inst
 
     @property
@@ -92,22 +140,134 @@ class SwfData(BitStreamParseMixin, SwfMovieClip):
         self.bitstream.seek(self._next_tag_header.bit_length, os.SEEK_CUR)
         self._next_tag_header = None
 
-    def read_tag(self):
+    @property
+    def tag_offset(self):
+        """
+        The byte offset of the header of the next tag read_tags reads.
+        """
+        offset = self.bitstream.tell() // 8
+        header = self._next_tag_header
+        if header is not None:
+            offset -= 6 if header.long_form else 2
+        return offset
+
+    def skip_to(self, offset):
+        """
+        Move read_tags on to the tag whose header is at the byte offset.
+        """
+        self.bitstream.seek(offset * 8)
+        self.bitstream.drop_before(self.bitstream.tell())
+        self._next_tag_header = None
+
+    def read_tag(self, lazy=False, lazy_pool=False):
+        """
+        Read the next tag. With lazy, return a LazySwfTag holding the
+        raw bytes of the tag instead of parsing it. With lazy_pool, the
+        ABC constant pool of a DoABC tag is decoded on first use.
+        """
         header = self.next_tag_header
-        bits = self.bitstream.read(BitStream[header.bit_length])
-        tag = header.type.parse_inner(bits)
-        tag.offset = self.bitstream.tell() // 8 - header.length - 2
+        offset = self.tag_offset
+        bits = self.bitstream.substream(header.bit_length)
+        if lazy:
+            tag = lazy_tag(header.type, header.as_bitstream().serialize(),
+                           bits.serialize(), offset)
+        else:
+            tag = parse_tag(header.type, bits, lazy_pool)
+            tag.offset = offset
         self._next_tag_header = None
         return tag
 
-    def read_tags(self, only_parse_type=None):
-        if isinstance(only_parse_type, SwfTag):
+    def read_tags(self, only_parse_type=None, parallel=None, lazy=False,
+                  lazy_pool=False):
+        """
+        Yield the tags from the current one on in file order, or only
+        those of the types in only_parse_type, which may be SwfTag
+        classes, tag names or tag ids.
+
+        With parallel, the tags are parsed by a ParallelSwfReader with
+        that many worker processes, or one per CPU if parallel is True.
+        With lazy, LazySwfTags are yielded and parsing is left until
+        the tags are used, so parallel is ignored. With lazy_pool, the
+        ABC constant pools of DoABC tags are decoded on first use; tags
+        coming back from worker processes are pickled, which decodes
+        them anyway.
+        """
+        if isinstance(only_parse_type, (type, SwfTag, UnknownSwfTag, basestring, int)):
             only_parse_type = (only_parse_type,)
+        ids = type_ids(only_parse_type) if only_parse_type else None
+        if parallel and not lazy:
+            processes = None if parallel is True else parallel
+            for tag in ParallelSwfReader(self, processes).read_tags(ids):
+                yield tag
+            return
         while self.bitstream.bits_available > 0:
-            if only_parse_type:
-                if self.next_tag_header.type in only_parse_type:
-                    yield self.read_tag()
+            # Nothing before the current tag will be read again.
+            self.bitstream.drop_before(self.bitstream.tell())
+            if ids:
+                if self.next_tag_header.id in ids:
+                    yield self.read_tag(lazy, lazy_pool)
                 else:
                     self.skip_tag()
             else:
-                yield self.read_tag()
+                yield self.read_tag(lazy, lazy_pool)
+
+    @property
+    def tag_index(self):
+        """
+        The SwfTagIndex of the tags, built the first time it is asked for.
+        """
+        if self.index is None:
+            source = getattr(self.bitstream, "source", None)
+            if isinstance(source, LazyBitStreamFileSource) and source.seekable:
+                # Seek over the bodies in the file itself, instead of
+                # pulling them through the stream.
+                source.file.seek(source.start)
+                self.index = SwfTagIndex.from_file(source.file, source.len)
+            else:
+                self.index = SwfTagIndex.from_bitstream(self.bitstream,
+                                                        self.tags_offset)
+        return self.index
+
+    def tag_body(self, entry):
+        """
+        Return a BitStream of the body of the tag at the index entry,
+        without disturbing read_tags.
+        """
+        source = getattr(self.bitstream, "source", None)
+        if isinstance(source, LazyBitStreamFileSource) and source.seekable:
+            return BufferBitStream(source.read_at(entry.offset, entry.length))
+        cursor = self.bitstream.tell()
+        self.bitstream.seek(entry.offset * 8)
+        try:
+            return self.bitstream.substream(entry.length * 8)
+        finally:
+            self.bitstream.seek(cursor)
+
+    def read_indexed_tag(self, entry, lazy_pool=False):
+        tag = parse_tag(tag_map[entry.id], self.tag_body(entry), lazy_pool)
+        tag.offset = entry.header_offset
+        return tag
+
+    def tag_at(self, i, lazy_pool=False):
+        """
+        Parse the i-th tag of the file.
+        """
+        return self.read_indexed_tag(self.tag_index[i], lazy_pool)
+
+    def tags_of_type(self, *types, **kw):
+        """
+        Parse the tags of the given types, which may be SwfTag
+        classes, tag names or tag ids, in file order. Pass
+        lazy_pool=True to decode ABC constant pools on first use.
+        """
+        lazy_pool = kw.pop('lazy_pool', False)
+        for entry in self.tag_index.of_type(type_ids(types)):
+            yield self.read_indexed_tag(entry, lazy_pool)
+
+    def frame_range(self, start, stop=None, lazy_pool=False):
+        """
+        Parse the tags of frames start up to stop, or of frame start
+        only if stop is not given.
+        """
+        for entry in self.tag_index.frame_range(start, stop):
+            yield self.read_indexed_tag(entry, lazy_pool)
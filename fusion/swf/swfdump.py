@@ -258,10 +258,10 @@ def main():
 
     if ext == ".swf":
         header(filename)
-        dump_swf(swfdata.SwfData.from_filename(filename))
+        dump_swf(swfdata.SwfData.from_filename(filename, mmap=True))
     elif ext == ".abc":
         header(filename)
-        AbcDumper(abc.AbcFile.from_filename(filename, lazy=False)).dump_abc()
+        AbcDumper(abc.AbcFile.from_filename(filename, mmap=True)).dump_abc()
     else:
         error('cannot parse a %s file' % (ext,))
 
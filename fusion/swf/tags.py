@@ -1,10 +1,11 @@
 
 import os
+import struct
 
 from zope.interface import implements, classProvides
 from zope.component import provideAdapter
 
-from fusion.bitstream.bitstream import BitStream
+from fusion.bitstream.bitstream import BitStream, BufferBitStream
 from fusion.bitstream.interfaces import IStruct, IStructClass
 from fusion.bitstream.formats import CString, Bit, Zero
 from fusion.bitstream.flash_formats import UI16, UI32
@@ -32,12 +33,22 @@ class SwfTag(object):
     id = -1
     min_version = -1
 
+    # Tags that define a character are given the next character id
+    # of the SWF they are added to.
+    defines_character = False
+
     def add_to(self, data):
         if data.version < self.min_version:
             raise SwfTagTooNew("%r requires a minimum version of %d. Your SWF v"
                 "ersion is %d" % (self, self.min_version, data.version))
+        if self.defines_character:
+            self.set_character_id(data.next_character_id)
+            data.next_character_id += 1
         data.add_raw_tag(self)
 
+    def set_character_id(self, characterid):
+        self.characterid = characterid
+
     def serialize_data(self):
         """
         Return the internal data of a tag.
@@ -67,7 +78,7 @@ class SwfTag(object):
     def from_bitstream(cls, bitstream):
         offset = bitstream.tell() // 8
         recordheader = RecordHeader.from_bitstream(bitstream)
-        bits = bitstream.read(BitStream[recordheader.length*8])
+        bits = bitstream.substream(recordheader.length*8)
         inst = cls.parse_inner(bits)
         inst.length = recordheader.length
         inst.offset = offset
@@ -157,10 +168,14 @@ class DoABC(SwfTag):
         self.flags = flags
 
     @classmethod
-    def parse_inner(cls, bitstream):
+    def parse_inner(cls, bitstream, lazy_pool=False):
+        """
+        With lazy_pool, the constant pool of the ABC file is decoded
+        on first use; see ConstantPool.from_bitstream.
+        """
         flags = bitstream.read(UI32)
         name  = bitstream.read(CString)
-        abc   = AbcFile.from_bitstream(bitstream)
+        abc   = AbcFile.from_bitstream(bitstream, lazy_pool)
         instance = cls(name, abc, flags)
         return instance
 
@@ -253,6 +268,7 @@ class DefineShape(SwfTag):
     id = 2
     min_version = 1
     variant = 1
+    defines_character = True
 
     _current_variant = None
 
@@ -267,10 +283,8 @@ class DefineShape(SwfTag):
         self.shape = ShapeWithStyle() if shape is None else shape
         self.characterid = characterid
 
-    def add_to(self, data):
-        super(DefineShape, self).add_to(data)
-        self.characterid = self.shape.characterid = data.next_character_id
-        data.next_character_id += 1
+    def set_character_id(self, characterid):
+        self.characterid = self.shape.characterid = characterid
 
     def serialize_data(self):
         DefineShape._current_variant = self.variant
@@ -336,16 +350,15 @@ class DefineShape4(DefineShape):
 class DefineSprite(SwfTag):
     id = 39
     min_version = 3
+    defines_character = True
 
     implements(IPlaceable)
 
     def __init__(self, movieclip):
         self.mc = movieclip
 
-    def add_to(self, data):
-        super(DefineSprite, self).add_to(data)
-        self.characterid = self.mc.shapes.characterid = data.next_character_id
-        data.next_character_id += 1
+    def set_character_id(self, characterid):
+        self.characterid = self.mc.shapes.characterid = characterid
 
     def serialize_data(self):
         bits = BitStream()
@@ -507,6 +520,7 @@ class DefineEditText(SwfTag):
 
     id = 37
     min_version = 4
+    defines_character = True
 
     def __init__(self, rect, variable, text="", readonly=True, isHTML=False,
                  wordwrap=False, multiline=True, password=False, autosize=True,
@@ -587,11 +601,6 @@ class DefineEditText(SwfTag):
         inst.outlines  = HasOutlines
         return inst
 
-    def add_to(self, data):
-        super(DefineEditText, self).add_to(data)
-        self.characterid = data.next_character_id
-        data.next_character_id += 1
-
     def serialize_data(self):
         bits = BitStream()
         bits.write(self.characterid, UI16)
@@ -654,6 +663,133 @@ class End(SwfTag):
         bits.seek(16, os.SEEK_CUR)
         return cls()
 
+class LazySwfTag(SwfTag):
+    """
+    The base of the lazy tag classes, which stand in for tags read
+    from a SWF and hold on to their raw bytes until they are needed.
+
+    Every tag type gets its own lazy subclass of its tag class (see
+    lazy_tag_class), so lazy tags are instances of their tag class and
+    the methods of that class apply to them as usual. Until a lazy tag
+    is parsed it only knows its offset, and serialize returns the bytes
+    the tag was read from, header included, so tags that are passed
+    through untouched are never decoded or re-encoded. The tag is
+    parsed, and takes on the state of the parsed tag, the first time an
+    attribute it does not have yet is looked up or any attribute is set.
+
+    A tag that defines a character stays unparsed when it is added to
+    a SWF: the new character id is patched into the first UI16 of the
+    raw body, where every character defining tag keeps it.
+    """
+    # The tag class (or UnknownSwfTag) of the lazy class, and its name.
+    tag_type = None
+    tag_name = None
+
+    def __init__(self, header, body, offset):
+        self.__dict__.update(_header=header, _body=body, offset=offset,
+                             parsed=False)
+
+    def parse(self):
+        """
+        Parse the tag, if that has not happened yet.
+        """
+        if not self.parsed:
+            tag = self.tag_type.parse_inner(BufferBitStream(self._body))
+            del self._header, self._body
+            self.__dict__.update(tag.__dict__, offset=self.offset,
+                                 parsed=True)
+        return self
+
+    def __getattr__(self, name):
+        # Only called for attributes the tag does not have (yet).
+        if name.startswith("__") or self.__dict__.get("parsed", True):
+            raise AttributeError(name)
+        return getattr(self.parse(), name)
+
+    def __setattr__(self, name, value):
+        self.parse()
+        super(LazySwfTag, self).__setattr__(name, value)
+
+    def as_tag(self):
+        """
+        Return a plain instance of the tag class with the state of the
+        parsed tag.
+        """
+        return plain_tag(*self.parse().__reduce_ex__(2)[1])
+
+    def __reduce_ex__(self, protocol):
+        if not self.parsed:
+            return lazy_tag, (self.tag_type, self._header, self._body, self.offset)
+        state = self.__dict__.copy()
+        del state["parsed"]
+        return plain_tag, (self.tag_type, state)
+
+    def set_character_id(self, characterid):
+        if self.parsed:
+            return super(LazySwfTag, self).set_character_id(characterid)
+        self.__dict__["_body"] = struct.pack("<H", characterid) + self._body[2:]
+
+    def serialize_data(self):
+        if not self.parsed:
+            return self._body
+        return super(LazySwfTag, self).serialize_data()
+
+    def serialize(self):
+        if not self.parsed:
+            return self._header + self._body
+        return super(LazySwfTag, self).serialize()
+
+    def __repr__(self):
+        if not self.parsed:
+            return "<%s (%#X) (Unparsed)>" % (self.tag_name, self.id)
+        return repr(self.as_tag())
+
+_lazy_classes = {}
+
+def lazy_tag_class(kind):
+    """
+    Return the LazySwfTag subclass for kind, a tag class or an
+    UnknownSwfTag.
+    """
+    cls = _lazy_classes.get(kind.id)
+    if cls is None or cls.tag_type is not kind:
+        if isinstance(kind, type):
+            bases, name = (LazySwfTag, kind), kind.__name__
+        else:
+            bases, name = (LazySwfTag, UnknownSwfTag), kind.name
+        cls = type(name, bases, dict(tag_type=kind, tag_name=name, id=kind.id,
+                                     min_version=kind.min_version,
+                                     __module__=__name__))
+        _lazy_classes[kind.id] = cls
+    return cls
+
+def parse_tag(kind, bits, lazy_pool=False):
+    """
+    Parse the body bits of a tag of type kind, a tag class or an
+    UnknownSwfTag. lazy_pool is passed on to DoABC tags.
+    """
+    if lazy_pool and kind is DoABC:
+        return kind.parse_inner(bits, lazy_pool)
+    return kind.parse_inner(bits)
+
+def plain_tag(kind, state):
+    """
+    Return an instance of the tag class kind with the state of a
+    parsed lazy tag.
+    """
+    if not isinstance(kind, type):
+        # UnknownSwfTags parse to themselves.
+        return kind
+    tag = kind.__new__(kind)
+    tag.__dict__.update(state)
+    return tag
+
+def lazy_tag(kind, header, body, offset):
+    """
+    Return an unparsed tag of type kind read from header and body, the
+    raw bytes of the tag, at the byte offset.
+    """
+    return lazy_tag_class(kind)(header, body, offset)
 
 class UnknownSwfTag(object):
     """
@@ -0,0 +1,117 @@
+import os
+import zipfile
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.index import SwfTagIndex, file_key
+from fusion.swf.tags import (FileAttributes, SetBackgroundColor,
+                             RemoveObject2, ShowFrame, End, DoABC)
+from fusion.avm2.abc_ import AbcFile
+
+def two_frames():
+    return [FileAttributes(), SetBackgroundColor(0x336699), ShowFrame(),
+            RemoveObject2(7), SetBackgroundColor(0x000000), ShowFrame()]
+
+def test_scan(make_swf):
+    for compress in (False, True):
+        swf = SwfData.from_bytestring(make_swf(two_frames(), compress))
+        index = swf.tag_index
+        assert [entry.id for entry in index] == [69, 9, 1, 28, 9, 1, 0]
+        assert [entry.frame for entry in index] == [0, 0, 0, 1, 1, 1, 2]
+        assert index.frame_count == 2
+        for entry, tag in zip(index, swf.read_tags()):
+            assert entry.header_offset == tag.offset
+            assert entry.offset == entry.header_offset + 2
+        assert index.from_offset(index[3].header_offset) == index[3:]
+        assert index.from_offset(index[3].header_offset - 1) == index[3:]
+
+def test_long_tag_offsets(tmpdir, make_swf):
+    abc = AbcFile()
+    abc.constants.utf8.index_for("x" * 100)
+    data = make_swf([SetBackgroundColor(0x336699), DoABC("script", abc),
+                     SetBackgroundColor(0x000000)])
+    path = tmpdir.join("long.swf")
+    path.write(data, mode="wb")
+
+    index = SwfData.from_bytestring(data).tag_index
+    assert index[1].length >= 0x3F
+    assert index[2].offset == index[2].header_offset + 2
+    offsets = [entry.header_offset for entry in index]
+    for kw in ({}, {"lazy": True}):
+        assert [tag.offset for tag in SwfData.from_bytestring(data).read_tags(**kw)] == offsets
+    swf = SwfData.from_filename(str(path))
+    assert [tag.offset for tag in swf.read_tags(parallel=2)] == offsets
+    swf = SwfData.from_filename(str(path))
+    assert [tag.offset for tag in swf.tags_of_type(SetBackgroundColor)] == \
+           [offsets[0], offsets[2]]
+
+def test_random_access(tmpdir, make_swf):
+    for compress in (False, True):
+        path = tmpdir.join("test%d.swf" % compress)
+        path.write(make_swf(two_frames(), compress), mode="wb")
+        for kw in ({}, {"lazy": True}, {"mmap": True}):
+            swf = SwfData.from_filename(str(path), **kw)
+            assert isinstance(swf.tag_at(3), RemoveObject2)
+            assert swf.tag_at(3).depth == 7
+            colors = [tag.color.color for tag in swf.tags_of_type(SetBackgroundColor)]
+            assert colors == [0x336699, 0x000000]
+            assert [type(tag) for tag in swf.frame_range(1)] == \
+                   [RemoveObject2, SetBackgroundColor, ShowFrame]
+            assert len(list(swf.frame_range(0, 3))) == 7
+
+            # Random access leaves read_tags where it was.
+            tags = swf.read_tags()
+            assert isinstance(tags.next(), FileAttributes)
+            swf.tag_at(-1)
+            assert len(list(tags)) == 6
+
+def test_from_file_offset(tmpdir, make_swf):
+    data = make_swf(two_frames(), False)
+    path = tmpdir.join("prefixed.swf")
+    path.write("PREFIX!!" + data + "TRAILING", mode="wb")
+    for kw in ({}, {"lazy": True}, {"lazy": False}, {"forward_only": True}):
+        file = path.open("rb")
+        file.seek(8)
+        swf = SwfData.from_file(file, len(data), **kw)
+        assert [tag.offset for tag in swf.read_tags()] == \
+               [entry.header_offset for entry in SwfData.from_bytestring(data).tag_index]
+    file.seek(8)
+    swf = SwfData.from_file(file, len(data), lazy=True)
+    assert swf.tag_at(3).depth == 7
+
+def test_from_unseekable(tmpdir, make_swf):
+    for compress in (False, True):
+        data = make_swf(two_frames(), compress)
+        read, write = os.pipe()
+        os.write(write, data)
+        os.close(write)
+        files = [os.fdopen(read, "rb")]
+
+        path = str(tmpdir.join("test%d.zip" % compress))
+        archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        archive.writestr("test.swf", data)
+        archive.close()
+        files.append(zipfile.ZipFile(path).open("test.swf"))
+
+        for file in files:
+            swf = SwfData.from_file(file, len(data), lazy=True)
+            assert [type(tag) for tag in swf.read_tags()][-4:] == \
+                   [RemoveObject2, SetBackgroundColor, ShowFrame, End]
+
+def test_sidecar(tmpdir, make_swf):
+    path = tmpdir.join("test.swf")
+    path.write(make_swf(two_frames(), True), mode="wb")
+    filename = str(path)
+    sidecar = filename + ".idx"
+
+    swf = SwfData.from_filename(filename, index=True)
+    assert os.path.exists(sidecar)
+    assert SwfTagIndex.load(sidecar, file_key(filename)).entries == swf.index.entries
+    assert isinstance(swf.tag_at(3), RemoveObject2)
+
+    os.utime(filename, (0, 0))
+    assert SwfTagIndex.load(sidecar, file_key(filename)) is None
+    SwfTagIndex.for_filename(filename)
+    assert SwfTagIndex.load(sidecar, file_key(filename)) is not None
+
+    tmpdir.join("test.swf.idx").write("FSIX", mode="wb")
+    assert SwfTagIndex.load(sidecar) is None
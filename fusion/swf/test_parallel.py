@@ -0,0 +1,93 @@
+import pickle
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.parallel import ParallelSwfReader
+from fusion.swf.tags import DoABC, SetBackgroundColor, ShowFrame, End
+from fusion.avm2.abc_ import AbcFile
+
+def scripts():
+    tags = []
+    for i in xrange(4):
+        abc = AbcFile()
+        abc.constants.utf8.index_for("script%d" % i)
+        tags.append(DoABC("script%d" % i, abc))
+        tags.append(SetBackgroundColor(i))
+    tags.append(ShowFrame())
+    return tags
+
+def test_pickle_tags(make_swf):
+    for tag in SwfData.from_bytestring(make_swf(scripts(), False)).read_tags():
+        copy = pickle.loads(pickle.dumps(tag, 2))
+        assert type(copy) is type(tag)
+        assert copy.serialize() == tag.serialize()
+
+def test_read_tags_parallel(tmpdir, make_swf):
+    for compress in (False, True):
+        path = tmpdir.join("test%d.swf" % compress)
+        path.write(make_swf(scripts(), compress), mode="wb")
+        serial = list(SwfData.from_filename(str(path)).read_tags())
+        for swf in (SwfData.from_filename(str(path), mmap=True),
+                    SwfData.from_bytestring(path.read(mode="rb"))):
+            tags = list(swf.read_tags(parallel=2))
+            assert [type(tag) for tag in tags] == [type(tag) for tag in serial]
+            assert [tag.serialize() for tag in tags] == \
+                   [tag.serialize() for tag in serial]
+
+        swf = SwfData.from_filename(str(path))
+        reader = ParallelSwfReader(swf, 2, batch_size=16)
+        names = [tag.name for tag in reader.read_tags([DoABC])]
+        assert names == ["script0", "script1", "script2", "script3"]
+
+def test_read_tags_parallel_resumes(tmpdir, make_swf):
+    path = tmpdir.join("test.swf")
+    path.write(make_swf(scripts(), True), mode="wb")
+    serial = [tag.serialize() for tag in SwfData.from_filename(str(path)).read_tags()]
+    for swf in (SwfData.from_filename(str(path)),
+                SwfData.from_bytestring(path.read(mode="rb"))):
+        tags = swf.read_tags()
+        first = [tags.next().serialize() for i in xrange(3)]
+        swf.next_tag_header
+        rest = [tag.serialize() for tag in swf.read_tags(parallel=2)]
+        assert first + rest == serial
+        assert list(swf.read_tags()) == []
+        assert list(swf.read_tags(parallel=2)) == []
+
+def test_read_tags_parallel_window(make_swf):
+    swf = SwfData.from_bytestring(make_swf(scripts(), False))
+    bodies = []
+    tag_body = swf.tag_body
+    def counting_tag_body(entry):
+        bodies.append(entry)
+        return tag_body(entry)
+    swf.tag_body = counting_tag_body
+
+    # Batches are built as the tags are used, and the SwfData can be
+    # used in between.
+    tags = ParallelSwfReader(swf, 1, batch_size=1).read_tags()
+    assert isinstance(tags.next(), DoABC)
+    assert len(bodies) <= 3
+    assert isinstance(swf.tag_at(1), SetBackgroundColor)
+    assert [type(tag) for tag in tags][-2:] == [ShowFrame, End]
+    assert len(bodies) == 11
+
+def test_read_tags_parallel_early_exit(make_swf):
+    data = make_swf(scripts(), False)
+    serial = [tag.serialize() for tag in SwfData.from_bytestring(data).read_tags()]
+    swf = SwfData.from_bytestring(data)
+    tags = ParallelSwfReader(swf, 2, batch_size=1).read_tags()
+    first = [tags.next().serialize() for i in xrange(3)]
+    tags.close()
+    assert first + [tag.serialize() for tag in swf.read_tags()] == serial
+
+    swf = SwfData.from_bytestring(data)
+    for tag in swf.read_tags(DoABC, parallel=2):
+        break
+    assert [tag.name for tag in swf.read_tags(DoABC)] == ["script1", "script2", "script3"]
+
+def test_only_parse_type(make_swf):
+    data = make_swf(scripts(), False)
+    for only_parse_type in (DoABC, "DoABC", DoABC.id, [DoABC, "SetBackgroundColor"]):
+        for parallel in (None, 2):
+            swf = SwfData.from_bytestring(data)
+            tags = list(swf.read_tags(only_parse_type, parallel=parallel))
+            assert len(tags) == (8 if isinstance(only_parse_type, list) else 4)
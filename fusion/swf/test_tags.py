@@ -0,0 +1,137 @@
+import pickle
+import struct
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.records import RecordHeader
+from fusion.swf.interfaces import ISwfPart
+from fusion.swf.tags import (LazySwfTag, UnknownSwfTag, DoABC, SymbolClass,
+                             DefineShape4, ShowFrame, End)
+from fusion.avm2.abc_ import AbcFile
+from fusion.avm2 import util
+from fusion.bitstream.bitstream import BufferBitStream
+
+def main_script():
+    abc = AbcFile()
+    abc.constants.utf8.index_for("Main")
+    return [DoABC("Main", abc), SymbolClass({0: "Main"}), ShowFrame()]
+
+def rewrite(data, lazy):
+    source = SwfData.from_bytestring(data)
+    swf = SwfData(source.width, source.height, source.fps,
+                  source.compress, source.version)
+    tags = list(source.read_tags(lazy=lazy))
+    for tag in tags:
+        swf.add_tag(tag)
+    return swf, tags
+
+def test_RecordHeader_long_form():
+    for length, long_form in ((5, False), (5, True), (0x3F, True)):
+        header = RecordHeader(82, length, long_form)
+        data = header.as_bitstream().serialize()
+        copy = RecordHeader.from_bitstream(BufferBitStream(data))
+        assert (copy.length, copy.long_form) == (length, long_form)
+        assert copy.as_bitstream().serialize() == data
+
+def test_passthrough(make_swf):
+    data = make_swf(main_script())
+    swf, tags = rewrite(data, True)
+    assert swf.serialize() == data
+    assert swf.num_frames == 1
+    assert not any(tag.parsed for tag in tags)
+
+    doabc = tags[0]
+    assert isinstance(doabc, DoABC)
+    assert ISwfPart(doabc) is doabc
+    assert doabc.id == DoABC.id
+    assert doabc.offset == 21
+    assert not doabc.parsed
+
+def test_lazy_classes(make_swf):
+    swf, tags = rewrite(make_swf(main_script()), True)
+    showframe = tags[2]
+    assert type(showframe).__mro__[1:3] == (LazySwfTag, ShowFrame)
+    assert showframe.__class__ is type(showframe)
+    assert isinstance(tags[3], End)
+    assert not showframe.parsed
+
+    # Setting an attribute parses the tag first.
+    symbols = tags[1]
+    symbols.offset = 0
+    assert symbols.parsed and symbols.symbols == {0: "Main"}
+    copy = symbols.as_tag()
+    assert type(copy) is SymbolClass and copy.symbols is symbols.symbols
+    assert repr(symbols) == repr(copy)
+    assert type(tags[0].as_tag()) is DoABC
+
+def test_parse_on_use(make_swf):
+    data = make_swf(main_script())
+    swf, tags = rewrite(data, True)
+    symbols = tags[1]
+    symbols.symbols[1] = "Other"
+    assert symbols.parsed
+    assert not tags[0].parsed
+
+    tags = list(SwfData.from_bytestring(swf.serialize()).read_tags())
+    assert tags[1].symbols == {0: "Main", 1: "Other"}
+    assert tags[0].name == "Main"
+
+def test_character_id():
+    source = SwfData()
+    shape = source.new_shape()
+    shape.graphics.lineStyle(1, 0xFF0000)
+    shape.graphics.lineTo(100, 100)
+    source.place(shape)
+    source.next_frame()
+    data = source.serialize()
+
+    swf = SwfData()
+    swf.next_character_id = 5
+    tags = list(SwfData.from_bytestring(data).read_tags(lazy=True))
+    for tag in tags:
+        swf.add_tag(tag)
+    shape = tags[0]
+    assert isinstance(shape, DefineShape4)
+    assert not shape.parsed
+    assert swf.next_character_id == 6
+
+    body = source.tags[0].serialize()
+    assert shape.serialize() == body[:2] + struct.pack("<H", 5) + body[4:]
+    assert swf.serialize()[21:] == data[21:].replace(body, shape.serialize())
+    assert shape.characterid == 5
+
+def test_lazy_pool(make_swf):
+    data = make_swf(main_script())
+    eager = SwfData.from_bytestring(data).read_tags(DoABC).next()
+    for read in (SwfData.read_tags, SwfData.tags_of_type):
+        tag = read(SwfData.from_bytestring(data), DoABC, lazy_pool=True).next()
+        utf8 = tag.abc.constants.utf8
+        assert not utf8.materialized
+        assert util.pending in utf8.pool
+        assert utf8.value_at(1) == "Main"
+        assert tag.serialize() == eager.serialize()
+    tag = SwfData.from_bytestring(data).tag_at(0, lazy_pool=True)
+    assert not tag.abc.constants.utf8.materialized
+    assert not isinstance(eager.abc.constants.utf8, util.LazyValuePool)
+
+def test_unknown_tag(make_swf):
+    body = "\x01\x00" + "data"
+    tag = "".join([struct.pack("<HI", 87 << 6 | 0x3F, len(body)), body])
+    data = make_swf(main_script())
+    data = data[:21] + tag + data[21:]
+    data = data[:4] + struct.pack("<I", len(data)) + data[8:]
+
+    swf, tags = rewrite(data, True)
+    assert isinstance(tags[0], UnknownSwfTag)
+    assert swf.serialize() == data
+
+def test_pickle(make_swf):
+    tag = list(SwfData.from_bytestring(make_swf(main_script())).read_tags(lazy=True))[1]
+    copy = pickle.loads(pickle.dumps(tag, 2))
+    assert isinstance(copy, SymbolClass) and isinstance(copy, LazySwfTag)
+    assert not copy.parsed
+    assert copy.serialize() == tag.serialize()
+
+    tag.parse()
+    copy = pickle.loads(pickle.dumps(tag, 2))
+    assert type(copy) is SymbolClass
+    assert copy.symbols == {0: "Main"}
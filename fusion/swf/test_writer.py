@@ -0,0 +1,118 @@
+import zlib
+import StringIO
+
+import py.test
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.writer import SwfWriter
+from fusion.swf.tags import (SetBackgroundColor, RemoveObject2, ShowFrame, End,
+                             DefineShape4, PlaceObject2)
+
+class Pipe(object):
+    """
+    An output that can only be written to.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+def inflate(data):
+    if data[0] == "C":
+        return data[:8] + zlib.decompress(data[8:])
+    return data
+
+def two_frames():
+    return [SetBackgroundColor(0x336699), ShowFrame(), RemoveObject2(1), ShowFrame()]
+
+def test_writer(make_swf):
+    for compress in (False, True):
+        for out in (StringIO.StringIO(), Pipe()):
+            with SwfWriter(out, compress=compress, level=9) as writer:
+                for tag in two_frames():
+                    writer.add_tag(tag)
+            data = out.getvalue()
+            assert inflate(data) == inflate(make_swf(two_frames(), compress))
+
+            swf = SwfData.from_bytestring(data)
+            assert swf.frame_count == 2
+            assert [type(tag) for tag in swf.read_tags()] == \
+                   [SetBackgroundColor, ShowFrame, RemoveObject2, ShowFrame, End]
+
+def draw(movie):
+    shape = movie.new_shape()
+    shape.graphics.lineStyle(1, 0xFF0000)
+    shape.graphics.lineTo(100, 100)
+    movie.place(shape)
+    movie.next_frame()
+
+def test_writer_shapes():
+    for compress in (False, True):
+        swf = SwfData(compress=compress)
+        draw(swf)
+        out = StringIO.StringIO()
+        with SwfWriter(out, compress=compress) as writer:
+            draw(writer)
+            writer.add_tag(DefineShape4(characterid=7))
+        swf.add_tag(DefineShape4(characterid=7))
+        assert inflate(out.getvalue()) == inflate(swf.serialize())
+
+        tags = list(SwfData.from_bytestring(out.getvalue()).read_tags())
+        assert [tag.id for tag in tags] == \
+               [DefineShape4.id, PlaceObject2.id, ShowFrame.id, DefineShape4.id, End.id]
+        assert [tags[0].characterid, tags[3].characterid] == [1, 2]
+
+def draw_late(movie):
+    first = movie.new_shape()
+    second = movie.new_shape()
+    first.graphics.lineTo(100, 100)
+    second.graphics.lineTo(50, 50)
+    movie.next_frame()
+
+def test_writer_holds_frame():
+    swf = SwfData()
+    draw_late(swf)
+    out = StringIO.StringIO()
+    with SwfWriter(out) as writer:
+        draw_late(writer)
+        assert writer.pending == []
+        writer.add_tag(DefineShape4(characterid=7))
+        writer.flush()
+        assert writer.pending == []
+    swf.add_tag(DefineShape4(characterid=7))
+    assert out.getvalue() == swf.serialize()
+
+def test_writer_error():
+    for out in (StringIO.StringIO(), Pipe()):
+        spill = StringIO.StringIO()
+        with py.test.raises(ValueError):
+            with SwfWriter(out, spill=spill) as writer:
+                writer.add_tag(SetBackgroundColor(0x336699))
+                raise ValueError
+        assert writer.closed
+        assert not spill.closed
+        data = out.getvalue() or spill.getvalue()
+        assert data[4:8] == "\0\0\0\0"
+        assert len(data) == 21
+
+def test_write_to(make_swf):
+    for compress in (False, True):
+        swf = make_swf(two_frames(), compress, serialize=False)
+        for threads in (None, 2):
+            out = StringIO.StringIO()
+            out.write("prefix")
+            swf.write_to(out, threads=threads, block_size=16)
+            data = out.getvalue()
+            assert data[:6] == "prefix"
+            assert inflate(data[6:]) == inflate(swf.serialize())
+
+def test_serialize_threads(make_swf):
+    swf = make_swf(two_frames(), True, serialize=False)
+    data = swf.serialize(threads=2, block_size=16)
+    assert inflate(data) == inflate(swf.serialize())
+    assert swf.serialize(level=9) == swf.serialize()[:8] + \
+           zlib.compress(inflate(data)[8:], 9)
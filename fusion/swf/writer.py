@@ -0,0 +1,184 @@
+"""
+Write a SWF to a file one tag at a time.
+
+SwfData.serialize builds the whole file in memory, then compresses it,
+which needs a few times the size of the output. SwfWriter is a SwfData
+that writes every tag out instead of keeping it. Parts like new_shape
+hand out a tag that is still being filled in after it was added, so
+the tags of a frame are only written once the frame is shown (a
+ShowFrame tag is added) or the writer is flushed.
+
+The length of the file and the number of frames are only known once
+the last tag has been written, so they are written as placeholders and
+patched when the writer is closed. In a compressed SWF the frame count
+is part of the compressed data. So the data before the tags goes into
+a stored (uncompressed) deflate block, which can be patched in place
+like in an uncompressed file, and the Adler-32 checksum of the zlib
+stream is computed afterwards from its two halves.
+
+Outputs that cannot seek get the SWF in a spill file first, which is
+copied to them when the writer is closed.
+"""
+
+import zlib
+import struct
+import shutil
+import tempfile
+
+from fusion.swf.swfdata import SwfData
+from fusion.swf.tags import End, ShowFrame
+from fusion.util import adler32_combine, zlib_header, ParallelDeflate, \
+     DEFLATE_BLOCK_SIZE
+
+def stored_block(data):
+    """
+    A non-final stored deflate block holding data, which has to start
+    on a byte boundary.
+    """
+    return struct.pack("<BHH", 0, len(data), len(data) ^ 0xFFFF) + data
+
+def seekable(file):
+    """
+    Whether the output file can be seeked back to patch it.
+    """
+    try:
+        file.seek(file.tell())
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+class SwfWriter(SwfData):
+    """
+    A SwfData that writes the tags added to it to file, and does not
+    keep them. The tags of the current frame are held until it is
+    shown or flush is called, so they can still be changed until then.
+
+    Close the writer (or use it as a context manager) to finish the
+    file. An End tag is added if the last tag was not one. A with
+    block left by an exception does not finish the file, so a partly
+    written SWF is never made to look complete.
+
+    :param level: the zlib compression level of a compressed SWF
+    :param spill: the file to write the SWF to if file cannot seek;
+                  a temporary file by default
+    :param threads: compress on this many threads with ParallelDeflate,
+                    or one per CPU if True
+    :param block_size: the size of the blocks ParallelDeflate compresses
+    """
+    def __init__(self, file, width=600, height=400, fps=24, compress=False,
+                 version=10, level=6, spill=None, threads=None,
+                 block_size=DEFLATE_BLOCK_SIZE):
+        SwfData.__init__(self, width, height, fps, compress, version)
+        self.file = file
+        self.own_spill = False
+        if seekable(file):
+            self.out = file
+        elif spill is not None:
+            self.out = spill
+        else:
+            self.out = tempfile.TemporaryFile()
+            self.own_spill = True
+        self.level = level
+        self.start = self.out.tell()
+        self.pending = []
+        self.last = None
+        self.closed = False
+
+        stub = self.get_data_stub()
+        self.length = 8 + len(stub)
+        self.out.write(self.get_magic() + chr(version) + struct.pack("<L", 0))
+        if compress:
+            self.out.write(zlib_header(level))
+            self.stub_offset = self.out.tell() + 5
+            self.out.write(stored_block(stub))
+            if threads:
+                self.compressor = ParallelDeflate(level, block_size,
+                                                  None if threads is True else threads)
+            else:
+                self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                                   -zlib.MAX_WBITS)
+            self.adler = zlib.adler32("")
+        else:
+            self.stub_offset = self.out.tell()
+            self.out.write(stub)
+            self.compressor = None
+
+    def add_raw_tag(self, tag):
+        if self.closed:
+            raise ValueError("cannot add tags to a closed SwfWriter")
+        self.pending.append(tag)
+        self.last = tag
+        if isinstance(tag, ShowFrame):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the tags held back so far. They must not be changed after
+        this.
+        """
+        if self.pending:
+            self.write_data("".join(tag.serialize() for tag in self.pending))
+            del self.pending[:]
+
+    def write_data(self, data):
+        """
+        Write serialized tags.
+        """
+        self.length += len(data)
+        if self.compressor:
+            self.adler = zlib.adler32(data, self.adler)
+            data = self.compressor.compress(data)
+        self.out.write(data)
+
+    def serialize(self):
+        raise TypeError("SwfWriter does not keep its tags to serialize")
+
+    def close(self):
+        """
+        Finish the SWF: write the End tag if needed, patch the length
+        and frame count, and copy the spill file to the output.
+        """
+        if self.closed:
+            return
+        if not isinstance(self.last, End):
+            self.add_raw_tag(End())
+        self.flush()
+        stub = self.get_data_stub()
+        out = self.out
+        if self.compressor:
+            out.write(self.compressor.flush())
+            adler = adler32_combine(zlib.adler32(stub), self.adler,
+                                    self.length - 8 - len(stub))
+            out.write(struct.pack(">L", adler))
+        end = out.tell()
+        out.seek(self.start + 4)
+        out.write(struct.pack("<L", self.length))
+        out.seek(self.stub_offset)
+        out.write(stub)
+        out.seek(end)
+
+        if out is not self.file:
+            out.seek(self.start)
+            shutil.copyfileobj(out, self.file)
+        self.release()
+
+    def release(self):
+        """
+        Stop writing without finishing the SWF, and drop the temporary
+        spill file and compression threads if the writer made them.
+        """
+        if isinstance(self.compressor, ParallelDeflate):
+            self.compressor.pool.terminate()
+        if self.own_spill:
+            self.out.close()
+        self.pending = []
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.release()
@@ -1,7 +1,9 @@
 
 import py.test
+import zlib
 
-from fusion.util import nbits, nbits_signed
+from fusion.util import nbits, nbits_signed, adler32_combine, zlib_header, \
+     ParallelDeflate, parallel_compress
 
 def test_nbits():
     assert nbits(0) == 0
@@ -36,3 +38,27 @@ def test_nbits_signed():
 
     assert nbits_signed(0, 1, 4, 2) == 4
     assert nbits_signed(0, 1, -4, 2) == 3
+
+def test_adler32_combine():
+    data = "".join(chr(i * 7 % 256) for i in xrange(100000))
+    for split in (0, 1, 5552, 65521, 65522, 99999, 100000):
+        a, b = data[:split], data[split:]
+        assert adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b)) == \
+               zlib.adler32(data) & 0xFFFFFFFF
+
+def test_zlib_header():
+    for level in xrange(-1, 10):
+        assert zlib_header(level) == zlib.compress("", level)[:2]
+
+def test_parallel_compress():
+    data = "".join(chr(i * i % 251) for i in xrange(50000)) * 3
+    for size in (0, 1, 1000, 65536, len(data)):
+        for block_size in (1000, 0x10000):
+            compressed = parallel_compress(data[:size], 9, block_size, 3)
+            assert zlib.decompress(compressed) == data[:size]
+
+    deflate = ParallelDeflate(block_size=4096, threads=2)
+    chunks = [deflate.compress(data[i:i+3000]) for i in xrange(0, len(data), 3000)]
+    chunks.append(deflate.flush())
+    assert zlib.decompress("".join(chunks), -zlib.MAX_WBITS) == data
+    assert deflate.adler == zlib.adler32(data) & 0xFFFFFFFF
@@ -1,5 +1,16 @@
 
 import re
+import zlib
+import struct
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# The modulus of Adler-32.
+ADLER_BASE = 65521
+
+# How much ParallelDeflate hands to a thread at a time.
+DEFLATE_BLOCK_SIZE = 0x100000
 
 def nbits(*args):
     """
@@ -56,3 +67,109 @@ def camel_case_convert(string):
     writeXMLDocument gets converted to write_xml_document.
     """
     return '_'.join(s.lower() for s in camel_case_match(string))
+
+def adler32_combine(adler1, adler2, len2):
+    """
+    Returns the Adler-32 checksum of two pieces of data joined together,
+    given the checksum of each and the length of the second one, like
+    zlib's adler32_combine.
+    """
+    adler1, adler2 = adler1 & 0xFFFFFFFF, adler2 & 0xFFFFFFFF
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = rem * sum1 % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xFFFF) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | sum2 << 16
+
+def zlib_header(level):
+    """
+    Returns the two byte header of a zlib stream compressed at level,
+    with a 32K window.
+    """
+    if level < 0:
+        level = 6
+    flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+    header = 0x7800 | flevel << 6
+    return struct.pack(">H", header + (31 - header % 31) % 31)
+
+def deflate_block(data, level, last):
+    """
+    Deflate a block on its own, ending it on a byte boundary with a
+    sync flush so that the next block can follow it, or as the final
+    block. Returns the compressed data, the Adler-32 of data and its
+    length.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + \
+                 compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data), len(data)
+
+class ParallelDeflate(object):
+    """
+    A raw deflate compressor with the compress/flush interface of
+    zlib's compressobj, which compresses blocks of block_size bytes
+    on threads threads (one per CPU by default), like pigz does.
+
+    zlib lets go of the GIL while it compresses, so the blocks are
+    compressed in parallel. Each block is compressed on its own, which
+    costs a little compression as no match can reach back into the
+    block before. The output comes out in order, and at most two
+    blocks per thread are in flight. adler is the Adler-32 checksum of
+    the data compressed so far, once flush has been called.
+    """
+    def __init__(self, level=6, block_size=DEFLATE_BLOCK_SIZE, threads=None):
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or cpu_count()
+        self.pool = ThreadPool(self.threads)
+        self.pending = deque()
+        self.buffer, self.buffered = [], 0
+        self.adler = zlib.adler32("") & 0xFFFFFFFF
+
+    def submit(self, data, last=False):
+        self.pending.append(self.pool.apply_async(deflate_block,
+                                                  (data, self.level, last)))
+
+    def collect(self, wait=0):
+        """
+        Return the compressed blocks that are done, waiting for all
+        but wait of the blocks in flight.
+        """
+        chunks = []
+        while self.pending and (len(self.pending) > wait or self.pending[0].ready()):
+            compressed, adler, length = self.pending.popleft().get()
+            self.adler = adler32_combine(self.adler, adler, length)
+            chunks.append(compressed)
+        return "".join(chunks)
+
+    def compress(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.block_size:
+            return ""
+        data, size = "".join(self.buffer), self.block_size
+        end = len(data) - len(data) % size
+        for start in xrange(0, end, size):
+            self.submit(data[start:start+size])
+        self.buffer, self.buffered = [data[end:]], len(data) - end
+        return self.collect(2 * self.threads)
+
+    def flush(self):
+        self.submit("".join(self.buffer), last=True)
+        self.buffer, self.buffered = [], 0
+        try:
+            return self.collect()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+def parallel_compress(data, level=6, block_size=DEFLATE_BLOCK_SIZE, threads=None):
+    """
+    Compress data into a zlib stream like zlib.compress, on threads
+    threads through ParallelDeflate.
+    """
+    compressor = ParallelDeflate(level, block_size, threads)
+    compressed = compressor.compress(data) + compressor.flush()
+    return "".join([zlib_header(level), compressed,
+                    struct.pack(">L", compressor.adler)])